@@ -0,0 +1,140 @@
+"""
+Local fake of the Telegram Bot API and a synthetic update generator.
+
+FakeBotAPI answers the methods the handlers call (getMe, sendMessage,
+editMessageText, answerCallbackQuery, getChatMember, getChat,
+deleteMessage, ...) with minimal valid objects and an optional latency.
+aiogram's Bot is pointed at it through a custom TelegramAPIServer:
+
+    bot = Bot(token, session=AiohttpSession(api=api.server()))
+
+UpdateFactory builds Update objects for Dispatcher.feed_update.
+"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from typing import Iterable, Optional
+
+from aiohttp import web
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+BOT_ID = 100500
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.0, non_members: Iterable[int] = ()):
+        self.latency = latency
+        self.non_members = set(non_members)
+        self.calls = Counter()
+        self._message_ids = itertools.count(1)
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    def server(self) -> TelegramAPIServer:
+        return TelegramAPIServer.from_base(self.url)
+
+    @staticmethod
+    def _user(user_id: int, is_bot: bool = False) -> dict:
+        return {"id": user_id, "is_bot": is_bot, "first_name": f"User {user_id}"}
+
+    def _message(self, chat_id, text: str = "", message_id: Optional[int] = None) -> dict:
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "private"},
+            "from": self._user(BOT_ID, is_bot=True),
+            "text": text or "",
+        }
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post())
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        name = method.lower()
+        if name == "getme":
+            result = {**self._user(BOT_ID, is_bot=True), "first_name": "Bench bot", "username": "bench_bot"}
+        elif name in ("sendmessage", "editmessagetext"):
+            message_id = int(params["message_id"]) if params.get("message_id") else None
+            result = self._message(params["chat_id"], params.get("text", ""), message_id)
+        elif name == "getchatmember":
+            user_id = int(params["user_id"])
+            status = "left" if user_id in self.non_members else "member"
+            result = {"status": status, "user": self._user(user_id)}
+        elif name == "getchat":
+            result = {"id": int(params["chat_id"]), "type": "supergroup", "title": "Bench chat"}
+        else:
+            # answerCallbackQuery, deleteMessage, deleteWebhook и прочие
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 18081):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        self.url = f"http://{host}:{port}"
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+class UpdateFactory:
+    """Синтетические апдейты от пользователей личного чата с ботом"""
+
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1_000_000)
+
+    def _user(self, user_id: int) -> dict:
+        return {
+            "id": user_id, "is_bot": False, "first_name": "Bench",
+            "last_name": str(user_id), "username": f"bench_{user_id}",
+        }
+
+    def _message(self, user_id: int, text: str, from_bot: bool = False) -> dict:
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": BOT_ID, "is_bot": True, "first_name": "Bench bot"} if from_bot else self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        return message
+
+    def message(self, user_id: int, text: str) -> Update:
+        return Update.model_validate({"update_id": next(self._update_ids), "message": self._message(user_id, text)})
+
+    def command(self, user_id: int, command: str) -> Update:
+        return self.message(user_id, f"/{command}")
+
+    def callback(self, user_id: int, data: str) -> Update:
+        """Нажатие inline-кнопки под сообщением бота"""
+        return Update.model_validate({
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": self._message(user_id, "menu", from_bot=True),
+            },
+        })
+
+if __name__ == "__main__":
+    # Пример апдейта для отладки генератора
+    print(json.dumps(UpdateFactory().callback(1, "connect").model_dump(mode="json", exclude_none=True), indent=2))
@@ -0,0 +1,194 @@
+"""
+Handler throughput benchmark: replays synthetic updates through the real
+router against FakeBotAPI and MockPanel.
+
+Phases:
+    start     - /start from new users (registration)
+    restart   - /start from the same, already registered users
+    connect   - "connect" button: profile creation in the panel
+    stats     - "stats" button
+    broadcast - admin broadcast to all users, until the job finishes
+
+Each phase reports updates/s, p50/p99 update latency, event-loop lag and
+per-update DB queries and Bot API calls:
+
+    python bench/handler_bench.py --users 2000
+"""
+import argparse
+import asyncio
+import logging
+import tempfile
+import time
+
+from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.fsm.storage.memory import MemoryStorage
+from sqlalchemy import event
+
+from fake_bot_api import FakeBotAPI, UpdateFactory
+from mock_panel import MockPanel
+from xui_bench import configure_env, percentile
+
+ADMIN_ID = 1
+USER_ID_BASE = 10_000_000
+
+class LoopLagMonitor:
+    """Задержка event loop: насколько позже запланированного просыпается sleep"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append((time.perf_counter() - started - self.interval) * 1000)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def take(self) -> list:
+        samples, self.samples = self.samples, []
+        return samples
+
+    def stop(self):
+        self._task.cancel()
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine.sync_engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+class Phase:
+    HEADER = (
+        f"{'phase':<10}{'updates':>9}{'upd/s':>9}{'p50 ms':>9}{'p99 ms':>9}"
+        f"{'lag p99':>9}{'lag max':>9}{'queries/u':>11}{'api/u':>8}"
+    )
+
+    def __init__(self, name, updates, duration, latencies, lag, queries, api_calls):
+        self.row = (
+            f"{name:<10}{updates:>9}{updates / duration if duration else 0:>9.1f}"
+            f"{percentile(latencies, 50):>9.1f}{percentile(latencies, 99):>9.1f}"
+            f"{percentile(lag, 99):>9.1f}{max(lag, default=0):>9.1f}"
+            f"{queries / updates if updates else 0:>11.2f}{api_calls / updates if updates else 0:>8.2f}"
+        )
+
+async def run(args):
+    configure_env(
+        args, tempfile.mkdtemp(prefix="xray-bench-"),
+        ADMINS=str(ADMIN_ID),
+        BROADCAST_RATE=str(args.broadcast_rate),
+        BROADCAST_PROGRESS_INTERVAL="1",
+        MEMBERSHIP_CACHE_TTL="300",
+    )
+
+    import broadcast
+    import database
+    import functions
+    import handlers
+    from config import config
+    from handlers import setup_handlers
+
+    panel = MockPanel(args.clients, (1,), args.panel_latency)
+    panel_runner = await panel.start(port=args.port)
+    api = FakeBotAPI(args.tg_latency)
+    await api.start(port=args.tg_port)
+    await database.init_db()
+    await database.load_user_store()
+
+    bot = Bot(config.BOT_TOKEN, session=AiohttpSession(api=api.server()))
+    dp = Dispatcher(storage=MemoryStorage())
+    setup_handlers(dp)
+    factory = UpdateFactory()
+    queries = QueryCounter(database.engine)
+    lag = LoopLagMonitor()
+    lag.start()
+    limit = asyncio.Semaphore(config.UPDATE_CONCURRENCY)
+    phases = []
+
+    async def feed(updates, name: str = None):
+        """Обработать апдейты с ограничением UPDATE_CONCURRENCY; без name фаза не попадает в отчет"""
+        latencies = []
+
+        async def handle(update):
+            async with limit:
+                started = time.perf_counter()
+                await dp.feed_update(bot, update)
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        lag.take()
+        queries_before, calls_before = queries.count, sum(api.calls.values())
+        started = time.perf_counter()
+        await asyncio.gather(*(handle(update) for update in updates))
+        if name:
+            phases.append(Phase(
+                name, len(updates), time.perf_counter() - started, latencies, lag.take(),
+                queries.count - queries_before, sum(api.calls.values()) - calls_before,
+            ))
+
+    users = [USER_ID_BASE + i for i in range(args.users)]
+    try:
+        await feed([factory.command(ADMIN_ID, "start")])
+        if args.skip_welcome_delay:
+            # Только пауза после приветствия: остальные задержки (aiohttp,
+            # aiogram, ограничители запросов) остаются настоящими
+            handlers.WELCOME_DELAY = 0
+        await feed([factory.command(user_id, "start") for user_id in users], "start")
+        await feed([factory.command(user_id, "start") for user_id in users], "restart")
+        await feed([factory.callback(user_id, "connect") for user_id in users], "connect")
+        await feed([factory.callback(user_id, "stats") for user_id in users], "stats")
+
+        # Рассылка: три шага администратора, затем ждем завершения фоновой задачи
+        await feed([factory.callback(ADMIN_ID, "admin_send_message")])
+        await feed([factory.callback(ADMIN_ID, "target_all")])
+        lag.take()
+        queries_before, sent_before = queries.count, api.calls["sendMessage"]
+        started = time.perf_counter()
+        await dp.feed_update(bot, factory.message(ADMIN_ID, "Benchmark broadcast"))
+        while broadcast._jobs:
+            await asyncio.sleep(0.05)
+        duration = time.perf_counter() - started
+        sent = api.calls["sendMessage"] - sent_before
+        phases.append(Phase(
+            "broadcast", sent, duration, [duration * 1000], lag.take(),
+            queries.count - queries_before, sent,
+        ))
+    finally:
+        lag.stop()
+        await bot.session.close()
+        await functions.close_api()
+        await database.close_db()
+        await api.close()
+        await panel_runner.cleanup()
+
+    print(
+        f"\n{args.users} users, Bot API latency {args.tg_latency * 1000:.0f} ms, "
+        f"panel latency {args.panel_latency * 1000:.0f} ms, update concurrency {config.UPDATE_CONCURRENCY}"
+    )
+    print(Phase.HEADER)
+    for phase in phases:
+        print(phase.row)
+    print("Bot API calls:", dict(api.calls.most_common()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Handler throughput benchmark")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--clients", type=int, default=1000, help="clients pre-created in the mock panel")
+    parser.add_argument("--tg-latency", type=float, default=0.005, help="Bot API latency, seconds")
+    parser.add_argument("--panel-latency", type=float, default=0.005, help="panel latency, seconds")
+    parser.add_argument("--broadcast-rate", type=float, default=1000, help="BROADCAST_RATE, messages per second")
+    parser.add_argument("--skip-welcome-delay", action="store_true",
+                        help="drop the 2 s pause after greeting a new user")
+    parser.add_argument("--port", type=int, default=18053, help="mock panel port")
+    parser.add_argument("--tg-port", type=int, default=18081, help="fake Bot API port")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+    # Для configure_env: ревизия в этом бенчмарке не запускается
+    args.tg_rate, args.concurrency = 1000, 10
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    asyncio.run(run(args))
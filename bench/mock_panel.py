@@ -0,0 +1,218 @@
+"""
+Local stand-in for the 3x-ui panel API used by the bot.
+
+Implements the endpoints XUIAPI talks to (login, inbounds/get, update,
+addClient, delClient, updateClient, getClientTraffics, onlines) with an
+artificial per-request latency and a configurable number of pre-created
+clients. Requests and bytes are counted per endpoint so benchmarks can
+report transfer costs.
+
+Standalone run (e.g. to point a local bot at it):
+
+    python bench/mock_panel.py --clients 10000 --latency 0.02 --port 2053
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import Counter
+from typing import Dict, Iterable, List
+
+from aiohttp import web
+
+class MockPanel:
+    def __init__(self, clients: int = 1000, inbound_ids: Iterable[int] = (1,),
+                 latency: float = 0.0, client_api: bool = True, base_path: str = "/panel",
+                 username: str = "admin", password: str = "admin"):
+        self.latency = latency
+        self.client_api = client_api
+        self.base_path = "/" + base_path.strip("/") if base_path.strip("/") else ""
+        self.username = username
+        self.password = password
+        self.inbounds: Dict[int, List[dict]] = {}
+        self._bodies: Dict[int, bytes] = {}
+        self._sessions = set()
+        self.requests = Counter()
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        for inbound_id in inbound_ids:
+            self.inbounds[inbound_id] = [
+                self.make_client(f"bench_{inbound_id}_{i}") for i in range(clients)
+            ]
+
+    @staticmethod
+    def make_client(email: str) -> dict:
+        return {
+            "id": str(uuid.uuid4()), "flow": "", "email": email, "limitIp": 0,
+            "totalGB": 0, "expiryTime": 0, "enable": True, "tgId": "", "subId": "",
+            "reset": 0,
+        }
+
+    def snapshot(self) -> dict:
+        """Текущие счетчики запросов и трафика (для разницы до/после сценария)"""
+        return {"requests": sum(self.requests.values()), "bytes_in": self.bytes_in, "bytes_out": self.bytes_out}
+
+    def _changed(self, inbound_id: int):
+        self._bodies.pop(inbound_id, None)
+
+    def _inbound_body(self, inbound_id: int) -> bytes:
+        # Сериализация больших инбаундов кэшируется до изменения, чтобы
+        # в замеры попадала стоимость бота, а не мока
+        body = self._bodies.get(inbound_id)
+        if body is None:
+            clients = self.inbounds[inbound_id]
+            body = json.dumps({"success": True, "msg": "", "obj": {
+                "id": inbound_id, "up": 1024 * len(clients), "down": 4096 * len(clients),
+                "total": 0, "remark": f"bench-{inbound_id}", "enable": True, "expiryTime": 0,
+                "listen": "", "port": 443 + inbound_id, "protocol": "vless",
+                "settings": json.dumps({"clients": clients, "decryption": "none", "fallbacks": []}),
+                "streamSettings": json.dumps({"network": "tcp", "security": "reality"}),
+                "sniffing": json.dumps({"enabled": False}),
+                "clientStats": [
+                    {"id": i, "inboundId": inbound_id, "enable": True, "email": c["email"],
+                     "up": 1024, "down": 4096, "expiryTime": 0, "total": 0}
+                    for i, c in enumerate(clients)
+                ],
+            }}).encode()
+            self._bodies[inbound_id] = body
+        return body
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler):
+        self.requests[request.match_info.route.name or request.path] += 1
+        self.bytes_in += request.content_length or 0
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if not request.path.endswith("/login") and request.cookies.get("3x-ui") not in self._sessions:
+            # Как и настоящая панель, без сессии отправляем на страницу логина
+            raise web.HTTPFound(f"{self.base_path}/")
+        response = await handler(request)
+        self.bytes_out += len(response.body or b"")
+        return response
+
+    @staticmethod
+    def _result(success: bool, msg: str = "") -> web.Response:
+        return web.json_response({"success": success, "msg": msg, "obj": None})
+
+    async def login(self, request: web.Request):
+        data = await request.post()
+        if data.get("username") != self.username or data.get("password") != self.password:
+            return self._result(False, "Wrong username or password")
+        token = uuid.uuid4().hex
+        self._sessions.add(token)
+        response = self._result(True, "Login Successfully")
+        response.set_cookie("3x-ui", token)
+        return response
+
+    async def get_inbound(self, request: web.Request):
+        inbound_id = int(request.match_info["id"])
+        if inbound_id not in self.inbounds:
+            return self._result(False, "record not found")
+        return web.Response(body=self._inbound_body(inbound_id), content_type="application/json")
+
+    async def update_inbound(self, request: web.Request):
+        inbound_id = int(request.match_info["id"])
+        data = await request.json()
+        self.inbounds[inbound_id] = json.loads(data["settings"])["clients"]
+        self._changed(inbound_id)
+        return self._result(True)
+
+    async def add_client(self, request: web.Request):
+        if not self.client_api:
+            raise web.HTTPNotFound()
+        data = await request.json()
+        inbound_id = int(data["id"])
+        clients = json.loads(data["settings"])["clients"]
+        emails = {c["email"] for c in self.inbounds[inbound_id]}
+        if any(c["email"] in emails for c in clients):
+            return self._result(False, "Duplicate email")
+        self.inbounds[inbound_id].extend(clients)
+        self._changed(inbound_id)
+        return self._result(True)
+
+    async def del_client(self, request: web.Request):
+        if not self.client_api:
+            raise web.HTTPNotFound()
+        inbound_id = int(request.match_info["id"])
+        client_id = request.match_info["client_id"]
+        clients = self.inbounds[inbound_id]
+        remaining = [c for c in clients if c["id"] != client_id]
+        if len(remaining) == len(clients):
+            return self._result(False, "client not found")
+        self.inbounds[inbound_id] = remaining
+        self._changed(inbound_id)
+        return self._result(True)
+
+    async def update_client(self, request: web.Request):
+        if not self.client_api:
+            raise web.HTTPNotFound()
+        data = await request.json()
+        inbound_id = int(data["id"])
+        client = json.loads(data["settings"])["clients"][0]
+        clients = self.inbounds[inbound_id]
+        for i, c in enumerate(clients):
+            if c["id"] == request.match_info["client_id"]:
+                clients[i] = client
+                self._changed(inbound_id)
+                return self._result(True)
+        return self._result(False, "client not found")
+
+    async def client_traffics(self, request: web.Request):
+        email = request.match_info["email"]
+        for inbound_id, clients in self.inbounds.items():
+            if any(c["email"] == email for c in clients):
+                return web.json_response({"success": True, "msg": "", "obj": {
+                    "inboundId": inbound_id, "email": email, "up": 1024, "down": 4096,
+                }})
+        return web.json_response({"success": True, "msg": "", "obj": None})
+
+    async def onlines(self, request: web.Request):
+        online = [c["email"] for clients in self.inbounds.values() for c in clients[:100]]
+        return web.json_response({"success": True, "msg": "", "obj": online})
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._middleware], client_max_size=256 * 1024 ** 2)
+        api = f"{self.base_path}/panel/api/inbounds"
+        app.router.add_post(f"{self.base_path}/login", self.login, name="login")
+        app.router.add_get(f"{api}/get/{{id}}", self.get_inbound, name="get")
+        app.router.add_post(f"{api}/update/{{id}}", self.update_inbound, name="update")
+        app.router.add_post(f"{api}/addClient", self.add_client, name="addClient")
+        app.router.add_post(f"{api}/{{id}}/delClient/{{client_id}}", self.del_client, name="delClient")
+        app.router.add_post(f"{api}/updateClient/{{client_id}}", self.update_client, name="updateClient")
+        app.router.add_get(f"{api}/getClientTraffics/{{email}}", self.client_traffics, name="getClientTraffics")
+        app.router.add_post(f"{api}/onlines", self.onlines, name="onlines")
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 2053) -> web.AppRunner:
+        runner = web.AppRunner(self.app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+async def _serve(args):
+    started = time.monotonic()
+    panel = MockPanel(args.clients, args.inbounds, args.latency, not args.no_client_api)
+    runner = await panel.start(args.host, args.port)
+    print(
+        f"Mock panel with {args.clients} clients per inbound {args.inbounds} "
+        f"listening on http://{args.host}:{args.port}/panel ({time.monotonic() - started:.1f}s)"
+    )
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock 3x-ui panel")
+    parser.add_argument("--clients", type=int, default=1000, help="clients per inbound")
+    parser.add_argument("--inbounds", type=int, nargs="+", default=[1])
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--no-client-api", action="store_true", help="emulate panels without addClient/delClient")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2053)
+    try:
+        asyncio.run(_serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
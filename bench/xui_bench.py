@@ -0,0 +1,226 @@
+"""
+End-to-end load benchmark of the bot's 3x-ui flows against MockPanel.
+
+Scenarios:
+    create  - pool.create_vless_profile for --ops users
+    stats   - get_user_stats + get_global_stats + get_online_users_count
+    poll    - full traffic snapshot of the inbound (TrafficMonitor.poll)
+    delete  - delete_client_by_email for the clients created above
+    audit   - run_membership_audit over --clients users with a fake bot,
+              --leavers of them have left the chat and lose their profiles
+
+For every scenario throughput, p50/p99 latency and the panel requests and
+bytes it caused are reported. Run one panel size per process:
+
+    for n in 1000 10000 50000; do python bench/xui_bench.py --clients $n; done
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+from mock_panel import MockPanel
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+SCENARIOS = ("create", "stats", "poll", "delete", "audit")
+
+def configure_env(args, data_dir: str, **extra: str):
+    """Настройки бота задаются до импорта модулей из src"""
+    os.environ.update({
+        "BOT_TOKEN": "123456:bench",
+        "CHAT_ID": "-1000000000000",
+        "XUI_API_URL": f"http://127.0.0.1:{args.port}",
+        "XUI_BASE_PATH": "/panel",
+        "XUI_HOST": "bench.example.com",
+        "INBOUND_ID": "1",
+        "DATABASE_URL": f"sqlite+aiosqlite:///{data_dir}/bench.db",
+        "AUDIT_RATE": str(args.tg_rate),
+        "AUDIT_CONCURRENCY": str(args.concurrency),
+        **extra,
+    })
+    os.environ.pop("XUI_SERVERS", None)
+    sys.path.insert(0, str(SRC_DIR))
+
+def percentile(values, q: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[int(q) - 1]
+
+class Report:
+    HEADER = f"{'scenario':<10}{'ops':>8}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'requests':>10}{'KiB in':>10}{'KiB out':>12}"
+
+    def __init__(self, panel: MockPanel):
+        self.panel = panel
+        self.rows = []
+
+    async def measure(self, name: str, ops, concurrency: int):
+        """Выполнить корутины из ops с заданной параллельностью и записать метрики"""
+        ops = list(ops)
+        latencies = []
+        pending = iter(ops)
+
+        async def worker():
+            for op in pending:
+                started = time.perf_counter()
+                await op()
+                latencies.append((time.perf_counter() - started) * 1000)
+
+        before = self.panel.snapshot()
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(ops))))))
+        self._add(name, latencies, time.perf_counter() - started, before)
+
+    def record(self, name: str, latencies, duration: float, before: dict):
+        self._add(name, latencies, duration, before)
+
+    def _add(self, name, latencies, duration, before):
+        after = self.panel.snapshot()
+        self.rows.append((
+            name, len(latencies), len(latencies) / duration if duration else 0.0,
+            percentile(latencies, 50), percentile(latencies, 99),
+            after["requests"] - before["requests"],
+            (after["bytes_out"] - before["bytes_out"]) / 1024,
+            (after["bytes_in"] - before["bytes_in"]) / 1024,
+        ))
+
+    def print(self, title: str):
+        print(f"\n{title}")
+        print(self.HEADER)
+        for name, ops, rate, p50, p99, requests, kib_in, kib_out in self.rows:
+            # "in" - принято ботом от панели, "out" - отправлено ботом
+            print(f"{name:<10}{ops:>8}{rate:>10.1f}{p50:>10.1f}{p99:>10.1f}{requests:>10}{kib_in:>10.0f}{kib_out:>12.0f}")
+
+class FakeBot:
+    """Бот, отвечающий на getChatMember без обращения к Telegram"""
+
+    def __init__(self, leavers: set, latency: float):
+        self.leavers = leavers
+        self.latency = latency
+        self.latencies = []
+        self.sent = 0
+
+    async def get_chat_member(self, chat_id: int, user_id: int):
+        started = time.perf_counter()
+        await asyncio.sleep(self.latency)
+        self.latencies.append((time.perf_counter() - started) * 1000)
+        return SimpleNamespace(status="left" if user_id in self.leavers else "member")
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.sent += 1
+
+async def _seed_users(panel: MockPanel, leavers_share: float) -> set:
+    """
+    Пользователи БД для ревизии. Вышедшие из чата все еще отмечены в БД
+    как участники, их профили остались в инбаунде (пропущенное событие
+    chat_member).
+    """
+    from database import Session, User
+
+    clients = panel.inbounds[1]
+    step = max(1, round(1 / leavers_share)) if leavers_share > 0 else 0
+    leavers = set()
+    users = []
+    for i, client in enumerate(clients):
+        telegram_id = 10_000_000 + i
+        is_leaver = bool(step) and i % step == 0
+        if is_leaver:
+            leavers.add(telegram_id)
+        users.append(User(
+            telegram_id=telegram_id, full_name=f"Bench {i}", chat_member=True,
+            vless_profile_data=json.dumps({"client_id": client["id"], "email": client["email"], "port": 444}),
+        ))
+    async with Session() as session:
+        session.add_all(users)
+        await session.commit()
+    return leavers
+
+async def run(args):
+    data_dir = tempfile.mkdtemp(prefix="xray-bench-")
+    configure_env(args, data_dir)
+
+    import database
+    import functions
+    import pool
+    from audit import run_membership_audit
+    from traffic import traffic_monitor
+
+    panel = MockPanel(args.clients, (1,), args.latency, not args.no_client_api)
+    runner = await panel.start(port=args.port)
+    await database.init_db()
+    report = Report(panel)
+    scenarios = [s for s in SCENARIOS if s in args.scenarios]
+    profiles = []
+
+    try:
+        # Первый снимок трафика делается при старте бота и в замеры не входит
+        await traffic_monitor.poll()
+
+        if "create" in scenarios:
+            async def create(telegram_id):
+                profile = await pool.create_vless_profile(telegram_id)
+                if profile:
+                    profiles.append(profile)
+            await report.measure("create", (lambda i=i: create(i) for i in range(args.ops)), args.concurrency)
+
+        if "stats" in scenarios:
+            emails = [c["email"] for c in panel.inbounds[1][:args.ops]]
+
+            async def stats(email):
+                await functions.get_user_stats(email)
+                await functions.get_global_stats()
+                await functions.get_online_users_count()
+            await report.measure("stats", (lambda e=e: stats(e) for e in emails), args.concurrency)
+
+        if "poll" in scenarios:
+            await report.measure("poll", (traffic_monitor.poll for _ in range(args.polls)), 1)
+
+        if "delete" in scenarios:
+            targets = profiles or [
+                {"email": c["email"], "client_id": c["id"]} for c in panel.inbounds[1][:args.ops]
+            ]
+
+            async def delete(profile):
+                await functions.delete_client_by_email(
+                    profile["email"], profile.get("client_id"),
+                    profile.get("server"), profile.get("inbound_id"),
+                )
+            await report.measure("delete", (lambda p=p: delete(p) for p in targets), args.concurrency)
+
+        if "audit" in scenarios:
+            leavers = await _seed_users(panel, args.leavers)
+            bot = FakeBot(leavers, args.tg_latency)
+            before = panel.snapshot()
+            started = time.perf_counter()
+            stats = await run_membership_audit(bot)
+            report.record("audit", bot.latencies, time.perf_counter() - started, before)
+            print(f"audit: {stats}")
+    finally:
+        await functions.close_api()
+        await database.close_db()
+        await runner.cleanup()
+
+    report.print(
+        f"{args.clients} clients, panel latency {args.latency * 1000:.0f} ms, "
+        f"concurrency {args.concurrency}, client API {'off' if args.no_client_api else 'on'}"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="3x-ui flows benchmark")
+    parser.add_argument("--clients", type=int, default=1000, help="clients pre-created in the inbound")
+    parser.add_argument("--ops", type=int, default=200, help="operations per scenario")
+    parser.add_argument("--polls", type=int, default=5, help="traffic snapshots in the poll scenario")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency", type=float, default=0.005, help="panel latency per request, seconds")
+    parser.add_argument("--no-client-api", action="store_true", help="panel without addClient/delClient")
+    parser.add_argument("--leavers", type=float, default=0.05, help="share of users that left the chat")
+    parser.add_argument("--tg-latency", type=float, default=0.002, help="getChatMember latency, seconds")
+    parser.add_argument("--tg-rate", type=float, default=1000, help="AUDIT_RATE for the audit scenario")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--port", type=int, default=18053)
+    asyncio.run(run(parser.parse_args()))
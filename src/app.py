@@ -1,4 +1,3 @@
-import json
 import asyncio
 import logging
 import warnings
@@ -6,8 +5,18 @@ import coloredlogs
 from config import config
 from aiogram import Bot, Dispatcher
 from handlers import setup_handlers
-from functions import delete_client_by_email, check_if_user_chat_member
-from database import Session, User, init_db, get_all_users, delete_user_profile
+from audit import run_membership_audit
+from broadcast import resume_broadcasts
+from server import create_web_app, run_webhook, start_web_app
+from metrics import setup_metrics, monitor_event_loop_lag
+from tracing import setup_tracing
+from storage import create_fsm_storage, locks
+from functions import close_api
+from traffic import traffic_monitor
+from history import traffic_history
+from presentation import presentation
+from subscription import subscriptions
+from database import engine, init_db, close_db, sync_admins, load_user_store
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
@@ -15,68 +24,31 @@ warnings.filterwarnings("ignore", category=DeprecationWarning)
 coloredlogs.install(level='info')
 logger = logging.getLogger(__name__)
 
+AUDIT_LEASE_TTL = 300
+
 async def check_users(bot: Bot):
     """Ревизия пользователей"""
     while True:
         try:
-            users = await get_all_users()
-            
-            for user in users:
-                # Проверяем, является ли пользователь участником чата (группы)
-                user_chat_member = await check_if_user_chat_member(user.telegram_id, bot)
-                # Small delay to reduce API burst and flood risk
-                await asyncio.sleep(0.1)
-
-                # Delete profile only when we explicitly confirmed non-membership.
-                # None means temporary check failure and must not trigger deletion.
-                if user_chat_member is False and user.vless_profile_data:
-                    try:
-                        profile = json.loads(user.vless_profile_data)
-                        # Удаляем из инбаунда
-                        success = await delete_client_by_email(profile["email"])
-                        if success:
-                            # Удаляем профиль из БД
-                            await delete_user_profile(user.telegram_id)
-                            
-                            await bot.send_message(
-                                user.telegram_id,
-                                "❌ Ваш профиль VPN был удален."
-                            )
-                        else:
-                            logger.warning(f"⚠️ Failed to delete client {profile['email']} from inbound")
-                    except Exception as e:
-                        logger.warning(f"⚠️ Deletion error: {e}")
+            # Ревизию выполняет только один из процессов бота
+            async with locks.lease("audit", AUDIT_LEASE_TTL) as acquired:
+                if acquired:
+                    await run_membership_audit(bot)
+                else:
+                    logger.info("ℹ️  Users audit is running in another worker, skipping")
         except Exception as e:
             logger.warning(f"⚠️ Users check error: {e}")
         
-        await asyncio.sleep(3600)
+        await asyncio.sleep(config.AUDIT_INTERVAL)
 
 async def update_admins_status():
     """Обновляет статус администраторов в базе данных"""
-    with Session() as session:
-        # Сбрасываем статус администратора у всех пользователей
-        session.query(User).update({User.is_admin: False})
-        
-        # Устанавливаем статус администратора для пользователей из config.ADMINS
-        for admin_id in config.ADMINS:
-            user = session.query(User).filter_by(telegram_id=admin_id).first()
-            if user:
-                user.is_admin = True
-            else:
-                # Если администратора нет в базе, создаем запись
-                new_admin = User(
-                    telegram_id=admin_id,
-                    full_name=f"Admin {admin_id}",
-                    is_admin=True
-                )
-                session.add(new_admin)
-        
-        session.commit()
+    await sync_admins(config.ADMINS)
     logger.info("✅ Admin status updated in database")
 
 async def main():
     bot = Bot(token=config.BOT_TOKEN)
-    dp = Dispatcher()
+    dp = Dispatcher(storage=create_fsm_storage())
     
     try:
         await init_db()
@@ -84,12 +56,17 @@ async def main():
 
         # Обновляем статус администраторов
         await update_admins_status()
+
+        # Пользователи читаются из памяти, записи идут в базу и в память
+        await load_user_store()
     except Exception as e:
         logger.error(f"❌ Database initialization error: {e}")
         return
     
     try:
         setup_handlers(dp)
+        setup_metrics(dp)
+        setup_tracing(dp, bot, engine)
         logger.info("✅ Handlers registered")
     except Exception as e:
         logger.error(f"❌ Handler registration error: {e}")
@@ -100,13 +77,57 @@ async def main():
         asyncio.create_task(check_users(bot))
     except Exception as e:
         logger.error(f"❌ Users check task failed to start: {e}")
+
+    # Продолжаем рассылки, прерванные перезапуском
+    try:
+        await resume_broadcasts(bot)
+    except Exception as e:
+        logger.error(f"❌ Broadcasts resume failed: {e}")
+
+    # Имя бота и название чата для приветствия и справки
+    if await presentation.refresh(bot):
+        logger.info("✅ Bot identity cached")
+    asyncio.create_task(presentation.run(bot))
+
+    # Запускаем фоновый опрос трафика
+    try:
+        asyncio.create_task(traffic_monitor.run())
+    except Exception as e:
+        logger.error(f"❌ Traffic poller failed to start: {e}")
+
+    if config.TRAFFIC_HISTORY_ENABLED:
+        asyncio.create_task(traffic_history.run())
     
-    logger.info("ℹ️  Starting bot...")
+    if config.METRICS_ENABLED:
+        asyncio.create_task(monitor_event_loop_lag())
+
+    # Тела подписок, не собранные сейчас, соберутся при первом запросе
+    if config.SUBSCRIPTION_BASE_URL:
+        try:
+            await subscriptions.warm()
+        except Exception as e:
+            logger.warning(f"⚠️ Subscriptions warm-up failed: {e}")
+
+    logger.info(f"ℹ️  Starting bot in {config.BOT_MODE} mode...")
+    web_runner = None
     try:
-        await dp.start_polling(bot)
+        if config.BOT_MODE == "webhook":
+            await run_webhook(dp, bot, create_web_app())
+        else:
+            if config.METRICS_ENABLED or config.SUBSCRIPTION_BASE_URL:
+                # В режиме polling веб-сервер нужен только для метрик и подписок
+                web_runner = await start_web_app(create_web_app())
+            # Вебхук, оставшийся от запуска в режиме webhook, мешает getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot, tasks_concurrency_limit=config.UPDATE_CONCURRENCY)
     except Exception as e:
         logger.error(f"❌ Bot start error: {e}")
         return
+    finally:
+        if web_runner:
+            await web_runner.cleanup()
+        await close_api()
+        await close_db()
 
 if __name__ == "__main__":
     try:
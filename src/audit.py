@@ -0,0 +1,113 @@
+import asyncio
+import json
+import logging
+import time
+
+from aiogram import Bot
+
+from config import config
+from database import get_all_users, delete_user_profile, set_chat_member, mark_membership_checked
+from functions import check_if_user_chat_member, delete_profiles
+from metrics import AUDIT_DURATION, AUDIT_LAST_FINISHED
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+async def run_membership_audit(bot: Bot) -> dict:
+    """
+    Один проход ревизии пользователей.
+
+    Основной источник изменений членства - события chat_member (см.
+    handlers.on_chat_member_update), ревизия лишь сверяет пропущенное.
+    Членство проверяется AUDIT_CONCURRENCY воркерами с общим ограничением
+    AUDIT_RATE запросов getChatMember в секунду. Профили вышедших из чата
+    пользователей удаляются из инбаунда одной пачкой в конце прохода.
+
+    Returns:
+        dict: статистика прохода (checked, leavers, removed, failed, duration).
+    """
+    started = time.monotonic()
+    users = await get_all_users()
+    limiter = TokenBucket(config.AUDIT_RATE)
+    leavers = []
+    members, strangers = [], []
+    checked = []
+    failed = 0
+
+    pending = iter(users)
+
+    async def worker():
+        nonlocal failed
+        for user in pending:
+            user_chat_member = await check_if_user_chat_member(user.telegram_id, bot, limiter)
+            if user_chat_member is None:
+                failed += 1
+                continue
+            checked.append(user.telegram_id)
+            if user_chat_member != user.chat_member:
+                (members if user_chat_member else strangers).append(user.telegram_id)
+            # Delete profile only when we explicitly confirmed non-membership,
+            # whatever the stored flag was.
+            # None means temporary check failure and must not trigger deletion.
+            if user_chat_member is False and user.vless_profile_data:
+                leavers.append(user)
+
+    await asyncio.gather(*(worker() for _ in range(max(1, config.AUDIT_CONCURRENCY))))
+
+    # Сверяем флаг членства, пропущенный событиями chat_member
+    await set_chat_member(members, True)
+    await set_chat_member(strangers, False)
+    await mark_membership_checked(checked)
+
+    removed = await revoke_profiles(bot, leavers, limiter)
+
+    duration = time.monotonic() - started
+    AUDIT_DURATION.set(duration)
+    AUDIT_LAST_FINISHED.set(time.time())
+    stats = {
+        "checked": len(checked),
+        "leavers": len(leavers),
+        "reconciled": len(members) + len(strangers),
+        "removed": removed,
+        "failed": failed,
+        "duration": duration,
+    }
+    logger.info(
+        f"✅ Users audit finished: {len(checked)} checked in {duration:.1f}s "
+        f"({len(checked) / duration if duration else 0:.1f} users/s), "
+        f"{removed}/{len(leavers)} profiles removed, "
+        f"{len(members) + len(strangers)} flags reconciled, {failed} checks failed"
+    )
+    return stats
+
+async def revoke_profiles(bot: Bot, users: list, limiter: TokenBucket = None) -> int:
+    """Удаление VPN профилей пользователей пачкой и уведомление владельцев"""
+    profiles = []
+    for user in users:
+        try:
+            profiles.append((user, json.loads(user.vless_profile_data)))
+        except Exception as e:
+            logger.warning(f"⚠️ Broken profile data for {user.telegram_id}: {e}")
+    if not profiles:
+        return 0
+
+    results = await delete_profiles([profile for _, profile in profiles])
+
+    removed = 0
+    for (user, profile), success in zip(profiles, results):
+        if not success:
+            logger.warning(f"⚠️ Failed to delete client {profile['email']} from inbound")
+            continue
+        try:
+            # Удаляем профиль из БД
+            await delete_user_profile(user.telegram_id)
+            removed += 1
+            if limiter:
+                await limiter.acquire()
+            await bot.send_message(
+                user.telegram_id,
+                "❌ Ваш профиль VPN был удален."
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Deletion error: {e}")
+    return removed
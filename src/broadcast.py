@@ -0,0 +1,182 @@
+import asyncio
+import logging
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from config import config
+from database import (
+    create_broadcast, set_broadcast_message, get_running_broadcasts,
+    get_pending_recipients, set_recipients_status, get_broadcast_progress,
+    finish_broadcast,
+)
+from metrics import BROADCAST_MESSAGES
+from ratelimit import TokenBucket
+from storage import locks
+
+logger = logging.getLogger(__name__)
+
+# Получатели читаются из БД порциями, а результаты отправки записываются
+# каждые FLUSH_SIZE сообщений: после аварийного перезапуска повторно могут
+# уйти лишь несколько последних сообщений
+CHUNK_SIZE = 500
+FLUSH_SIZE = 20
+MAX_SEND_ATTEMPTS = 3
+BROADCAST_LEASE_TTL = 60
+
+# Общий для всех рассылок лимит Telegram на сообщения разным пользователям
+broadcast_limiter = TokenBucket(config.BROADCAST_RATE)
+
+_jobs: Dict[int, asyncio.Task] = {}
+
+class BroadcastJob:
+    """
+    Background delivery of one broadcast.
+
+    Recipients are stored in `broadcast_recipients` with their delivery
+    status, so an interrupted job resumes from the remaining `pending` rows
+    after a restart. Progress is reported by editing the admin's status
+    message.
+    """
+
+    def __init__(self, bot: Bot, broadcast_id: int, text: str,
+                 admin_chat_id: int, status_message_id: Optional[int]):
+        self.bot = bot
+        self.broadcast_id = broadcast_id
+        self.text = text
+        self.admin_chat_id = admin_chat_id
+        self.status_message_id = status_message_id
+        self._sent = []
+        self._failed = []
+
+    async def run(self):
+        progress_task = asyncio.create_task(self._report_progress())
+        try:
+            after_id = 0
+            while True:
+                chunk = await get_pending_recipients(self.broadcast_id, after_id, CHUNK_SIZE)
+                if not chunk:
+                    break
+                after_id = chunk[-1][0]
+                await self._send_chunk(chunk)
+            await self._flush()
+            await finish_broadcast(self.broadcast_id)
+        finally:
+            progress_task.cancel()
+            # Сохраняем уже отправленное даже при остановке бота
+            await asyncio.shield(self._flush())
+        await self._edit_status(finished=True)
+
+    async def _send_chunk(self, chunk):
+        recipients = iter(chunk)
+
+        async def worker():
+            for recipient_id, telegram_id in recipients:
+                if await self._send(telegram_id):
+                    self._sent.append(recipient_id)
+                else:
+                    self._failed.append(recipient_id)
+                if len(self._sent) + len(self._failed) >= FLUSH_SIZE:
+                    await self._flush()
+
+        await asyncio.gather(*(worker() for _ in range(max(1, config.BROADCAST_CONCURRENCY))))
+
+    async def _flush(self):
+        sent, self._sent = self._sent, []
+        failed, self._failed = self._failed, []
+        await set_recipients_status(sent, "sent")
+        await set_recipients_status(failed, "failed")
+
+    async def _send(self, telegram_id: int) -> bool:
+        for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+            await broadcast_limiter.acquire()
+            try:
+                await self.bot.send_message(telegram_id, self.text)
+                BROADCAST_MESSAGES.labels("sent").inc()
+                return True
+            except TelegramRetryAfter as e:
+                logger.warning(
+                    f"⚠️ Flood control during broadcast {self.broadcast_id}. "
+                    f"Pausing for {e.retry_after}s (attempt {attempt}/{MAX_SEND_ATTEMPTS})"
+                )
+                BROADCAST_MESSAGES.labels("flood_retry").inc()
+                broadcast_limiter.pause(e.retry_after + 1)
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Бот заблокирован пользователем или чат недоступен - повтор не поможет
+                logger.info(f"ℹ️  Broadcast message to {telegram_id} rejected: {e}")
+                break
+            except Exception as e:
+                logger.error(f"🛑 Ошибка отправки сообщения {telegram_id}: {e}")
+                break
+        BROADCAST_MESSAGES.labels("failed").inc()
+        return False
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(config.BROADCAST_PROGRESS_INTERVAL)
+            await self._edit_status()
+
+    async def _edit_status(self, finished: bool = False):
+        if not self.status_message_id:
+            return
+        try:
+            progress = await get_broadcast_progress(self.broadcast_id)
+            total = sum(progress.values())
+            title = "📨 Результаты рассылки:" if finished else "⏳ Идет рассылка..."
+            await self.bot.edit_message_text(
+                chat_id=self.admin_chat_id,
+                message_id=self.status_message_id,
+                text=(
+                    f"{title}\n\n"
+                    f"• Успешно: {progress['sent']}\n"
+                    f"• Не удалось: {progress['failed']}\n"
+                    f"• Осталось: {progress['pending']}\n"
+                    f"• Всего: {total}"
+                ),
+            )
+        except TelegramBadRequest as e:
+            # "message is not modified" - прогресс не изменился с прошлого раза
+            logger.debug(f"⚙️ Broadcast status not edited: {e}")
+        except Exception as e:
+            logger.warning(f"⚠️ Broadcast status update error: {e}")
+
+def _spawn(job: BroadcastJob):
+    task = _jobs.get(job.broadcast_id)
+    if task and not task.done():
+        return
+    task = asyncio.create_task(_run_job(job))
+    _jobs[job.broadcast_id] = task
+
+async def _run_job(job: BroadcastJob):
+    try:
+        # При нескольких процессах бота рассылку ведет только один
+        async with locks.lease(f"broadcast:{job.broadcast_id}", BROADCAST_LEASE_TTL) as acquired:
+            if not acquired:
+                logger.info(f"ℹ️  Broadcast {job.broadcast_id} is handled by another worker")
+                return
+            await job.run()
+        logger.info(f"✅ Broadcast {job.broadcast_id} finished")
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"🛑 Broadcast {job.broadcast_id} error: {e}")
+    finally:
+        _jobs.pop(job.broadcast_id, None)
+
+async def start_broadcast(bot: Bot, admin_chat_id: int, text: str, target: str, telegram_ids) -> int:
+    """Создание рассылки и запуск ее в фоне. Возвращает id рассылки"""
+    broadcast = await create_broadcast(admin_chat_id, text, target, telegram_ids)
+    status_message = await bot.send_message(admin_chat_id, "⏳ Рассылка запущена...")
+    await set_broadcast_message(broadcast.id, status_message.message_id)
+    _spawn(BroadcastJob(bot, broadcast.id, text, admin_chat_id, status_message.message_id))
+    return broadcast.id
+
+async def resume_broadcasts(bot: Bot):
+    """Продолжение рассылок, прерванных перезапуском бота"""
+    for broadcast in await get_running_broadcasts():
+        logger.info(f"ℹ️  Resuming broadcast {broadcast.id}")
+        _spawn(BroadcastJob(
+            bot, broadcast.id, broadcast.text,
+            broadcast.admin_chat_id, broadcast.status_message_id,
+        ))
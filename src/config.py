@@ -1,21 +1,95 @@
 import os
+import json
 from dotenv import load_dotenv
-from pydantic import BaseModel, Field, field_validator
-from typing import List
+from pydantic import BaseModel, Field, field_validator, model_validator
+from typing import List, Optional
 
 load_dotenv()
 
+class XUIServer(BaseModel):
+    """Панель 3x-ui из пула серверов и ее инбаунды для новых клиентов"""
+    name: str
+    api_url: str
+    base_path: str = "/panel"
+    username: str = "admin"
+    password: str = "admin"
+    host: str
+    inbounds: List[int]
+    # Параметры Reality; если не заданы, берутся общие REALITY_*
+    reality_public_key: Optional[str] = None
+    reality_fingerprint: Optional[str] = None
+    reality_sni: Optional[str] = None
+    reality_short_id: Optional[str] = None
+    reality_spider_x: Optional[str] = None
+
 class Config(BaseModel):
     BOT_TOKEN: str = os.getenv("BOT_TOKEN", "")
+    BOT_MODE: str = os.getenv("BOT_MODE", "polling")  # polling | webhook
+    UPDATE_CONCURRENCY: int = int(os.getenv("UPDATE_CONCURRENCY", 100))
+    WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
+    WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_MAX_CONNECTIONS: int = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 40))
+    WEB_SERVER_HOST: str = os.getenv("WEB_SERVER_HOST", "0.0.0.0")
+    WEB_SERVER_PORT: int = int(os.getenv("WEB_SERVER_PORT", 8080))
+    METRICS_ENABLED: bool = os.getenv("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+    METRICS_PATH: str = os.getenv("METRICS_PATH", "/metrics")
+    SUBSCRIPTION_BASE_URL: str = os.getenv("SUBSCRIPTION_BASE_URL", "")  # пусто - подписки отключены
+    SUBSCRIPTION_PATH: str = os.getenv("SUBSCRIPTION_PATH", "/sub")
+    SUBSCRIPTION_UPDATE_INTERVAL: int = int(os.getenv("SUBSCRIPTION_UPDATE_INTERVAL", 12))  # ч
+    TRACE_SLOW_THRESHOLD: float = float(os.getenv("TRACE_SLOW_THRESHOLD", 2))  # с, 0 - отключено
+    PROFILE_SAMPLE_RATE: float = float(os.getenv("PROFILE_SAMPLE_RATE", 0))  # доля апдейтов под cProfile
+    PROFILE_DIR: str = os.getenv("PROFILE_DIR", "/app/data/profiles")
+    PROFILE_KEEP: int = int(os.getenv("PROFILE_KEEP", 50))
     ADMINS: List[int] = Field(default_factory=list)
     CHAT_ID: int = Field(default=os.getenv("CHAT_ID"))
     XUI_API_URL: str = os.getenv("XUI_API_URL", "http://localhost:54321")
     XUI_BASE_PATH: str = os.getenv("XUI_BASE_PATH", "/panel")
     XUI_USERNAME: str = os.getenv("XUI_USERNAME", "admin")
     XUI_PASSWORD: str = os.getenv("XUI_PASSWORD", "admin")
+    XUI_POOL_SIZE: int = int(os.getenv("XUI_POOL_SIZE", 10))
+    XUI_KEEPALIVE_TIMEOUT: float = float(os.getenv("XUI_KEEPALIVE_TIMEOUT", 30))
+    XUI_TIMEOUT: float = float(os.getenv("XUI_TIMEOUT", 30))
+    XUI_MUTATION_WINDOW: float = float(os.getenv("XUI_MUTATION_WINDOW", 0.2))
+    XUI_BULK_DELETE_THRESHOLD: int = int(os.getenv("XUI_BULK_DELETE_THRESHOLD", 10))
+    XUI_SNAPSHOT_TTL: float = float(os.getenv("XUI_SNAPSHOT_TTL", 120))
     XUI_HOST: str = os.getenv("XUI_HOST", "your-server.com")
     XUI_SERVER_NAME: str = os.getenv("XUI_SERVER_NAME", "domain.com")
     INBOUND_ID: int = Field(default=os.getenv("INBOUND_ID", 1))
+    AUDIT_INTERVAL: float = float(os.getenv("AUDIT_INTERVAL", 21600))
+    AUDIT_CONCURRENCY: int = int(os.getenv("AUDIT_CONCURRENCY", 10))
+    AUDIT_RATE: float = float(os.getenv("AUDIT_RATE", 20))
+    MEMBERSHIP_CACHE_TTL: float = float(os.getenv("MEMBERSHIP_CACHE_TTL", 300))
+    MEMBERSHIP_CACHE_SIZE: int = int(os.getenv("MEMBERSHIP_CACHE_SIZE", 50000))
+    DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite+aiosqlite:////app/data/users.db")
+    DB_POOL_SIZE: int = int(os.getenv("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW: int = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    SQLITE_SYNCHRONOUS: str = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+    SQLITE_BUSY_TIMEOUT: int = int(os.getenv("SQLITE_BUSY_TIMEOUT", 5000))  # мс
+    SQLITE_MMAP_SIZE: int = int(os.getenv("SQLITE_MMAP_SIZE", 268435456))  # байт
+    SQLITE_CACHE_SIZE: int = int(os.getenv("SQLITE_CACHE_SIZE", -65536))  # < 0 - КиБ
+    USER_STORE_ENABLED: bool = os.getenv("USER_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+    BROADCAST_RATE: float = float(os.getenv("BROADCAST_RATE", 30))
+    BROADCAST_CONCURRENCY: int = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+    BROADCAST_PROGRESS_INTERVAL: float = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", 5))
+    FSM_STORAGE: str = os.getenv("FSM_STORAGE", "memory")  # memory | sqlite | redis
+    REDIS_URL: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    LOCK_BACKEND: str = os.getenv("LOCK_BACKEND", "local")  # local | sqlite
+    LOCK_WAIT: float = float(os.getenv("LOCK_WAIT", 30))
+    LOCK_POLL_INTERVAL: float = float(os.getenv("LOCK_POLL_INTERVAL", 0.2))
+    XUI_SERVERS: List[XUIServer] = Field(default_factory=list)
+    PLACEMENT_TRAFFIC_WEIGHT: float = float(os.getenv("PLACEMENT_TRAFFIC_WEIGHT", 0.5))
+    TRAFFIC_POLL_INTERVAL: float = float(os.getenv("TRAFFIC_POLL_INTERVAL", 60))
+    TRAFFIC_HISTORY_ENABLED: bool = os.getenv("TRAFFIC_HISTORY_ENABLED", "true").lower() in ("1", "true", "yes")
+    TRAFFIC_SAMPLE_RETENTION: float = float(os.getenv("TRAFFIC_SAMPLE_RETENTION", 2))  # сут
+    TRAFFIC_MINUTE_RETENTION: float = float(os.getenv("TRAFFIC_MINUTE_RETENTION", 2))  # сут
+    TRAFFIC_HOUR_RETENTION: float = float(os.getenv("TRAFFIC_HOUR_RETENTION", 60))  # сут
+    TRAFFIC_DAY_RETENTION: float = float(os.getenv("TRAFFIC_DAY_RETENTION", 730))  # сут
+    TRAFFIC_TOP_LIMIT: int = int(os.getenv("TRAFFIC_TOP_LIMIT", 10))
+    ANALYTICS_SPIKE_RATIO: float = float(os.getenv("ANALYTICS_SPIKE_RATIO", 5))  # раз к часовому пику клиента
+    ANALYTICS_SPIKE_THRESHOLD: float = float(os.getenv("ANALYTICS_SPIKE_THRESHOLD", 3.5))  # модифицированный z-score
+    ANALYTICS_MIN_RATE: float = float(os.getenv("ANALYTICS_MIN_RATE", 1048576))  # байт/с
+    PRESENTATION_REFRESH_INTERVAL: float = float(os.getenv("PRESENTATION_REFRESH_INTERVAL", 3600))
     REALITY_PUBLIC_KEY: str = os.getenv("REALITY_PUBLIC_KEY", "")
     REALITY_FINGERPRINT: str = os.getenv("REALITY_FINGERPRINT", "chrome")
     REALITY_SNI: str = os.getenv("REALITY_SNI", "example.com")
@@ -39,9 +113,43 @@ class Config(BaseModel):
         if isinstance(value, str):
             return int(value)
         return value or 1
-    
+
+    @field_validator('XUI_SERVERS', mode='before')
+    def parse_xui_servers(cls, value):
+        if isinstance(value, str):
+            return json.loads(value) if value.strip() else []
+        return value or []
+
+    @model_validator(mode='after')
+    def fill_xui_servers(self):
+        # Без XUI_SERVERS пул состоит из одной панели из настроек XUI_*
+        if not self.XUI_SERVERS:
+            self.XUI_SERVERS = [XUIServer(
+                name="default",
+                api_url=self.XUI_API_URL,
+                base_path=self.XUI_BASE_PATH,
+                username=self.XUI_USERNAME,
+                password=self.XUI_PASSWORD,
+                host=self.XUI_HOST,
+                inbounds=[self.INBOUND_ID],
+            )]
+        for server in self.XUI_SERVERS:
+            server.reality_public_key = server.reality_public_key or self.REALITY_PUBLIC_KEY
+            server.reality_fingerprint = server.reality_fingerprint or self.REALITY_FINGERPRINT
+            server.reality_sni = server.reality_sni or self.REALITY_SNI
+            server.reality_short_id = server.reality_short_id or self.REALITY_SHORT_ID
+            server.reality_spider_x = server.reality_spider_x or self.REALITY_SPIDER_X
+        return self
+
+    def get_server(self, name: Optional[str] = None) -> Optional[XUIServer]:
+        """Сервер пула по имени; без имени - первый (основной) сервер"""
+        if name is None:
+            return self.XUI_SERVERS[0]
+        return next((server for server in self.XUI_SERVERS if server.name == name), None)
+
 config = Config(
     ADMINS=os.getenv("ADMINS", ""),
     CHAT_ID=os.getenv("CHAT_ID"),
     INBOUND_ID=os.getenv("INBOUND_ID", 1),
+    XUI_SERVERS=os.getenv("XUI_SERVERS", ""),
 )
\ No newline at end of file
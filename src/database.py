@@ -1,7 +1,17 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, func
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import (
+    Column, Integer, String, DateTime, Boolean, Float, ForeignKey, Index, Text,
+    func, select, update, delete, insert, event, inspect, text, case, or_,
+)
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base
 from datetime import datetime
+from typing import Dict, List, Optional
 import logging
+import time
+
+from config import config
 
 logger = logging.getLogger(__name__)
 
@@ -16,31 +26,268 @@ class User(Base):
     registration_date = Column(DateTime, default=datetime.utcnow)
     vless_profile_id = Column(String)
     vless_profile_data = Column(String)
-    chat_member = Column(Boolean, default=False)
-    is_admin = Column(Boolean, default=False)
+    chat_member = Column(Boolean, default=False, index=True)
+    is_admin = Column(Boolean, default=False, index=True)
+    membership_checked_at = Column(DateTime)  # последняя проверка членства через Telegram
+    sub_id = Column(String, unique=True, index=True)  # ключ ссылки подписки /sub/{sub_id}
+    # Постраничный вывод списков участников и изгоев по курсору telegram_id
+    __table_args__ = (Index('ix_users_chat_member_telegram_id', 'chat_member', 'telegram_id'),)
 
 class StaticProfile(Base):
     __tablename__ = 'static_profiles'
     id = Column(Integer, primary_key=True)
-    name = Column(String)
+    name = Column(String, index=True)
     vless_url = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-engine = create_engine('sqlite:////app/data/users.db', echo=False)
-Session = sessionmaker(bind=engine)
+# Профиль настроек SQLite: WAL позволяет читать параллельно с записью,
+# synchronous=NORMAL в режиме WAL безопасен и не делает fsync на каждый коммит
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": config.SQLITE_SYNCHRONOUS,
+    "busy_timeout": config.SQLITE_BUSY_TIMEOUT,
+    "mmap_size": config.SQLITE_MMAP_SIZE,
+    "cache_size": config.SQLITE_CACHE_SIZE,
+    "temp_store": "MEMORY",
+    "foreign_keys": "ON",
+}
+
+def _create_engine():
+    url = make_url(config.DATABASE_URL)
+    options = {"echo": False}
+    if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+        options.update(pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW)
+    return create_async_engine(url, **options)
+
+class Broadcast(Base):
+    __tablename__ = 'broadcasts'
+    id = Column(Integer, primary_key=True)
+    admin_chat_id = Column(Integer)
+    status_message_id = Column(Integer)
+    text = Column(Text)
+    target = Column(String)
+    status = Column(String, default="running", index=True)  # running | done | cancelled
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+
+class BroadcastRecipient(Base):
+    __tablename__ = 'broadcast_recipients'
+    id = Column(Integer, primary_key=True)
+    broadcast_id = Column(Integer, ForeignKey('broadcasts.id', ondelete="CASCADE"))
+    telegram_id = Column(Integer)
+    status = Column(String, default="pending")  # pending | sent | failed
+    __table_args__ = (Index('ix_broadcast_recipients_progress', 'broadcast_id', 'status', 'id'),)
+
+class FSMRecord(Base):
+    __tablename__ = 'fsm_states'
+    key = Column(String, primary_key=True)
+    state = Column(String)
+    data = Column(Text)
+
+class Lease(Base):
+    __tablename__ = 'leases'
+    name = Column(String, primary_key=True)
+    owner = Column(String)
+    expires_at = Column(Float)
+
+# История трафика хранится без rowid: строки лежат прямо в B-дереве
+# первичного ключа, без отдельной копии ключевых колонок
+class TrafficSample(Base):
+    """Прирост трафика клиента между двумя опросами панели"""
+    __tablename__ = 'traffic_samples'
+    ts = Column(Integer, primary_key=True)  # unix time опроса
+    email = Column(String, primary_key=True)
+    up = Column(Integer, nullable=False, default=0)
+    down = Column(Integer, nullable=False, default=0)
+    __table_args__ = {'sqlite_with_rowid': False}
+
+class TrafficRollup(Base):
+    """Трафик клиента за минуту, час или сутки (UTC)"""
+    __tablename__ = 'traffic_rollups'
+    resolution = Column(Integer, primary_key=True)  # длина интервала, с: 60 | 3600 | 86400
+    bucket = Column(Integer, primary_key=True)  # начало интервала, unix time
+    email = Column(String, primary_key=True)
+    up = Column(Integer, nullable=False, default=0)
+    down = Column(Integer, nullable=False, default=0)
+    __table_args__ = (
+        Index('ix_traffic_rollups_email', 'email', 'resolution', 'bucket'),
+        {'sqlite_with_rowid': False},
+    )
+
+class TrafficCounter(Base):
+    """Последние учтенные счетчики клиента в панели - база для приростов"""
+    __tablename__ = 'traffic_counters'
+    email = Column(String, primary_key=True)
+    up = Column(Integer, nullable=False, default=0)
+    down = Column(Integer, nullable=False, default=0)
+    __table_args__ = {'sqlite_with_rowid': False}
+
+engine = _create_engine()
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+@event.listens_for(engine.sync_engine, "connect")
+def _apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if engine.dialect.name != "sqlite":
+        return
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+def _migrate(connection):
+    """
+    Легкая миграция существующей базы: create_all не трогает уже
+    созданные таблицы, поэтому недостающие колонки и индексы создаем отдельно.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(connection.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+                logger.info(f"⚙️ Column {table.name}.{column.name} added")
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
 
 async def init_db():
-    Base.metadata.create_all(engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_migrate)
     logger.info("✅ Database tables created")
 
+async def close_db():
+    await engine.dispose()
+
+class UserRecord:
+    """Строка таблицы users в памяти"""
+    __slots__ = (
+        "id", "telegram_id", "full_name", "username", "registration_date",
+        "vless_profile_id", "vless_profile_data", "chat_member", "is_admin",
+        "membership_checked_at", "sub_id",
+    )
+
+    def __init__(self, id: int, telegram_id: int, full_name: Optional[str] = None,
+                 username: Optional[str] = None, registration_date: Optional[datetime] = None,
+                 vless_profile_id: Optional[str] = None, vless_profile_data: Optional[str] = None,
+                 chat_member: bool = False, is_admin: bool = False,
+                 membership_checked_at: Optional[datetime] = None, sub_id: Optional[str] = None):
+        self.id = id
+        self.telegram_id = telegram_id
+        self.full_name = full_name
+        self.username = username
+        self.registration_date = registration_date
+        self.vless_profile_id = vless_profile_id
+        self.vless_profile_data = vless_profile_data
+        self.chat_member = bool(chat_member)
+        self.is_admin = bool(is_admin)
+        self.membership_checked_at = membership_checked_at
+        self.sub_id = sub_id
+
+    @classmethod
+    def from_model(cls, user: User) -> "UserRecord":
+        return cls(**{field: getattr(user, field) for field in cls.__slots__})
+
+    def __repr__(self) -> str:
+        return f"UserRecord(telegram_id={self.telegram_id}, chat_member={self.chat_member})"
+
+class UserStore:
+    """
+    In-memory copy of the users table.
+
+    Loaded once at startup; the repository functions below write to SQLite
+    first and then apply the same change here, so reads never touch the
+    database. Records are indexed by telegram_id and by chat_member, which
+    makes lookups and the member counts O(1). Users with a subscription
+    are also indexed by sub_id. Records are shared between
+    callers and must only be changed through the repository functions.
+
+    Every process keeps its own copy, so the store is only consistent
+    while a single bot process writes to the database (USER_STORE_ENABLED).
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._by_telegram_id: Dict[int, UserRecord] = {}
+        self._by_chat_member: Dict[bool, Dict[int, UserRecord]] = {True: {}, False: {}}
+        self._by_sub_id: Dict[str, UserRecord] = {}
+
+    def load(self, records: List[UserRecord]):
+        self._by_telegram_id.clear()
+        self._by_sub_id.clear()
+        for index in self._by_chat_member.values():
+            index.clear()
+        for record in records:
+            self.put(record)
+        self.loaded = True
+
+    def get(self, telegram_id: int) -> Optional[UserRecord]:
+        return self._by_telegram_id.get(telegram_id)
+
+    def get_by_sub_id(self, sub_id: str) -> Optional[UserRecord]:
+        return self._by_sub_id.get(sub_id)
+
+    def put(self, record: UserRecord):
+        previous = self._by_telegram_id.get(record.telegram_id)
+        if previous is not None:
+            self._by_chat_member[bool(previous.chat_member)].pop(record.telegram_id, None)
+            if previous.sub_id:
+                self._by_sub_id.pop(previous.sub_id, None)
+        self._by_telegram_id[record.telegram_id] = record
+        self._by_chat_member[bool(record.chat_member)][record.telegram_id] = record
+        if record.sub_id:
+            self._by_sub_id[record.sub_id] = record
+
+    def update(self, telegram_id: int, **fields):
+        record = self._by_telegram_id.get(telegram_id)
+        if record is None:
+            return
+        if "chat_member" in fields and bool(fields["chat_member"]) != bool(record.chat_member):
+            self._by_chat_member[bool(record.chat_member)].pop(telegram_id, None)
+            self._by_chat_member[bool(fields["chat_member"])][telegram_id] = record
+        if "sub_id" in fields and fields["sub_id"] != record.sub_id:
+            if record.sub_id:
+                self._by_sub_id.pop(record.sub_id, None)
+            if fields["sub_id"]:
+                self._by_sub_id[fields["sub_id"]] = record
+        for field, value in fields.items():
+            setattr(record, field, bool(value) if field in ("chat_member", "is_admin") else value)
+
+    def all(self, chat_member: Optional[bool] = None) -> List[UserRecord]:
+        if chat_member is None:
+            return list(self._by_telegram_id.values())
+        return list(self._by_chat_member[chat_member].values())
+
+    def counts(self):
+        """Всего пользователей, участников чата и изгоев"""
+        return (
+            len(self._by_telegram_id),
+            len(self._by_chat_member[True]),
+            len(self._by_chat_member[False]),
+        )
+
+user_store = UserStore()
+
+async def load_user_store():
+    """Загрузка всех пользователей в память (при USER_STORE_ENABLED)"""
+    if not config.USER_STORE_ENABLED:
+        return
+    async with Session() as session:
+        result = await session.execute(select(User).order_by(User.id))
+        user_store.load([UserRecord.from_model(user) for user in result.scalars()])
+    logger.info(f"✅ User store loaded: {user_store.counts()[0]} users")
+
 async def get_user(telegram_id: int):
-    with Session() as session:
-        return session.query(User).filter_by(telegram_id=telegram_id).first()
+    if user_store.loaded:
+        return user_store.get(telegram_id)
+    async with Session() as session:
+        result = await session.execute(select(User).filter_by(telegram_id=telegram_id))
+        return result.scalars().first()
 
 async def create_user(telegram_id: int, full_name: str, username: str = None,
                       chat_member: bool = False,
                       is_admin: bool = False):
-    with Session() as session:
+    async with Session() as session:
         user = User(
             telegram_id=telegram_id,
             full_name=full_name,
@@ -49,43 +296,447 @@ async def create_user(telegram_id: int, full_name: str, username: str = None,
             is_admin=is_admin,
         )
         session.add(user)
-        session.commit()
+        await session.commit()
         logger.info(f"✅ New user created: {telegram_id}")
+        if user_store.loaded:
+            user = UserRecord.from_model(user)
+            user_store.put(user)
         return user
 
+async def update_user(telegram_id: int, **fields):
+    """Обновление полей пользователя"""
+    async with Session() as session:
+        await session.execute(update(User).where(User.telegram_id == telegram_id).values(**fields))
+        await session.commit()
+    if user_store.loaded:
+        user_store.update(telegram_id, **fields)
+
+async def get_user_by_sub_id(sub_id: str):
+    if user_store.loaded:
+        return user_store.get_by_sub_id(sub_id)
+    async with Session() as session:
+        result = await session.execute(select(User).filter_by(sub_id=sub_id))
+        return result.scalars().first()
+
+async def set_user_profile(telegram_id: int, vless_profile_data: str, sub_id: Optional[str] = None):
+    await update_user(telegram_id, vless_profile_data=vless_profile_data, sub_id=sub_id)
+    logger.info(f"✅ User profile saved: {telegram_id}")
+
 async def delete_user_profile(telegram_id: int):
-    with Session() as session:
-        user = session.query(User).filter_by(telegram_id=telegram_id).first()
-        if user:
-            user.vless_profile_data = None
-            session.commit()
-            logger.info(f"✅ User profile deleted: {telegram_id}")
+    async with Session() as session:
+        result = await session.execute(
+            update(User)
+            .where(User.telegram_id == telegram_id, User.vless_profile_data.isnot(None))
+            .values(vless_profile_data=None, sub_id=None)
+        )
+        await session.commit()
+    if user_store.loaded:
+        user_store.update(telegram_id, vless_profile_data=None, sub_id=None)
+    if result.rowcount:
+        logger.info(f"✅ User profile deleted: {telegram_id}")
+
+# Ограничение SQLite на число параметров запроса: длинные списки id
+# обновляются порциями
+IN_CHUNK_SIZE = 500
+
+async def set_chat_member(telegram_ids, chat_member: bool) -> int:
+    """Массовое обновление флага членства в чате"""
+    telegram_ids = list(telegram_ids)
+    if not telegram_ids:
+        return 0
+    updated = 0
+    async with Session() as session:
+        for start in range(0, len(telegram_ids), IN_CHUNK_SIZE):
+            result = await session.execute(
+                update(User)
+                .where(
+                    User.telegram_id.in_(telegram_ids[start:start + IN_CHUNK_SIZE]),
+                    User.chat_member.isnot(chat_member),
+                )
+                .values(chat_member=chat_member)
+            )
+            updated += result.rowcount
+        await session.commit()
+    if user_store.loaded:
+        for telegram_id in telegram_ids:
+            user_store.update(telegram_id, chat_member=chat_member)
+    return updated
+
+async def mark_membership_checked(telegram_ids, checked_at: Optional[datetime] = None):
+    """Отметка времени проверки членства для пачки пользователей"""
+    telegram_ids = list(telegram_ids)
+    checked_at = checked_at or datetime.utcnow()
+    async with Session() as session:
+        for start in range(0, len(telegram_ids), IN_CHUNK_SIZE):
+            await session.execute(
+                update(User)
+                .where(User.telegram_id.in_(telegram_ids[start:start + IN_CHUNK_SIZE]))
+                .values(membership_checked_at=checked_at)
+            )
+        await session.commit()
+    if user_store.loaded:
+        for telegram_id in telegram_ids:
+            user_store.update(telegram_id, membership_checked_at=checked_at)
+
+async def sync_admins(admin_ids):
+    """Выставляет флаг администратора ровно пользователям из admin_ids"""
+    async with Session() as session:
+        # Сбрасываем статус администратора у всех пользователей
+        await session.execute(update(User).values(is_admin=False))
+        
+        for admin_id in admin_ids:
+            result = await session.execute(select(User).filter_by(telegram_id=admin_id))
+            user = result.scalars().first()
+            if user:
+                user.is_admin = True
+            else:
+                # Если администратора нет в базе, создаем запись
+                session.add(User(
+                    telegram_id=admin_id,
+                    full_name=f"Admin {admin_id}",
+                    is_admin=True
+                ))
+        
+        await session.commit()
+    # Затрагивает всех пользователей и создает записи, проще перечитать
+    if user_store.loaded:
+        await load_user_store()
 
 async def get_all_users(chat_member: bool = None):
-    with Session() as session:
-        query = session.query(User)
+    if user_store.loaded:
+        return user_store.all(chat_member)
+    async with Session() as session:
+        query = select(User)
         if chat_member is not None:
             if chat_member:
                 query = query.filter(User.chat_member.is_(True))
             else:
                 query = query.filter(User.chat_member.is_(False))
-        return query.all()
+        result = await session.execute(query)
+        return result.scalars().all()
+
+async def get_users_page(chat_member: bool, after_id: int = 0, before_id: int = 0,
+                         limit: int = 20, search: Optional[str] = None):
+    """
+    Страница пользователей по курсору telegram_id (keyset pagination).
+
+    after_id - страница сразу после курсора, before_id - сразу перед ним.
+    Читается не больше limit + 1 строк независимо от числа пользователей.
+
+    Returns:
+        tuple: строки (telegram_id, full_name, username, membership_checked_at)
+        по возрастанию telegram_id и признак того, что в направлении запроса
+        есть еще строки.
+    """
+    query = (
+        select(User.telegram_id, User.full_name, User.username, User.membership_checked_at)
+        .where(User.chat_member.is_(chat_member))
+    )
+    if search:
+        # _ и % в запросе (частые в username) ищутся буквально
+        pattern = "%" + search.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+        condition = (
+            User.full_name.ilike(pattern, escape="\\")
+            | User.username.ilike(pattern, escape="\\")
+        )
+        if search.isdigit():
+            condition = condition | (User.telegram_id == int(search))
+        query = query.where(condition)
+    if before_id:
+        query = query.where(User.telegram_id < before_id).order_by(User.telegram_id.desc())
+    else:
+        query = query.where(User.telegram_id > after_id).order_by(User.telegram_id)
+
+    async with Session() as session:
+        rows = (await session.execute(query.limit(limit + 1))).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before_id:
+        rows.reverse()
+    return rows, has_more
 
 async def create_static_profile(name: str, vless_url: str):
-    with Session() as session:
+    async with Session() as session:
         profile = StaticProfile(name=name, vless_url=vless_url)
         session.add(profile)
-        session.commit()
+        await session.commit()
         logger.info(f"✅ Static profile created: {name}")
         return profile
 
 async def get_static_profiles():
-    with Session() as session:
-        return session.query(StaticProfile).all()
+    async with Session() as session:
+        result = await session.execute(select(StaticProfile))
+        return result.scalars().all()
+
+async def get_static_profile(profile_id: int):
+    async with Session() as session:
+        return await session.get(StaticProfile, profile_id)
+
+async def delete_static_profile(profile_id: int):
+    async with Session() as session:
+        await session.execute(delete(StaticProfile).where(StaticProfile.id == profile_id))
+        await session.commit()
+        logger.info(f"✅ Static profile deleted: {profile_id}")
 
 async def get_user_stats():
-    with Session() as session:
-        total = session.query(func.count(User.id)).scalar()
-        chat_members = session.query(func.count(User.id)).filter(User.chat_member).scalar()
+    if user_store.loaded:
+        return user_store.counts()
+    async with Session() as session:
+        total = await session.scalar(select(func.count(User.id)))
+        chat_members = await session.scalar(select(func.count(User.id)).filter(User.chat_member))
         strangers = total - chat_members
-        return total, chat_members, strangers 
+        return total, chat_members, strangers
+
+async def create_broadcast(admin_chat_id: int, text: str, target: str, telegram_ids) -> Broadcast:
+    """Создание рассылки вместе со списком получателей"""
+    async with Session() as session:
+        broadcast = Broadcast(admin_chat_id=admin_chat_id, text=text, target=target)
+        session.add(broadcast)
+        await session.flush()
+        recipients = [{"broadcast_id": broadcast.id, "telegram_id": telegram_id} for telegram_id in telegram_ids]
+        if recipients:
+            await session.execute(insert(BroadcastRecipient), recipients)
+        await session.commit()
+        logger.info(f"✅ Broadcast {broadcast.id} created for {len(recipients)} recipients")
+        return broadcast
+
+async def set_broadcast_message(broadcast_id: int, message_id: int):
+    async with Session() as session:
+        await session.execute(
+            update(Broadcast).where(Broadcast.id == broadcast_id).values(status_message_id=message_id)
+        )
+        await session.commit()
+
+async def get_running_broadcasts():
+    async with Session() as session:
+        result = await session.execute(select(Broadcast).filter_by(status="running"))
+        return result.scalars().all()
+
+async def get_pending_recipients(broadcast_id: int, after_id: int = 0, limit: int = 500):
+    """Следующая порция неотправленных получателей: список пар (id, telegram_id)"""
+    async with Session() as session:
+        result = await session.execute(
+            select(BroadcastRecipient.id, BroadcastRecipient.telegram_id)
+            .where(
+                BroadcastRecipient.broadcast_id == broadcast_id,
+                BroadcastRecipient.status == "pending",
+                BroadcastRecipient.id > after_id,
+            )
+            .order_by(BroadcastRecipient.id)
+            .limit(limit)
+        )
+        return result.all()
+
+async def set_recipients_status(recipient_ids, status: str):
+    recipient_ids = list(recipient_ids)
+    if not recipient_ids:
+        return
+    async with Session() as session:
+        await session.execute(
+            update(BroadcastRecipient).where(BroadcastRecipient.id.in_(recipient_ids)).values(status=status)
+        )
+        await session.commit()
+
+async def get_broadcast_progress(broadcast_id: int) -> dict:
+    """Количество получателей рассылки по статусам"""
+    async with Session() as session:
+        result = await session.execute(
+            select(BroadcastRecipient.status, func.count(BroadcastRecipient.id))
+            .where(BroadcastRecipient.broadcast_id == broadcast_id)
+            .group_by(BroadcastRecipient.status)
+        )
+        progress = {"pending": 0, "sent": 0, "failed": 0}
+        progress.update(dict(result.all()))
+        return progress
+
+async def finish_broadcast(broadcast_id: int, status: str = "done"):
+    async with Session() as session:
+        await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id)
+            .values(status=status, finished_at=datetime.utcnow())
+        )
+        await session.commit()
+
+async def get_fsm_record(key: str):
+    async with Session() as session:
+        return await session.get(FSMRecord, key)
+
+async def save_fsm_record(key: str, **fields):
+    """Сохранение состояния или данных FSM (upsert по ключу)"""
+    async with Session() as session:
+        await session.execute(
+            sqlite_insert(FSMRecord)
+            .values(key=key, **fields)
+            .on_conflict_do_update(index_elements=[FSMRecord.key], set_=fields)
+        )
+        await session.commit()
+
+async def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    """
+    Захват или продление аренды блокировки.
+
+    Аренда переходит к новому владельцу только после истечения срока
+    действия текущей, поэтому упавший процесс не держит блокировку вечно.
+    """
+    now = time.time()
+    async with Session() as session:
+        await session.execute(
+            sqlite_insert(Lease)
+            .values(name=name, owner=owner, expires_at=now + ttl)
+            .on_conflict_do_update(
+                index_elements=[Lease.name],
+                set_={"owner": owner, "expires_at": now + ttl},
+                where=(Lease.expires_at < now) | (Lease.owner == owner),
+            )
+        )
+        await session.commit()
+        return await session.scalar(select(Lease.owner).filter_by(name=name)) == owner
+
+async def release_lease(name: str, owner: str):
+    async with Session() as session:
+        await session.execute(delete(Lease).where(Lease.name == name, Lease.owner == owner))
+        await session.commit()
+
+async def get_traffic_counters() -> Dict[str, tuple]:
+    """Последние учтенные счетчики клиентов: email -> (up, down)"""
+    async with Session() as session:
+        result = await session.execute(select(TrafficCounter.email, TrafficCounter.up, TrafficCounter.down))
+        return {email: (up, down) for email, up, down in result}
+
+async def add_traffic_samples(ts: int, deltas: Dict[str, tuple], resolutions=(60, 3600, 86400),
+                              counters: Optional[Dict[str, tuple]] = None):
+    """
+    Запись приростов трафика одного опроса и добавление их в агрегаты.
+
+    Args:
+        ts: unix time опроса.
+        deltas: email -> (up, down), только ненулевые приросты.
+        resolutions: длины интервалов агрегатов в секундах.
+        counters: email -> (up, down), счетчики панели, от которых
+            посчитаны приросты; сохраняются в той же транзакции.
+    """
+    if not deltas:
+        return
+    samples = [{"ts": ts, "email": email, "up": up, "down": down} for email, (up, down) in deltas.items()]
+    # Два опроса в одну секунду попадают в одну строку приростов
+    sample = sqlite_insert(TrafficSample)
+    sample = sample.on_conflict_do_update(
+        index_elements=[TrafficSample.ts, TrafficSample.email],
+        set_={"up": TrafficSample.up + sample.excluded.up, "down": TrafficSample.down + sample.excluded.down},
+    )
+    rollup = sqlite_insert(TrafficRollup)
+    rollup = rollup.on_conflict_do_update(
+        index_elements=[TrafficRollup.resolution, TrafficRollup.bucket, TrafficRollup.email],
+        set_={"up": TrafficRollup.up + rollup.excluded.up, "down": TrafficRollup.down + rollup.excluded.down},
+    )
+    async with Session() as session:
+        await session.execute(sample, samples)
+        for resolution in resolutions:
+            bucket = ts - ts % resolution
+            await session.execute(rollup, [
+                {"resolution": resolution, "bucket": bucket, "email": sample["email"],
+                 "up": sample["up"], "down": sample["down"]}
+                for sample in samples
+            ])
+        if counters:
+            await _upsert_traffic_counters(session, counters)
+        await session.commit()
+
+async def _upsert_traffic_counters(session, counters: Dict[str, tuple]):
+    counter = sqlite_insert(TrafficCounter)
+    counter = counter.on_conflict_do_update(
+        index_elements=[TrafficCounter.email],
+        set_={"up": counter.excluded.up, "down": counter.excluded.down},
+    )
+    await session.execute(counter, [
+        {"email": email, "up": up, "down": down} for email, (up, down) in counters.items()
+    ])
+
+async def save_traffic_counters(counters: Dict[str, tuple]):
+    """Сохранение счетчиков клиентов без приростов (начальная база истории)"""
+    if not counters:
+        return
+    async with Session() as session:
+        await _upsert_traffic_counters(session, counters)
+        await session.commit()
+
+async def get_traffic_totals(periods, email: Optional[str] = None) -> List[tuple]:
+    """
+    Суммы (up, down) по агрегатам за несколько периодов одним запросом.
+
+    Args:
+        periods: пары (длина интервала агрегата, начало первого интервала).
+        email: клиент; без него - трафик всех клиентов.
+    """
+    conditions = [
+        (TrafficRollup.resolution == resolution) & (TrafficRollup.bucket >= since)
+        for resolution, since in periods
+    ]
+    columns = []
+    for condition in conditions:
+        columns.append(func.coalesce(func.sum(case((condition, TrafficRollup.up), else_=0)), 0))
+        columns.append(func.coalesce(func.sum(case((condition, TrafficRollup.down), else_=0)), 0))
+    query = select(*columns).where(or_(*conditions))
+    if email is not None:
+        query = query.where(TrafficRollup.email == email)
+    async with Session() as session:
+        row = (await session.execute(query)).one()
+    return [(row[i], row[i + 1]) for i in range(0, len(row), 2)]
+
+async def get_top_traffic(resolution: int, since: int, limit: int = 10):
+    """Клиенты с наибольшим трафиком: строки (email, up, down)"""
+    total = func.sum(TrafficRollup.up + TrafficRollup.down)
+    async with Session() as session:
+        result = await session.execute(
+            select(TrafficRollup.email, func.sum(TrafficRollup.up), func.sum(TrafficRollup.down))
+            .where(TrafficRollup.resolution == resolution, TrafficRollup.bucket >= since)
+            .group_by(TrafficRollup.email)
+            .order_by(total.desc())
+            .limit(limit)
+        )
+        return result.all()
+
+async def get_peak_traffic(resolution: int, since: int, until: int) -> Dict[str, int]:
+    """Наибольший трафик (up + down) каждого клиента в одном агрегате интервала [since, until)"""
+    async with Session() as session:
+        result = await session.execute(
+            select(TrafficRollup.email, func.max(TrafficRollup.up + TrafficRollup.down))
+            .where(
+                TrafficRollup.resolution == resolution,
+                TrafficRollup.bucket >= since,
+                TrafficRollup.bucket < until,
+            )
+            .group_by(TrafficRollup.email)
+        )
+        return dict(result.all())
+
+async def compact_traffic_history(samples_before: int, rollups_before: Dict[int, int]) -> int:
+    """
+    Удаление истории старше срока хранения.
+
+    Args:
+        samples_before: unix time, раньше которого удаляются приросты.
+        rollups_before: длина интервала -> unix time, раньше которого
+            удаляются агрегаты этой длины.
+
+    Returns:
+        int: число удаленных строк.
+    """
+    async with Session() as session:
+        result = await session.execute(delete(TrafficSample).where(TrafficSample.ts < samples_before))
+        removed = result.rowcount
+        for resolution, before in rollups_before.items():
+            result = await session.execute(
+                delete(TrafficRollup)
+                .where(TrafficRollup.resolution == resolution, TrafficRollup.bucket < before)
+            )
+            removed += result.rowcount
+        await session.commit()
+        # Без статистики планировщик для трафика одного клиента выбирает
+        # первичный ключ и читает агрегаты всех клиентов за период.
+        # analysis_limit ограничивает ANALYZE выборкой строк из каждого индекса
+        if engine.dialect.name == "sqlite":
+            await session.execute(text("PRAGMA analysis_limit=1000"))
+            await session.execute(text("ANALYZE traffic_rollups"))
+        return removed
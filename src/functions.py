@@ -3,8 +3,12 @@ import uuid
 import json
 import logging
 import random
+import secrets
 import asyncio
-from typing import Optional
+import contextvars
+import time
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Dict, List, Optional
 
 from aiogram import Bot
 from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
@@ -12,496 +16,865 @@ from aiogram.types import Chat
 
 from aiohttp.client_exceptions import ContentTypeError
 
-from config import config
+from cache import TTLCache
+from config import config, XUIServer
+from metrics import MEMBERSHIP_FLOOD_RETRIES, XUI_LOGINS, observe_xui
+from ratelimit import TokenBucket
+from storage import locks
+from tracing import trace
 
 logger = logging.getLogger(__name__)
 
+INBOUND_LEASE_TTL = 60
+
+class PanelEndpointMissing(Exception):
+    """Панель не поддерживает запрошенный эндпоинт (старая версия 3x-ui)"""
+
+@dataclass
+class ClientMutation:
+    """Одно изменение клиента инбаунда, ожидающее записи в панель"""
+    op: str  # "add" | "update" | "delete"
+    email: str
+    client: Optional[dict] = None
+    client_id: Optional[str] = None
+    result: Optional[bool] = None
+    future: Optional[asyncio.Future] = field(default=None, repr=False)
+
+@dataclass
+class InboundSnapshot:
+    """
+    Разобранные данные инбаунда для чтения без запроса к панели.
+
+    inbound - поля инбаунда без settings и clientStats, settings - настройки
+    без списка клиентов, clients - клиенты по email.
+    """
+    inbound: dict
+    settings: dict
+    clients: Dict[str, dict]
+    raw_settings: str = field(repr=False)
+    fetched_at: float
+    version: int = 1
+
+    @property
+    def port(self) -> int:
+        return self.inbound["port"]
+
+    @property
+    def remark(self) -> str:
+        return self.inbound["remark"]
+
+class InboundMutationQueue:
+    """
+    Single writer for client mutations of one inbound.
+
+    Mutations submitted within `window` seconds of each other are applied
+    together in one batch, so concurrent read-modify-write cycles can no
+    longer overwrite each other's clients. Each caller gets its own result.
+    """
+
+    def __init__(self, apply: Callable[[List[ClientMutation]], Awaitable[None]], window: float):
+        self._apply = apply
+        self._window = window
+        self._pending: List[ClientMutation] = []
+        self._wakeup = asyncio.Event()
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, mutation: ClientMutation) -> bool:
+        return (await self.submit_many([mutation]))[0]
+
+    async def submit_many(self, mutations: List[ClientMutation]) -> List[bool]:
+        """Поставить несколько изменений в очередь так, чтобы они попали в одну пачку"""
+        loop = asyncio.get_running_loop()
+        for mutation in mutations:
+            mutation.future = loop.create_future()
+        self._pending.extend(mutations)
+        if self._worker is None or self._worker.done():
+            # Воркер общий для всех вызывающих и не должен наследовать
+            # контекст (трассировку) апдейта, который его запустил
+            self._worker = asyncio.create_task(self._run(), context=contextvars.Context())
+        self._wakeup.set()
+        return list(await asyncio.shield(asyncio.gather(*(m.future for m in mutations))))
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Даем время собраться соседним изменениям
+            await asyncio.sleep(self._window)
+            self._wakeup.clear()
+            batch, self._pending = self._pending, []
+            if not batch:
+                continue
+            try:
+                await self._apply(batch)
+            except asyncio.CancelledError:
+                # Пачка могла примениться частично: результат неизвестен
+                self._cancel(batch)
+                raise
+            except Exception as e:
+                logger.exception(f"🛑 Inbound mutation batch error: {e}")
+            for mutation in batch:
+                if not mutation.future.done():
+                    mutation.future.set_result(bool(mutation.result))
+
+    @staticmethod
+    def _cancel(mutations: List[ClientMutation]):
+        for mutation in mutations:
+            if not mutation.future.done():
+                mutation.future.cancel()
+
+    async def close(self):
+        """Остановка воркера; ожидающие apply() получают CancelledError"""
+        if self._worker:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+        self._cancel(self._pending)
+        self._pending = []
+
 class XUIAPI:
-    def __init__(self):
-        self.session = None
+    def __init__(self, server: XUIServer):
+        self.server = server
+        self.session: Optional[aiohttp.ClientSession] = None
         self.cookie_jar = aiohttp.CookieJar(unsafe=True)  # Разрешаем небезопасные куки
-        self.auth_cookies = None
+        self._login_task: Optional[asyncio.Future] = None
+        self._login_generation = 0
+        self._logged_in = False
+        # None - еще не проверяли, поддерживает ли панель addClient/delClient/updateClient
+        self._client_api_supported: Optional[bool] = None
+        self._mutation_queues: Dict[int, InboundMutationQueue] = {}
+        self._snapshots: Dict[int, InboundSnapshot] = {}
+        self._snapshot_tasks: Dict[int, asyncio.Future] = {}
 
-    async def login(self):
-        """Аутентификация в 3x-UI API"""
-        try:
-            # Создаем новую сессию с общей куки-банкой
+    @property
+    def base_url(self) -> str:
+        """URL панели с учетом базового пути"""
+        base_url = self.server.api_url.rstrip('/')
+        base_path = self.server.base_path.strip('/')
+        if base_path:
+            base_url = f"{base_url}/{base_path}"
+        return base_url
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Долгоживущая сессия с пулом соединений и общей куки-банкой"""
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=config.XUI_POOL_SIZE,
+                keepalive_timeout=config.XUI_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
+            )
             self.session = aiohttp.ClientSession(
+                connector=connector,
                 cookie_jar=self.cookie_jar,
+                timeout=aiohttp.ClientTimeout(total=config.XUI_TIMEOUT),
                 trust_env=True  # Доверять переменным окружения для прокси
             )
-            
+        return self.session
+
+    @observe_xui
+    async def login(self) -> bool:
+        """Аутентификация в 3x-UI API"""
+        try:
             auth_data = {
-                "username": config.XUI_USERNAME,
-                "password": config.XUI_PASSWORD
+                "username": self.server.username,
+                "password": self.server.password
             }
+            login_url = f"{self.base_url}/login"
             
-            # Формируем URL с учетом базового пути
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            login_url = f"{base_url}/login"
-            
-            logger.info(f"ℹ️  Trying login to {login_url} with user: {config.XUI_USERNAME}")
+            logger.info(f"ℹ️  Trying login to {login_url} with user: {self.server.username}")
             
-            async with self.session.post(login_url, data=auth_data) as resp:
+            async with self._get_session().post(login_url, data=auth_data) as resp:
                 if resp.status != 200:
                     logger.error(f"🛑 Login failed with status: {resp.status}")
-                    return False
+                    return self._set_logged_in(False)
                 
                 try:
                     response = await resp.json()
                     if response.get("success"):
                         logger.info("✅ Login successful")
-                        # Сохраняем куки для последующих запросов
-                        self.auth_cookies = self.cookie_jar
-                        logger.debug(f"⚙️ Auth cookies: {self.auth_cookies}")
-                        return True
+                        return self._set_logged_in(True)
                     else:
                         logger.error(f"🛑 Login failed: {response.get('msg')}")
-                        return False
+                        return self._set_logged_in(False)
                 except ContentTypeError:
                     text = await resp.text()
                     if "success" in text.lower():
                         logger.warning("⚠️ Login successful (text response)")
-                        # Сохраняем куки для последующих запросов
-                        self.auth_cookies = self.cookie_jar
-                        logger.debug(f"⚙️ Auth cookies: {self.auth_cookies}")
-                        return True
+                        return self._set_logged_in(True)
                     logger.error(f"🛑 Login failed. Response text: {text[:100]}...")
-                    return False
+                    return self._set_logged_in(False)
         except Exception as e:
             logger.exception(f"🛑 Login error: {e}")
-            return False
+            return self._set_logged_in(False)
+
+    def _set_logged_in(self, value: bool) -> bool:
+        XUI_LOGINS.labels(self.server.name, "success" if value else "failure").inc()
+        self._logged_in = value
+        if value:
+            self._login_generation += 1
+        return value
+
+    async def ensure_login(self, stale_generation: Optional[int] = None) -> bool:
+        """
+        Lazily authenticate against the panel.
+
+        Concurrent callers share a single in-flight login: only the first one
+        performs the request, the rest await the same task and reuse its result.
+
+        Args:
+            stale_generation: Login generation that the panel has just rejected.
+                If the current session is newer, no re-login is performed.
+        """
+        if self._logged_in and self._login_generation != stale_generation:
+            return True
+        if self._login_task is None:
+            self._login_task = asyncio.ensure_future(self.login())
+            self._login_task.add_done_callback(self._clear_login_task)
+        return await asyncio.shield(self._login_task)
+
+    def _clear_login_task(self, _task: asyncio.Future) -> None:
+        self._login_task = None
+
+    @staticmethod
+    def _is_auth_failure(resp: aiohttp.ClientResponse) -> bool:
+        # Неавторизованные запросы к API панель редиректит на страницу логина
+        return resp.status == 401 or resp.status in (301, 302, 303, 307, 308)
+
+    async def _request(self, method: str, path: str, raise_on_missing: bool = False,
+                       **kwargs) -> Optional[dict]:
+        """
+        Запрос к API панели с переиспользованием сессии.
+
+        При ответе 401 или редиректе на страницу логина выполняется повторная
+        аутентификация и запрос повторяется один раз.
+
+        Raises:
+            PanelEndpointMissing: если raise_on_missing=True и панель ответила 404.
+
+        Returns:
+            Optional[dict]: JSON-ответ панели или None при ошибке.
+        """
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        for attempt in (1, 2):
+            if not await self.ensure_login():
+                logger.error(f"🛑 Login failed before request to {path}")
+                return None
+            generation = self._login_generation
+            async with trace(f"xui {method} {path}"), \
+                    self._get_session().request(method, url, allow_redirects=False, **kwargs) as resp:
+                if self._is_auth_failure(resp):
+                    logger.warning(f"⚠️ Panel session expired (status={resp.status}), re-login required")
+                    if attempt == 1 and await self.ensure_login(stale_generation=generation):
+                        continue
+                    return None
+
+                if resp.status == 404 and raise_on_missing:
+                    raise PanelEndpointMissing(path)
 
-    async def get_inbound(self, inbound_id: int):
-        """Получение данных инбаунда"""
-        try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/panel/api/inbounds/get/{inbound_id}"
-            
-            logger.info(f"ℹ️  Getting inbound data from: {url}")
-            logger.debug(f"⚙️ Using cookies: {self.cookie_jar}")
-            
-            async with self.session.get(url) as resp:
-                logger.debug(f"⚙️ Response status: {resp.status}")
-                logger.debug(f"⚙️ Response cookies: {resp.cookies}")
-                
                 if resp.status != 200:
                     text = await resp.text()
-                    logger.error(f"🛑 Get inbound failed: status={resp.status}, response={text[:100]}...")
+                    logger.error(f"🛑 Request {path} failed: status={resp.status}, response={text[:100]}...")
                     return None
-                
+
                 try:
-                    data = await resp.json()
-                    if data.get("success"):
-                        logger.debug(f'⚙️ Data: {str(data)}')
-                        return data.get("obj")
-                    else:
-                        logger.error(f"🛑 Get inbound failed: {data.get('msg')}")
-                        return None
+                    return await resp.json()
                 except ContentTypeError:
                     text = await resp.text()
-                    logger.error(f"🛑 Get inbound response error: {text[:100]}...")
-                    return None
+                    logger.warning(f"⚠️ Non-JSON response from {path}: {text[:100]}...")
+                    return {"success": "success" in text.lower(), "msg": text[:100], "obj": None}
+        return None
+
+    @observe_xui
+    async def get_inbound(self, inbound_id: int):
+        """Получение данных инбаунда"""
+        try:
+            logger.info(f"ℹ️  Getting inbound data: {inbound_id}")
+            data = await self._request("GET", f"panel/api/inbounds/get/{inbound_id}")
+            if not data:
+                return None
+            if data.get("success"):
+                logger.debug(f'⚙️ Data: {str(data)}')
+                inbound = data.get("obj")
+                if inbound:
+                    self._store_snapshot(inbound_id, inbound)
+                return inbound
+            logger.error(f"🛑 Get inbound failed: {data.get('msg')}")
+            return None
         except Exception as e:
             logger.exception(f"🛑 Get inbound error: {e}")
             return None
 
+    def _store_snapshot(self, inbound_id: int, inbound: dict):
+        """Обновление снимка инбаунда по свежему ответу панели"""
+        raw_settings = inbound.get("settings") or "{}"
+        previous = self._snapshots.get(inbound_id)
+        if previous and previous.raw_settings == raw_settings:
+            # Клиенты не менялись - переиспользуем уже разобранные настройки
+            settings, clients, version = previous.settings, previous.clients, previous.version
+        else:
+            settings = json.loads(raw_settings)
+            clients = {client.get("email"): client for client in settings.pop("clients", [])}
+            version = previous.version + 1 if previous else 1
+        self._snapshots[inbound_id] = InboundSnapshot(
+            inbound={k: v for k, v in inbound.items() if k not in ("settings", "clientStats")},
+            settings=settings,
+            clients=clients,
+            raw_settings=raw_settings,
+            fetched_at=time.monotonic(),
+            version=version,
+        )
+
+    async def get_inbound_snapshot(self, inbound_id: int,
+                                   max_age: Optional[float] = None) -> Optional[InboundSnapshot]:
+        """
+        Cached inbound data.
+
+        The snapshot is refreshed by every `get_inbound` call (the traffic
+        monitor polls each inbound on a timer) and kept in sync with our own
+        client mutations, so it is re-downloaded here only when it is older
+        than `max_age` (XUI_SNAPSHOT_TTL by default). Concurrent callers share
+        one request.
+        """
+        max_age = config.XUI_SNAPSHOT_TTL if max_age is None else max_age
+        snapshot = self._snapshots.get(inbound_id)
+        if snapshot and time.monotonic() - snapshot.fetched_at < max_age:
+            return snapshot
+        task = self._snapshot_tasks.get(inbound_id)
+        if task is None:
+            task = asyncio.ensure_future(self.get_inbound(inbound_id))
+            task.add_done_callback(lambda _task: self._snapshot_tasks.pop(inbound_id, None))
+            self._snapshot_tasks[inbound_id] = task
+        if not await asyncio.shield(task):
+            return None
+        return self._snapshots.get(inbound_id)
+
+    def invalidate_snapshot(self, inbound_id: int):
+        self._snapshots.pop(inbound_id, None)
+
+    def _apply_snapshot_delta(self, inbound_id: int, batch: List[ClientMutation]):
+        """
+        Перенос результата своих изменений в снимок без запроса к панели.
+
+        Если часть пачки не применилась, состояние панели неизвестно и
+        снимок сбрасывается до следующей загрузки.
+        """
+        snapshot = self._snapshots.get(inbound_id)
+        if snapshot is None:
+            return
+        if not all(m.result for m in batch):
+            self.invalidate_snapshot(inbound_id)
+            return
+        clients = dict(snapshot.clients)
+        for m in batch:
+            if m.op == "delete":
+                clients.pop(m.email, None)
+            else:
+                clients[m.email] = m.client
+        snapshot.clients = clients
+        snapshot.version += 1
+
+    @observe_xui
     async def update_inbound(self, inbound_id: int, data: dict):
         """Обновление инбаунда"""
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/panel/api/inbounds/update/{inbound_id}"
-            
-            logger.info(f"ℹ️  Updating inbound at: {url}")
-            
-            async with self.session.post(url, json=data) as resp:
-                if resp.status != 200:
-                    logger.error(f"🛑 Update inbound failed with status: {resp.status}")
-                    return False
-                
-                try:
-                    response = await resp.json()
-                    return response.get("success", False)
-                except ContentTypeError:
-                    text = await resp.text()
-                    return "success" in text.lower()
+            logger.info(f"ℹ️  Updating inbound: {inbound_id}")
+            response = await self._request("POST", f"panel/api/inbounds/update/{inbound_id}", json=data)
+            return bool(response and response.get("success", False))
         except Exception as e:
             logger.exception(f"🛑 Update inbound error: {e}")
             return False
 
-    async def create_vless_profile(self, telegram_id: int):
-        """Создание нового клиента для пользователя"""
-        if not await self.login():
-            logger.error("🛑 Login failed before creating profile")
+    def _build_client(self, email: str, **extra) -> dict:
+        """Настройки нового клиента для Reality"""
+        return {
+            "id": str(uuid.uuid4()),
+            "flow": "",
+            "email": email,
+            "limitIp": 0,
+            "totalGB": 0,
+            "expiryTime": 0,
+            "enable": True,
+            "subId": new_sub_id(),
+            "reset": 0,
+            # Добавляем настройки для Reality
+            "fingerprint": self.server.reality_fingerprint,
+            "publicKey": self.server.reality_public_key,
+            "shortId": self.server.reality_short_id,
+            "spiderX": self.server.reality_spider_x,
+            **extra,
+        }
+
+    def _profile_data(self, client: dict, inbound: dict) -> dict:
+        return {
+            "client_id": client["id"],
+            "email": client["email"],
+            "sub_id": client["subId"],
+            # Размещение клиента в пуле серверов
+            "server": self.server.name,
+            "inbound_id": inbound["id"],
+            "host": self.server.host,
+            "port": inbound["port"],
+            # Указываем тип безопасности как reality
+            "security": "reality",
+            "remark": inbound["remark"],
+            # Добавляем необходимые параметры для Reality
+            "sni": self.server.reality_sni,
+            "pbk": self.server.reality_public_key,
+            "fp": self.server.reality_fingerprint,
+            "sid": self.server.reality_short_id,
+            "spx": self.server.reality_spider_x
+        }
+
+    async def _client_request(self, path: str, payload: Optional[dict] = None) -> Optional[bool]:
+        """
+        Запрос к клиентскому эндпоинту панели (addClient/delClient/updateClient).
+
+        Returns:
+            Optional[bool]: результат операции или None, если панель не
+            поддерживает эндпоинт и нужно переписать инбаунд целиком.
+        """
+        if self._client_api_supported is False:
             return None
-        
-        inbound = await self.get_inbound(config.INBOUND_ID)
+        try:
+            response = await self._request("POST", path, raise_on_missing=True, json=payload)
+        except PanelEndpointMissing:
+            logger.warning("⚠️ Panel has no per-client API, falling back to full inbound updates")
+            self._client_api_supported = False
+            return None
+        if response is not None:
+            self._client_api_supported = True
+        if response and not response.get("success"):
+            logger.error(f"🛑 Request {path} failed: {response.get('msg')}")
+        return bool(response and response.get("success"))
+
+    async def _rewrite_inbound_clients(self, inbound_id: int, mutate) -> bool:
+        """
+        Старый путь для панелей без клиентского API: загрузить инбаунд,
+        изменить список клиентов и отправить settings целиком.
+
+        Args:
+            mutate: функция, принимающая список клиентов и возвращающая новый
+                список либо None, если изменений нет.
+        """
+        inbound = await self.get_inbound(inbound_id)
         if not inbound:
-            logger.error(f"🛑 Inbound {config.INBOUND_ID} not found")
+            logger.error(f"🛑 Inbound {inbound_id} not found")
+            return False
+
+        settings = json.loads(inbound["settings"])
+        clients = mutate(settings.get("clients", []))
+        if clients is None:
+            return False
+        settings["clients"] = clients
+
+        update_data = {
+            "up": inbound["up"],
+            "down": inbound["down"],
+            "total": inbound["total"],
+            "remark": inbound["remark"],
+            "enable": inbound["enable"],
+            "expiryTime": inbound["expiryTime"],
+            "listen": inbound["listen"],
+            "port": inbound["port"],
+            "protocol": inbound["protocol"],
+            "settings": json.dumps(settings, separators=(",", ":")),
+            "streamSettings": inbound["streamSettings"],
+            "sniffing": inbound["sniffing"],
+            # "allocate": inbound["allocate"]
+        }
+        return await self.update_inbound(inbound_id, update_data)
+
+    def _mutation_queue(self, inbound_id: int) -> InboundMutationQueue:
+        queue = self._mutation_queues.get(inbound_id)
+        if queue is None:
+            async def apply(batch: List[ClientMutation]):
+                # Другие процессы бота могут менять тот же инбаунд
+                lease_name = f"inbound:{self.server.name}:{inbound_id}"
+                async with locks.lease(lease_name, INBOUND_LEASE_TTL, config.LOCK_WAIT) as acquired:
+                    if not acquired:
+                        logger.error(f"🛑 Inbound {inbound_id} on {self.server.name} is locked by another worker")
+                        return
+                    await self._apply_mutations(inbound_id, batch)
+                    self._apply_snapshot_delta(inbound_id, batch)
+            queue = InboundMutationQueue(apply, config.XUI_MUTATION_WINDOW)
+            self._mutation_queues[inbound_id] = queue
+        return queue
+
+    @observe_xui
+    async def add_client(self, inbound_id: int, client: dict) -> bool:
+        """Добавление клиента в инбаунд"""
+        mutation = ClientMutation("add", client["email"], client=client, client_id=client["id"])
+        return await self._mutation_queue(inbound_id).submit(mutation)
+
+    @observe_xui
+    async def update_client(self, inbound_id: int, client: dict) -> bool:
+        """Обновление настроек клиента (поиск по client["id"])"""
+        mutation = ClientMutation("update", client["email"], client=client, client_id=client["id"])
+        return await self._mutation_queue(inbound_id).submit(mutation)
+
+    @observe_xui
+    async def remove_client(self, inbound_id: int, email: str, client_id: Optional[str] = None) -> bool:
+        """Удаление клиента из инбаунда"""
+        mutation = ClientMutation("delete", email, client_id=client_id)
+        return await self._mutation_queue(inbound_id).submit(mutation)
+
+    @observe_xui
+    async def remove_clients(self, inbound_id: int, clients: List[tuple]) -> List[bool]:
+        """
+        Пакетное удаление клиентов одной записью в инбаунд.
+
+        Args:
+            clients: список пар (email, client_id); client_id может быть None.
+        """
+        mutations = [ClientMutation("delete", email, client_id=client_id) for email, client_id in clients]
+        return await self._mutation_queue(inbound_id).submit_many(mutations)
+
+    @observe_xui
+    async def find_client_ids(self, inbound_id: int, emails) -> Dict[str, str]:
+        """
+        Поиск id клиентов по email в снимке инбаунда.
+
+        Если кого-то в снимке нет (клиент мог быть добавлен вне бота),
+        снимок перезагружается один раз.
+        """
+        wanted = set(emails)
+        for max_age in (None, 0):
+            snapshot = await self.get_inbound_snapshot(inbound_id, max_age=max_age)
+            if not snapshot:
+                return {}
+            if wanted <= snapshot.clients.keys():
+                break
+        return {
+            email: snapshot.clients[email].get("id")
+            for email in wanted
+            if email in snapshot.clients
+        }
+
+    async def _apply_mutations(self, inbound_id: int, batch: List[ClientMutation]):
+        """
+        Применение пачки изменений к инбаунду.
+
+        Добавления отправляются одним addClient, одиночные удаления и
+        обновления идут через клиентские эндпоинты. Крупные пачки удалений,
+        а также все изменения на панелях без клиентского API применяются
+        одной перезаписью инбаунда.
+        """
+        deletes = [m for m in batch if m.op == "delete"]
+        if len(batch) > 1:
+            logger.info(f"ℹ️  Applying {len(batch)} client mutations to inbound {inbound_id}")
+
+        if self._client_api_supported is not False and len(deletes) < config.XUI_BULK_DELETE_THRESHOLD:
+            await self._apply_via_client_api(inbound_id, batch)
+
+        remaining = [m for m in batch if m.result is None]
+        if remaining:
+            await self._apply_via_inbound_rewrite(inbound_id, remaining)
+
+    async def _apply_via_client_api(self, inbound_id: int, batch: List[ClientMutation]):
+        adds = [m for m in batch if m.op == "add"]
+        if adds:
+            payload = {"id": inbound_id, "settings": json.dumps({"clients": [m.client for m in adds]})}
+            result = await self._client_request("panel/api/inbounds/addClient", payload)
+            if result is False and len(adds) > 1:
+                # Один неудачный клиент (например, дубликат email) не должен
+                # ронять остальных - повторяем по одному
+                for m in adds:
+                    payload = {"id": inbound_id, "settings": json.dumps({"clients": [m.client]})}
+                    m.result = await self._client_request("panel/api/inbounds/addClient", payload)
+            else:
+                for m in adds:
+                    m.result = result
+            if result is None:
+                return
+
+        for m in (m for m in batch if m.op == "update"):
+            payload = {"id": inbound_id, "settings": json.dumps({"clients": [m.client]})}
+            m.result = await self._client_request(f"panel/api/inbounds/updateClient/{m.client_id}", payload)
+            if m.result is None:
+                return
+
+        deletes = [m for m in batch if m.op == "delete"]
+        unresolved = [m.email for m in deletes if not m.client_id]
+        if unresolved:
+            client_ids = await self.find_client_ids(inbound_id, unresolved)
+            for m in deletes:
+                m.client_id = m.client_id or client_ids.get(m.email)
+        for m in deletes:
+            if not m.client_id:
+                m.result = False
+                continue
+            m.result = await self._client_request(f"panel/api/inbounds/{inbound_id}/delClient/{m.client_id}")
+            if m.result is None:
+                return
+
+    async def _apply_via_inbound_rewrite(self, inbound_id: int, batch: List[ClientMutation]):
+        def mutate(clients: list):
+            changed = False
+            for m in batch:
+                m.result = False
+                if m.op == "add":
+                    if any(c.get("email") == m.email for c in clients):
+                        logger.error(f"🛑 Client {m.email} already exists")
+                        continue
+                    clients.append(m.client)
+                elif m.op == "update":
+                    index = next((i for i, c in enumerate(clients) if c.get("id") == m.client_id), None)
+                    if index is None:
+                        continue
+                    clients[index] = m.client
+                else:
+                    new_clients = [c for c in clients if c.get("email") != m.email]
+                    if len(new_clients) == len(clients):
+                        continue
+                    clients = new_clients
+                m.result = True
+                changed = True
+            # Если не было изменений
+            return clients if changed else None
+
+        success = await self._rewrite_inbound_clients(inbound_id, mutate)
+        for m in batch:
+            m.result = bool(m.result and success)
+
+    @observe_xui
+    async def create_vless_profile(self, telegram_id: int, inbound_id: int):
+        """Создание нового клиента для пользователя"""
+        snapshot = await self.get_inbound_snapshot(inbound_id)
+        if not snapshot:
+            logger.error(f"🛑 Inbound {inbound_id} not found on {self.server.name}")
             return None
         
         try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
-            client_id = str(uuid.uuid4())
             email = f"user_{telegram_id}_{random.randint(1000,9999)}"
-            
-            # Обновленные настройки для Reality
-            new_client = {
-                "id": client_id,
-                "flow": "",
-                "email": email,
-                "limitIp": 0,
-                "totalGB": 0,
-                "expiryTime": 0,
-                "enable": True,
-                "subId": "",
-                "reset": 0,
-                # Добавляем настройки для Reality
-                "fingerprint": config.REALITY_FINGERPRINT,
-                "publicKey": config.REALITY_PUBLIC_KEY,
-                "shortId": config.REALITY_SHORT_ID,
-                "spiderX": config.REALITY_SPIDER_X
-            }
-            
-            clients.append(new_client)
-            settings["clients"] = clients
-            
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-                # "allocate": inbound["allocate"]
-            }
-            
-            if await self.update_inbound(config.INBOUND_ID, update_data):
-                return {
-                    "client_id": client_id,
-                    "email": email,
-                    "port": inbound["port"],
-                    # Указываем тип безопасности как reality
-                    "security": "reality",
-                    "remark": inbound["remark"],
-                    # Добавляем необходимые параметры для Reality
-                    "sni": config.REALITY_SNI,
-                    "pbk": config.REALITY_PUBLIC_KEY,
-                    "fp": config.REALITY_FINGERPRINT,
-                    "sid": config.REALITY_SHORT_ID,
-                    "spx": config.REALITY_SPIDER_X
-                }
+            while email in snapshot.clients:
+                email = f"user_{telegram_id}_{random.randint(1000,9999)}"
+            client = self._build_client(email)
+            if await self.add_client(inbound_id, client):
+                return self._profile_data(client, snapshot.inbound)
             return None
         except Exception as e:
             logger.exception(f"🛑 Create profile error: {e}")
             return None
 
-    async def create_static_client(self, profile_name: str):
+    @observe_xui
+    async def create_static_client(self, profile_name: str, inbound_id: int):
         """Создание статического клиента"""
-        if not await self.login():
-            logger.error("🛑 Login failed before creating static client")
+        snapshot = await self.get_inbound_snapshot(inbound_id)
+        if not snapshot:
+            logger.error(f"🛑 Inbound {inbound_id} not found on {self.server.name}")
             return None
-        
-        inbound = await self.get_inbound(config.INBOUND_ID)
-        if not inbound:
-            logger.error(f"🛑 Inbound {config.INBOUND_ID} not found")
+        if profile_name in snapshot.clients:
+            logger.error(f"🛑 Client {profile_name} already exists")
             return None
         
         try:
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
-            client_id = str(uuid.uuid4())
-            
-            # Обновленные настройки для Reality
-            new_client = {
-                "id": client_id,
-                "flow": "",
-                "email": profile_name,
-                "limitIp": 0,
-                "totalGB": 0,
-                "expiryTime": 0,
-                "enable": True,
-                "tgId": "",
-                "subId": "",
-                "reset": 0,
-                # Добавляем настройки для Reality
-                "fingerprint": config.REALITY_FINGERPRINT,
-                "publicKey": config.REALITY_PUBLIC_KEY,
-                "shortId": config.REALITY_SHORT_ID,
-                "spiderX": config.REALITY_SPIDER_X
-            }
-            
-            clients.append(new_client)
-            settings["clients"] = clients
-            
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-                # "allocate": inbound["allocate"]
-            }
-            
-            if await self.update_inbound(config.INBOUND_ID, update_data):
-                return {
-                    "client_id": client_id,
-                    "email": profile_name,
-                    "port": inbound["port"],
-                    # Указываем тип безопасности как reality
-                    "security": "reality",
-                    "remark": inbound["remark"],
-                    # Добавляем необходимые параметры для Reality
-                    "sni": config.REALITY_SNI,
-                    "pbk": config.REALITY_PUBLIC_KEY,
-                    "fp": config.REALITY_FINGERPRINT,
-                    "sid": config.REALITY_SHORT_ID,
-                    "spx": config.REALITY_SPIDER_X
-                }
+            client = self._build_client(profile_name, tgId="")
+            if await self.add_client(inbound_id, client):
+                return self._profile_data(client, snapshot.inbound)
             return None
         except Exception as e:
             logger.exception(f"🛑 Create static client error: {e}")
             return None
 
-    async def delete_client(self, email: str):
-        """Удаление клиента по email"""
-        if not await self.login():
-            return False
-        
+    @observe_xui
+    async def delete_client(self, email: str, client_id: Optional[str] = None,
+                            inbound_id: Optional[int] = None):
+        """
+        Удаление клиента по email.
+
+        Если client_id известен (хранится в профиле пользователя), панель
+        не запрашивается для его поиска. Без inbound_id клиент удаляется из
+        первого инбаунда сервера.
+        """
         try:
-            # Получаем данные инбаунда
-            inbound = await self.get_inbound(config.INBOUND_ID)
-            if not inbound:
-                return False
-            
-            settings = json.loads(inbound["settings"])
-            clients = settings.get("clients", [])
-            
-            # Фильтруем клиентов
-            new_clients = [c for c in clients if c["email"] != email]
-            
-            # Если не было изменений
-            if len(new_clients) == len(clients):
-                return False
-            
-            settings["clients"] = new_clients
-            
-            # Формируем данные для обновления
-            update_data = {
-                "up": inbound["up"],
-                "down": inbound["down"],
-                "total": inbound["total"],
-                "remark": inbound["remark"],
-                "enable": inbound["enable"],
-                "expiryTime": inbound["expiryTime"],
-                "listen": inbound["listen"],
-                "port": inbound["port"],
-                "protocol": inbound["protocol"],
-                "settings": json.dumps(settings, indent=2),
-                "streamSettings": inbound["streamSettings"],
-                "sniffing": inbound["sniffing"],
-                # "allocate": inbound["allocate"]
-            }
-            
-            return await self.update_inbound(config.INBOUND_ID, update_data)
+            return await self.remove_client(inbound_id or self.server.inbounds[0], email, client_id)
         except Exception as e:
             logger.exception(f"🛑 Delete client error: {e}")
             return False
     
+    @observe_xui
     async def get_user_stats(self, email: str):
         """Получение статистики по email"""
-        if not await self.login():
-            logger.error("🛑 Login failed before getting stats")
-            return {"upload": 0, "download": 0}
-        
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/panel/api/inbounds/getClientTraffics/{email}"
-            
-            async with self.session.get(url) as resp:
-                if resp.status != 200:
-                    return {"upload": 0, "download": 0}
-                
-                try:
-                    data = await resp.json()
-                    if data.get("success"):
-                        client_data = data.get("obj")
-                        if isinstance(client_data, dict):
-                            return {
-                                "upload": client_data.get("up", 0),
-                                "download": client_data.get("down", 0)
-                            }
-                except ContentTypeError:
-                    return {"upload": 0, "download": 0}
-
+            data = await self._request("GET", f"panel/api/inbounds/getClientTraffics/{email}")
+            if data and data.get("success"):
+                client_data = data.get("obj")
+                if isinstance(client_data, dict):
+                    return {
+                        "upload": client_data.get("up", 0),
+                        "download": client_data.get("down", 0)
+                    }
         except Exception as e:
             logger.error(f"🛑 Stats error: {e}")
         return {"upload": 0, "download": 0}
     
+    @observe_xui
     async def get_global_stats(self, inbound_id: int):
-        """Получение статистики по email"""
-        if not await self.login():
-            logger.error("🛑 Login failed before getting stats")
-            return {"upload": 0, "download": 0}
-        
+        """Получение статистики по инбаунду (из снимка не старше XUI_SNAPSHOT_TTL)"""
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/panel/api/inbounds/get/{inbound_id}"
-            
-            async with self.session.get(url) as resp:
-                if resp.status != 200:
-                    return {"upload": 0, "download": 0}
-                
-                try:
-                    data = await resp.json()
-                    if data.get("success"):
-                        client_data = data.get("obj")
-                        if isinstance(client_data, dict):
-                            return {
-                                "upload": client_data.get("up", 0),
-                                "download": client_data.get("down", 0)
-                            }
-                except ContentTypeError:
-                    return {"upload": 0, "download": 0}
-
+            snapshot = await self.get_inbound_snapshot(inbound_id)
+            if snapshot:
+                return {
+                    "upload": snapshot.inbound.get("up", 0),
+                    "download": snapshot.inbound.get("down", 0)
+                }
         except Exception as e:
             logger.error(f"🛑 Stats error: {e}")
         return {"upload": 0, "download": 0}
 
+    @observe_xui
     async def get_online_users_across_inbounds(self):
-        if not await self.login():
-            logger.error("🛑 Login failed before getting online users")
-            return 0
-        
         try:
-            base_url = config.XUI_API_URL.rstrip('/')
-            base_path = config.XUI_BASE_PATH.strip('/')
-            if base_path:
-                base_url = f"{base_url}/{base_path}"
-            url = f"{base_url}/panel/api/inbounds/onlines"
-            
-            async with self.session.post(url) as resp:
-                if resp.status != 200:
-                    return 0
-                try:
-                    data = await resp.json()
-                    logger.debug(data)
-                    online_users_count = 0
-                    if data.get("success"):
-                        users = data.get("obj")
-                        try:
-                            online_users_count = len(users)
-                        except Exception as e:
-                            logger.error(f"🛑 Get online users error: {e}")
-                        finally:
-                            return online_users_count
-                except ContentTypeError:
-                    return 0
+            data = await self._request("POST", "panel/api/inbounds/onlines")
+            logger.debug(data)
+            if data and data.get("success"):
+                return len(data.get("obj") or [])
         except Exception as e:
             logger.error(f"🛑 Get online users error: {e}")
         return 0
 
     async def close(self):
+        for queue in self._mutation_queues.values():
+            await queue.close()
+        self._mutation_queues.clear()
+        self._snapshots.clear()
         if self.session:
             await self.session.close()
+        self._logged_in = False
 
 
-async def create_vless_profile(telegram_id: int):
-    api = XUIAPI()
-    try:
-        return await api.create_vless_profile(telegram_id)
-    finally:
-        await api.close()
+_apis: Dict[str, XUIAPI] = {}
 
-async def create_static_client(profile_name: str):
-    api = XUIAPI()
-    try:
-        return await api.create_static_client(profile_name)
-    finally:
+def get_api(server_name: Optional[str] = None) -> XUIAPI:
+    """
+    Общий для процесса клиент панели (одна сессия и пул соединений на сервер).
+
+    Без имени возвращается клиент основного сервера пула.
+
+    Raises:
+        KeyError: если сервера с таким именем нет в XUI_SERVERS.
+    """
+    server = config.get_server(server_name)
+    if server is None:
+        raise KeyError(f"Unknown panel server: {server_name}")
+    api = _apis.get(server.name)
+    if api is None:
+        api = _apis[server.name] = XUIAPI(server)
+    return api
+
+async def close_api():
+    for api in _apis.values():
         await api.close()
+    _apis.clear()
 
-async def delete_client_by_email(email: str):
-    api = XUIAPI()
+async def delete_client_by_email(email: str, client_id: Optional[str] = None,
+                                 server: Optional[str] = None, inbound_id: Optional[int] = None):
+    """Удаление клиента; server и inbound_id берутся из размещения профиля"""
     try:
-        return await api.delete_client(email)
-    finally:
-        await api.close()
+        api = get_api(server)
+    except KeyError as e:
+        logger.error(f"🛑 Delete client {email} error: {e}")
+        return False
+    return await api.delete_client(email, client_id, inbound_id)
+
+async def delete_profiles(profiles: List[dict]) -> List[bool]:
+    """
+    Пакетное удаление клиентов по данным профилей.
+
+    Профили группируются по размещению, и каждый инбаунд получает одну
+    пачку удалений. Профили без server/inbound_id (созданные до появления
+    пула) удаляются с основного сервера.
+    """
+    groups: Dict[tuple, List[int]] = {}
+    for index, profile in enumerate(profiles):
+        groups.setdefault((profile.get("server"), profile.get("inbound_id")), []).append(index)
+
+    results = [False] * len(profiles)
+
+    async def delete_group(server_name, inbound_id, indexes):
+        try:
+            api = get_api(server_name)
+            clients = [(profiles[i]["email"], profiles[i].get("client_id")) for i in indexes]
+            group_results = await api.remove_clients(inbound_id or api.server.inbounds[0], clients)
+        except Exception as e:
+            logger.exception(f"🛑 Delete clients error on {server_name}/{inbound_id}: {e}")
+            return
+        for i, success in zip(indexes, group_results):
+            results[i] = success
+
+    await asyncio.gather(*(
+        delete_group(server_name, inbound_id, indexes)
+        for (server_name, inbound_id), indexes in groups.items()
+    ))
+    return results
 
 async def get_global_stats():
-    api = XUIAPI()
-    try:
-        return await api.get_global_stats(config.INBOUND_ID)
-    finally:
-        await api.close()
+    """Суммарный трафик всех инбаундов пула"""
+    stats = await asyncio.gather(*(
+        get_api(server.name).get_global_stats(inbound_id)
+        for server in config.XUI_SERVERS
+        for inbound_id in server.inbounds
+    ))
+    return {
+        "upload": sum(s["upload"] for s in stats),
+        "download": sum(s["download"] for s in stats),
+    }
 
 async def get_online_users_count():
-    api = XUIAPI()
-    try:
-        return await api.get_online_users_across_inbounds()
-    finally:
-        await api.close()
+    counts = await asyncio.gather(*(
+        get_api(server.name).get_online_users_across_inbounds()
+        for server in config.XUI_SERVERS
+    ))
+    return sum(counts)
 
-async def get_user_stats(email: str):
-    api = XUIAPI()
-    try:
-        return await api.get_user_stats(email)
-    finally:
-        await api.close()
+async def get_user_stats(email: str, server: Optional[str] = None):
+    return await get_api(server).get_user_stats(email)
+
+def new_sub_id() -> str:
+    """Ключ подписки клиента (subId), как у подписок самой панели"""
+    return secrets.token_hex(8)
 
 def generate_vless_url(profile_data: dict) -> str:
     remark = profile_data.get('remark', '')
     email = profile_data['email']
     fragment = f"{remark}-{email}" if remark else email
+
+    # Хост и Reality берутся из текущих настроек сервера, на котором
+    # размещен клиент; для удаленного из пула сервера - из самого профиля
+    server = config.get_server(profile_data.get('server'))
+    if server:
+        host, pbk, fp, sni, sid, spx = (
+            server.host, server.reality_public_key, server.reality_fingerprint,
+            server.reality_sni, server.reality_short_id, server.reality_spider_x,
+        )
+    else:
+        host = profile_data.get('host', config.XUI_HOST)
+        pbk, fp, sni, sid, spx = (profile_data.get(key, '') for key in ('pbk', 'fp', 'sni', 'sid', 'spx'))
     
     return (
-        f"vless://{profile_data['client_id']}@{config.XUI_HOST}:{profile_data['port']}"
+        f"vless://{profile_data['client_id']}@{host}:{profile_data['port']}"
         f"?type=tcp&security=reality"
-        f"&pbk={config.REALITY_PUBLIC_KEY}"
-        f"&fp={config.REALITY_FINGERPRINT}"
-        f"&sni={config.REALITY_SNI}"
-        f"&sid={config.REALITY_SHORT_ID}"
-        f"&spx={config.REALITY_SPIDER_X}"
+        f"&pbk={pbk}"
+        f"&fp={fp}"
+        f"&sni={sni}"
+        f"&sid={sid}"
+        f"&spx={spx}"
         f"#{fragment}"
     )
 
-async def check_if_user_chat_member(user_id: int, bot: Bot) -> Optional[bool]:
+MEMBER_STATUSES = ('member', 'administrator', 'creator')
+
+# Результаты проверок членства: telegram_id -> bool
+membership_cache = TTLCache(config.MEMBERSHIP_CACHE_SIZE, config.MEMBERSHIP_CACHE_TTL)
+
+async def check_if_user_chat_member(user_id: int, bot: Bot,
+                                    limiter: Optional[TokenBucket] = None) -> Optional[bool]:
     """
     Check if user is a member of the configured chat.
     
     Args:
         user_id: Telegram user ID to check
         bot: Bot instance for API calls
+        limiter: Optional shared rate limiter. Every attempt takes a token,
+            and flood control pauses the whole limiter instead of one caller.
         
     Returns:
         Optional[bool]:
@@ -512,6 +885,8 @@ async def check_if_user_chat_member(user_id: int, bot: Bot) -> Optional[bool]:
     max_attempts = 3
     for attempt in range(1, max_attempts + 1):
         try:
+            if limiter:
+                await limiter.acquire()
             # Get chat member information
             chat_member = await bot.get_chat_member(
                 chat_id=config.CHAT_ID,
@@ -519,10 +894,13 @@ async def check_if_user_chat_member(user_id: int, bot: Bot) -> Optional[bool]:
             )
 
             # Check if user is a member (member, administrator, or creator)
-            return chat_member.status in ['member', 'administrator', 'creator']
+            is_member = chat_member.status in MEMBER_STATUSES
+            membership_cache.set(user_id, is_member)
+            return is_member
 
         except TelegramRetryAfter as e:
             # Temporary flood limit: wait and retry
+            MEMBERSHIP_FLOOD_RETRIES.inc()
             retry_after = int(getattr(e, "retry_after", 5))
             logger.warning(
                 f"Flood control while checking membership for user {user_id}. "
@@ -530,10 +908,14 @@ async def check_if_user_chat_member(user_id: int, bot: Bot) -> Optional[bool]:
             )
             if attempt == max_attempts:
                 return None
-            await asyncio.sleep(retry_after + 1)
+            if limiter:
+                limiter.pause(retry_after + 1)
+            else:
+                await asyncio.sleep(retry_after + 1)
         except TelegramBadRequest as e:
             # User not found / bot permissions / invalid chat state
             logger.warning(f"Failed to check chat membership for user {user_id}: {e}")
+            membership_cache.set(user_id, False)
             return False
         except Exception as e:
             # Temporary/unknown failure - don't treat as "not a member"
@@ -542,6 +924,18 @@ async def check_if_user_chat_member(user_id: int, bot: Bot) -> Optional[bool]:
 
     return None
 
+async def get_chat_membership(user_id: int, bot: Bot) -> Optional[bool]:
+    """
+    Cached variant of check_if_user_chat_member.
+
+    Answers from membership_cache while the entry is fresh (it is also fed by
+    the audit and by chat_member updates) and asks Telegram only on a miss.
+    """
+    is_member = membership_cache.get(user_id)
+    if is_member is not None:
+        return is_member
+    return await check_if_user_chat_member(user_id, bot)
+
 async def get_chat_name(bot: Bot, chat_id: int | str) -> str:
     """
     Retrieve the display name for a chat, given a chat ID.
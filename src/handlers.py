@@ -1,34 +1,60 @@
 import asyncio
 import logging
 import json
+from datetime import datetime
+from html import escape
 from aiogram import Dispatcher, Router, F, Bot
-from aiogram.types import Message, CallbackQuery
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated
 from aiogram.filters import Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from config import config
 from database import (
-    StaticProfile, get_user, create_user, get_all_users,
-    create_static_profile, get_static_profiles, 
-    User, Session, get_user_stats as db_user_stats,
+    get_user, create_user, update_user, get_all_users, set_user_profile,
+    create_static_profile, get_static_profiles, get_static_profile,
+    delete_static_profile, set_chat_member, User, get_user_stats as db_user_stats,
+    get_users_page, mark_membership_checked,
 )
 from functions import (
-    create_vless_profile, delete_client_by_email, generate_vless_url,
-    get_user_stats, create_static_client, get_global_stats,
-    get_online_users_count, check_if_user_chat_member, get_chat_name,
+    generate_vless_url, get_online_users_count, get_chat_membership,
+    MEMBER_STATUSES, membership_cache, new_sub_id,
 )
+from presentation import (
+    presentation, menu_keyboard, ADMIN_PANEL_KEYBOARD, BACK_TO_MENU_KEYBOARD, CLIENT_APPS_KEYBOARD,
+)
+from pool import create_vless_profile, create_static_client, delete_static_client
+from audit import revoke_profiles
+from broadcast import start_broadcast
+from membership_sync import start_membership_sync, cancel_membership_sync
+from subscription import subscription_url
+from traffic import traffic_monitor
+from history import traffic_history, TOP_PERIOD
+from analytics import get_traffic_report
 
 logger = logging.getLogger(__name__)
 
 router = Router()
 
 MAX_MESSAGE_LENGTH = 4096
+USER_LIST_PAGE_SIZE = 20
+# Пауза после приветствия нового пользователя перед меню, с
+WELCOME_DELAY = 2
 
 class AdminStates(StatesGroup):
     CREATE_STATIC_PROFILE = State()
     SEND_MESSAGE = State()
     SEND_MESSAGE_TARGET = State()
+    USER_SEARCH = State()
+
+class UserListPage(CallbackData, prefix="users"):
+    """Кнопки списка пользователей: курсор telegram_id и действие"""
+    members: bool
+    action: str = "page"  # page | search | reset
+    after: int = 0
+    before: int = 0
 
 def split_text(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
     """Разбивает текст на части указанной максимальной длины"""
@@ -48,9 +74,41 @@ def split_text(text: str, max_length: int = MAX_MESSAGE_LENGTH) -> list:
         text = text[len(part):].lstrip()
     return parts
 
-async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
+def format_traffic(size: int) -> str:
+    """Объем трафика в MB или GB"""
+    megabytes = size / 1024 / 1024
+    if megabytes < 1024:
+        return f"{megabytes:.2f} MB"
+    return f"{megabytes / 1024:.2f} GB"
+
+def format_periods(periods) -> str:
+    """Трафик по периодам из истории"""
+    text = ""
+    for label, up, down in periods:
+        text += f"**{label}:** 🔼 `{format_traffic(up)}` | 🔽 `{format_traffic(down)}`\n"
+    return text + "\n"
+
+def format_age(checked_at) -> str:
+    """Возраст последней проверки членства"""
+    if not checked_at:
+        return "не проверялся"
+    seconds = (datetime.utcnow() - checked_at).total_seconds()
+    if seconds < 3600:
+        return f"{max(int(seconds // 60), 1)} мин"
+    if seconds < 86400:
+        return f"{int(seconds // 3600)} ч"
+    return f"{int(seconds // 86400)} дн"
+
+def format_updated_at(updated_at) -> str:
+    """Подпись о времени снимка статистики"""
+    if not updated_at:
+        return "🕒 Данные пока недоступны"
+    return f"🕒 Данные на: `{updated_at:%d.%m.%Y %H:%M:%S}`"
+
+async def show_menu(bot: Bot, chat_id: int, message_id: int = None, user: User = None):
     """Функция для отображения меню (может как редактировать существующее сообщение, так и отправлять новое)"""
-    user = await get_user(chat_id)
+    if user is None:
+        user = await get_user(chat_id)
     if not user:
         return
     
@@ -58,16 +116,7 @@ async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
         f"**Имя профиля**: `{user.full_name}`\n"
         f"**Id**: `{user.telegram_id}`\n"
     )
-    
-    builder = InlineKeyboardBuilder()
-    builder.button(text="✅ Подключить", callback_data="connect")
-    builder.button(text="📊 Статистика", callback_data="stats")
-    builder.button(text="ℹ️ Помощь", callback_data="help")
-    
-    if user.is_admin:
-        builder.button(text="⚠️ Админ. меню", callback_data="admin_menu")
-    
-    builder.adjust(2, 2, 1)
+    reply_markup = menu_keyboard(user.is_admin)
     
     if message_id:
         # Редактируем существующее сообщение
@@ -75,7 +124,7 @@ async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
             chat_id=chat_id,
             message_id=message_id,
             text=text,
-            reply_markup=builder.as_markup(),
+            reply_markup=reply_markup,
             parse_mode='Markdown'
         )
     else:
@@ -83,11 +132,11 @@ async def show_menu(bot: Bot, chat_id: int, message_id: int = None):
         await bot.send_message(
             chat_id=chat_id,
             text=text,
-            reply_markup=builder.as_markup(),
+            reply_markup=reply_markup,
             parse_mode='Markdown'
         )
 
-def update_user_data(message: Message, user: User, update_data: dict) -> None:
+async def update_user_data(message: Message, user: User, update_data: dict) -> User:
     """
     Update user data in the database.
     
@@ -102,23 +151,20 @@ def update_user_data(message: Message, user: User, update_data: dict) -> None:
                      Valid fields include: full_name, username, telegram_id, etc.
     
     Returns:
-        None
+        User: The updated user, re-read through the repository
         
     Note:
         The function logs the update operation for debugging purposes.
         Only fields that exist in the User model can be updated.
     """
-    with Session() as session:
-        db_user = session.query(User).get(user.id)
-        for key, value in update_data.items():
-            setattr(db_user, key, value)
-        session.commit()
-        logger.info(f"🔄 Updated user data: {message.from_user.id}")
+    await update_user(user.telegram_id, **update_data)
+    logger.info(f"🔄 Updated user data: {message.from_user.id}")
+    return await get_user(user.telegram_id)
 
 @router.message(Command("start"))
 async def start_cmd(message: Message, bot: Bot):
     logger.info(f"ℹ️ Start command from {message.from_user.id}")
-    is_user_chat_member = await check_if_user_chat_member(message.from_user.id, bot)
+    is_user_chat_member = await get_chat_membership(message.from_user.id, bot)
 
     if is_user_chat_member:
         user = await get_user(message.from_user.id)
@@ -141,14 +187,15 @@ async def start_cmd(message: Message, bot: Bot):
                 chat_member=is_user_chat_member,
                 is_admin=is_admin
             )
-            await message.answer(f"Добро пожаловать в VPN бота `{(await bot.get_me()).full_name}`!", parse_mode='Markdown')
-            await asyncio.sleep(2)
+            bot_name = await presentation.get_bot_name(bot)
+            await message.answer(f"Добро пожаловать в VPN бота `{bot_name}`!", parse_mode='Markdown')
+            await asyncio.sleep(WELCOME_DELAY)
     
         # Обновляем данные, если есть изменения
         if update_data:
-            update_user_data(message, user, update_data)
+            user = await update_user_data(message, user, update_data)
         
-        await show_menu(bot, message.from_user.id)
+        await show_menu(bot, message.from_user.id, user=user)
     else:
         await message.answer("Сервис недоступен.")
         logger.info(f"🛑 Denied access to {message.from_user.id}")
@@ -160,7 +207,7 @@ async def menu_cmd(message: Message, bot: Bot):
         await start_cmd(message, bot)
         return
     
-    is_user_chat_member = await check_if_user_chat_member(message.from_user.id, bot)
+    is_user_chat_member = await get_chat_membership(message.from_user.id, bot)
 
     # Проверяем изменения данных
     update_data = {}
@@ -168,15 +215,16 @@ async def menu_cmd(message: Message, bot: Bot):
         update_data["full_name"] = message.from_user.full_name
     if user.username != message.from_user.username:
         update_data["username"] = message.from_user.username
-    if user.chat_member != is_user_chat_member:
+    # None - проверка не удалась, сохраненный флаг не трогаем
+    if is_user_chat_member is not None and user.chat_member != is_user_chat_member:
         update_data["chat_member"] = is_user_chat_member
     
     # Обновляем данные если есть изменения
     if update_data:
-        update_user_data(message, user, update_data)
+        user = await update_user_data(message, user, update_data)
     
     if is_user_chat_member:
-        await show_menu(bot, message.from_user.id)
+        await show_menu(bot, message.from_user.id, user=user)
     else:
         await message.answer("Сервис недоступен.")
         logger.info(f"🛑 Denied access to {message.from_user.id}")
@@ -184,11 +232,9 @@ async def menu_cmd(message: Message, bot: Bot):
 @router.callback_query(F.data == "help")
 async def help_msg(callback: CallbackQuery, bot: Bot):
     await callback.answer()
-    builder = InlineKeyboardBuilder()
-    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
-    chat_name = await get_chat_name(bot, config.CHAT_ID)
+    chat_name = await presentation.get_chat_name(bot)
     text = f"Проблемы в работе сети и бота обсуждаем в чатe `{chat_name}`"
-    await callback.message.answer(text, parse_mode='Markdown', reply_markup=builder.as_markup())
+    await callback.message.answer(text, parse_mode='Markdown', reply_markup=BACK_TO_MENU_KEYBOARD)
 
 @router.callback_query(F.data == "admin_menu")
 async def admin_menu(callback: CallbackQuery):
@@ -199,21 +245,16 @@ async def admin_menu(callback: CallbackQuery):
     
     _, chat_members_count, strangers_count = await db_user_stats()
     online_users_count = await get_online_users_count()
+    cache_stats = membership_cache.stats()
     
     text = (
         "**Административное меню**\n\n"
         f"Пользователей онлайн (по всем inbounds): `{online_users_count}`\n"
         f"Членов чата: `{chat_members_count}` | изгоев: `{strangers_count}`\n"
+        f"Кэш членства: `{cache_stats['hits']}` попаданий | `{cache_stats['misses']}` промахов\n"
     )
     
-    builder = InlineKeyboardBuilder()
-    builder.button(text="📋 Список пользователей", callback_data="admin_user_list")
-    builder.button(text="📊 Статистика исп. сети", callback_data="admin_network_stats")
-    builder.button(text="📢 Рассылка", callback_data="admin_send_message")
-    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
-    builder.adjust(2, 1, 1, 1, 1)
-    
-    await callback.message.edit_text(text, reply_markup=builder.as_markup(), parse_mode='Markdown')
+    await callback.message.edit_text(text, reply_markup=ADMIN_PANEL_KEYBOARD, parse_mode='Markdown')
 
 # Обработчики для вывода списка пользователей
 @router.callback_query(F.data == "admin_user_list")
@@ -226,74 +267,171 @@ async def admin_user_list(callback: CallbackQuery):
     builder.adjust(1, 1, 1)
     await callback.message.edit_text("**Выберите фильтр**", reply_markup=builder.as_markup(), parse_mode='Markdown')
 
+async def render_user_list(state: FSMContext, members: bool, after: int = 0, before: int = 0):
+    """
+    Страница списка участников чата или изгоев.
+
+    Строки читаются по курсору telegram_id (after / before), поэтому
+    стоимость страницы не зависит от числа пользователей. Строка поиска
+    хранится в данных FSM администратора.
+    """
+    data = await state.get_data()
+    search = data.get("user_search")
+    rows, has_more = await get_users_page(members, after, before, USER_LIST_PAGE_SIZE, search)
+
+    text = f"👤 <b>{'Члены чата' if members else 'Изгои'}</b>"
+    if search:
+        text += f"\n🔍 Поиск: <code>{escape(search)}</code>"
+    else:
+        _, chat_members_count, strangers_count = await db_user_stats()
+        text += f"\nВсего: <code>{chat_members_count if members else strangers_count}</code>"
+    text += "\n\n"
+    for telegram_id, full_name, username, checked_at in rows:
+        username = f"@{escape(username)}" if username else "none"
+        text += f"• {escape(full_name or '')} ({username} | <code>{telegram_id}</code>)"
+        text += f" · 🕒 {format_age(checked_at)}\n" if members else "\n"
+    if not rows:
+        text += "Никого не найдено"
+
+    # Курсор пришел со страницы, где он был, значит в обратную сторону записи есть
+    has_prev = has_more if before else bool(after)
+    has_next = bool(before) or has_more
+    builder = InlineKeyboardBuilder()
+    navigation = 0
+    if rows and has_prev:
+        builder.button(text="⬅️", callback_data=UserListPage(members=members, before=rows[0].telegram_id))
+        navigation += 1
+    if rows and has_next:
+        builder.button(text="➡️", callback_data=UserListPage(members=members, after=rows[-1].telegram_id))
+        navigation += 1
+    if search:
+        builder.button(text="✖️ Сбросить поиск", callback_data=UserListPage(members=members, action="reset"))
+    else:
+        builder.button(text="🔍 Поиск", callback_data=UserListPage(members=members, action="search"))
+    if members:
+        builder.button(text="🔄 Проверить членство", callback_data="membership_sync_start")
+    builder.button(text="↩️ Назад", callback_data="admin_user_list")
+    builder.adjust(*([navigation] if navigation else []), 1)
+    return text, builder.as_markup()
+
+async def show_user_list(callback: CallbackQuery, state: FSMContext, members: bool,
+                         after: int = 0, before: int = 0):
+    text, reply_markup = await render_user_list(state, members, after, before)
+    await callback.message.edit_text(text, reply_markup=reply_markup, parse_mode="HTML")
+
 @router.callback_query(F.data == "user_list_chat_members")
-async def handle_user_list_chat_members(callback: CallbackQuery, bot: Bot):
+async def handle_user_list_chat_members(callback: CallbackQuery, state: FSMContext):
     """
     Показать список участников чата.
-    Перед выводом список синхронизируется с реальным состоянием чата:
-    пользователи, вышедшие из чата, помечаются как chat_member = False.
+    Список выводится сразу из базы с возрастом последней проверки членства;
+    перепроверка через Telegram запускается отдельной кнопкой в фоне.
     """
-    # Берем текущий список отмеченных как участники
-    users = await get_all_users(chat_member=True)
-    if not users:
-        await callback.answer("Нет членов чата")
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
         return
+    await callback.answer()
+    await state.update_data(user_search=None)
+    await show_user_list(callback, state, members=True)
 
-    # Синхронизируем флаг chat_member с реальным статусом в Telegram
-    has_changes = False
-    with Session() as session:
-        for user in users:
-            is_member = await check_if_user_chat_member(user.telegram_id, bot)
-            if not is_member:
-                db_user = session.query(User).get(user.id)
-                if db_user and db_user.chat_member:
-                    db_user.chat_member = False
-                    has_changes = True
-        if has_changes:
-            session.commit()
-
-    # Повторно запрашиваем только тех, кто действительно остается участником
-    users = await get_all_users(chat_member=True)
-    if not users:
-        await callback.answer("Нет членов чата")
+@router.callback_query(F.data == "membership_sync_start")
+async def membership_sync_start(callback: CallbackQuery, bot: Bot):
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
         return
+    if start_membership_sync(bot, callback.message.chat.id):
+        await callback.answer("🔄 Проверка запущена")
+    else:
+        await callback.answer("ℹ️ Проверка уже идет")
 
-    text = "👤 <b>Члены чата:</b>\n\n"
-    for user in users:
-        username = f"@{user.username}" if user.username else "none"
-        user_line = f"• {user.full_name} ({username} | <code>{user.telegram_id}</code>)\n"
+@router.callback_query(F.data == "membership_sync_cancel")
+async def membership_sync_cancel(callback: CallbackQuery):
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+    if cancel_membership_sync():
+        await callback.answer("⏹ Останавливаем проверку")
+    else:
+        await callback.answer("Проверка не запущена")
 
-        # Если текст становится слишком длинным, отправляем текущую часть и начинаем новую
-        if len(text) + len(user_line) > MAX_MESSAGE_LENGTH:
-            await callback.message.answer(text, parse_mode="HTML")
-            text = "👤 <b>Члены чата (продолжение):</b>\n\n"
+@router.callback_query(F.data == "user_list_not_chat_members")
+async def handle_user_list_not_chat_members(callback: CallbackQuery, state: FSMContext):
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+    await callback.answer()
+    await state.update_data(user_search=None)
+    await show_user_list(callback, state, members=False)
 
-        text += user_line
+@router.callback_query(UserListPage.filter(F.action == "page"))
+async def user_list_page(callback: CallbackQuery, callback_data: UserListPage, state: FSMContext):
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+    await callback.answer()
+    await show_user_list(callback, state, callback_data.members, callback_data.after, callback_data.before)
 
-    # Отправляем оставшуюся часть текста
-    await callback.message.answer(text, parse_mode="HTML")
+@router.callback_query(UserListPage.filter(F.action == "search"))
+async def user_list_search(callback: CallbackQuery, callback_data: UserListPage, state: FSMContext):
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+    await callback.answer()
+    # Список остается одним сообщением: после ввода запроса редактируем его же
+    await state.update_data(
+        user_list_members=callback_data.members,
+        user_list_message_id=callback.message.message_id,
+    )
+    await state.set_state(AdminStates.USER_SEARCH)
+    builder = InlineKeyboardBuilder()
+    builder.button(text="↩️ Отмена", callback_data=UserListPage(members=callback_data.members, action="reset"))
+    await callback.message.edit_text(
+        "🔍 Введите имя, username или ID пользователя",
+        reply_markup=builder.as_markup(),
+    )
 
-@router.callback_query(F.data == "user_list_not_chat_members")
-async def handle_user_list_not_chat_members(callback: CallbackQuery):
-    users = await get_all_users(chat_member=False)
-    if not users:
-        await callback.answer("Нет изгоев")
+@router.callback_query(UserListPage.filter(F.action == "reset"))
+async def user_list_reset(callback: CallbackQuery, callback_data: UserListPage, state: FSMContext):
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
         return
-    
-    text = "👤 <b>Изгои:</b>\n\n"
-    for user in users:
-        username = f"@{user.username}" if user.username else "none"
-        user_line = f"• {user.full_name} ({username} | <code>{user.telegram_id}</code>)\n"
-        
-        # Если текст становится слишком длинным, отправляем текущую часть и начинаем новую
-        if len(text) + len(user_line) > MAX_MESSAGE_LENGTH:
-            await callback.message.answer(text, parse_mode="HTML")
-            text = "👤 <b>Изгои (продолжение):</b>\n\n"
-        
-        text += user_line
-    
-    # Отправляем оставшуюся часть текста
-    await callback.message.answer(text, parse_mode="HTML")
+    await callback.answer()
+    await state.set_state(None)
+    await state.update_data(user_search=None)
+    await show_user_list(callback, state, callback_data.members)
+
+@router.message(AdminStates.USER_SEARCH)
+async def user_list_search_query(message: Message, state: FSMContext, bot: Bot):
+    data = await state.get_data()
+    await state.set_state(None)
+    user = await get_user(message.from_user.id)
+    if not user or not user.is_admin:
+        await message.answer("🛑 Доступ запрещен!")
+        return
+    await state.update_data(user_search=(message.text or "").strip()[:64] or None)
+    text, reply_markup = await render_user_list(state, data["user_list_members"])
+
+    try:
+        await message.delete()
+    except TelegramBadRequest:
+        pass
+    try:
+        await bot.edit_message_text(
+            chat_id=message.chat.id,
+            message_id=data["user_list_message_id"],
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode="HTML",
+        )
+    except TelegramBadRequest:
+        # Исходное сообщение удалено или слишком старое для редактирования
+        await message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
 
 # Обработчики для рассылки сообщений
 @router.callback_query(F.data == "admin_send_message")
@@ -332,24 +470,9 @@ async def admin_send_message(message: Message, state: FSMContext, bot: Bot):
     else:  # all
         users = await get_all_users()
     
-    success = 0
-    failed = 0
-    
-    for user in users:
-        try:
-            await bot.send_message(user.telegram_id, text)
-            success += 1
-        except Exception as e:
-            logger.error(f"🛑 Ошибка отправки сообщения {user.telegram_id}: {e}")
-            failed += 1
-    
-    await message.answer(
-        f"📨 Результаты рассылки:\n\n"
-        f"• Успешно: {success}\n"
-        f"• Не удалось: {failed}\n"
-        f"• Всего: {len(users)}"
-    )
     await state.clear()
+    # Рассылка идет в фоне, прогресс обновляется в отдельном сообщении
+    await start_broadcast(bot, message.chat.id, text, target, [user.telegram_id for user in users])
 
 # Остальные обработчики остаются без изменений
 @router.callback_query(F.data == "static_profiles_menu")
@@ -407,18 +530,16 @@ async def handle_delete_static_profile(callback: CallbackQuery):
     try:
         profile_id = int(callback.data.split("_")[-1])
         
-        with Session() as session:
-            profile = session.query(StaticProfile).filter_by(id=profile_id).first()
-            if not profile:
-                await callback.answer("⚠️ Профиль не найден")
-                return
-            
-            success = await delete_client_by_email(profile.name)
-            if not success:
-                logger.error(f"🛑 Ошибка удаления клиента из инбаунда: {profile.name}")
-            
-            session.delete(profile)
-            session.commit()
+        profile = await get_static_profile(profile_id)
+        if not profile:
+            await callback.answer("⚠️ Профиль не найден")
+            return
+        
+        success = await delete_static_client(profile.name)
+        if not success:
+            logger.error(f"🛑 Ошибка удаления клиента из инбаунда: {profile.name}")
+        
+        await delete_static_profile(profile_id)
         
         await callback.answer("✅ Профиль удален!")
         await callback.message.delete()
@@ -442,11 +563,7 @@ async def connect_profile(callback: CallbackQuery):
         profile_data = await create_vless_profile(user.telegram_id)
         
         if profile_data:
-            with Session() as session:
-                db_user = session.query(User).filter_by(telegram_id=user.telegram_id).first()
-                if db_user:
-                    db_user.vless_profile_data = json.dumps(profile_data)
-                    session.commit()
+            await set_user_profile(user.telegram_id, json.dumps(profile_data), profile_data.get("sub_id"))
             user = await get_user(user.telegram_id)
         else:
             await callback.message.answer("🛑 Ошибка при создании профиля. Попробуйте позже.")
@@ -457,27 +574,30 @@ async def connect_profile(callback: CallbackQuery):
         await callback.message.answer("⚠️ У вас пока нет созданного профиля.")
         return
     vless_url = generate_vless_url(profile_data)
+    subscription = ""
+    if config.SUBSCRIPTION_BASE_URL:
+        if not profile_data.get("sub_id"):
+            # Профили, созданные до появления подписок
+            profile_data["sub_id"] = new_sub_id()
+            await set_user_profile(user.telegram_id, json.dumps(profile_data), profile_data["sub_id"])
+        subscription = (
+            "Или добавьте подписку - приложение будет само получать обновления профиля:\n\n"
+            f"`{subscription_url(profile_data['sub_id'])}`\n\n"
+        )
     text = (
         "🎉 **Ваш VPN профиль готов!**\n\n"
         "ℹ️ **Инструкция по подключению:**\n"
         "1. Скачайте приложение для вашей платформы\n"
         "2. Скопируйте эту ссылку и импортируйте в приложение:\n\n"
         f"`{vless_url}`\n\n"
+        f"{subscription}"
         "3. Добавьте пути [гайд](https://telegra.ph/Nastrojka-marshrutizacii-routing-na-kliente-02-24)\n"
         "4. Активируйте соединение в приложении"
     )
 
-    builder = InlineKeyboardBuilder()
-    builder.button(text='️Windows [Hiddify]', url='https://github.com/hiddify/hiddify-app/releases/download/v4.1.1/Hiddify-Windows-Setup-x64.exe')
-    builder.button(text='Linux [Hiddify]', url='https://github.com/hiddify/hiddify-app/releases')
-    builder.button(text='iOS/macOS [Happ]', url='https://apps.apple.com/ru/app/happ-proxy-utility-plus/id6746188973')
-    builder.button(text='Android [Hiddify]', url='https://play.google.com/store/apps/details?id=app.hiddify.com')
-    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
-    builder.adjust(2, 2, 1)
-
     await callback.message.edit_text(
         text,
-        reply_markup=builder.as_markup(),
+        reply_markup=CLIENT_APPS_KEYBOARD,
         parse_mode='Markdown',
         disable_web_page_preview=True,
     )
@@ -490,53 +610,135 @@ async def user_stats(callback: CallbackQuery):
         return
     await callback.message.edit_text("⚙️ Загружаем вашу статистику...")
     profile_data = safe_json_loads(user.vless_profile_data, default={})
-    stats = await get_user_stats(profile_data["email"])
+    stats = await traffic_monitor.get_client_stats(profile_data["email"])
 
     logger.debug(stats)
-    upload = f"{stats.get('upload', 0) / 1024 / 1024:.2f}"
-    upload_size = 'MB' if int(float(upload)) < 1024 else 'GB'
-    if upload_size == "GB":
-        upload = f"{int(float(upload) / 1024):.2f}"
-
-    download = f"{stats.get('download', 0) / 1024 / 1024:.2f}"
-    download_size = 'MB' if int(float(download)) < 1024 else 'GB'
-    if download_size == "GB":
-        download = f"{int(float(download) / 1024):.2f}"
-
-    await callback.message.delete()
     text = (
         "📊 **Ваша статистика:**\n\n"
-        f"🔼 Загружено: `{upload} {upload_size}`\n"
-        f"🔽 Скачано: `{download} {download_size}`\n"
+        f"🔼 Загружено: `{format_traffic(stats.get('upload', 0))}`\n"
+        f"🔽 Скачано: `{format_traffic(stats.get('download', 0))}`\n"
     )
+    if config.TRAFFIC_HISTORY_ENABLED:
+        text += "\n" + format_periods(await traffic_history.get_periods(profile_data["email"]))
+    text += format_updated_at(stats['updated_at'])
+    await callback.message.delete()
     await callback.message.answer(text, parse_mode='Markdown')
 
 @router.callback_query(F.data == "admin_network_stats")
 async def network_stats(callback: CallbackQuery):
-    stats = await get_global_stats()
-
-    upload = f"{stats.get('upload', 0) / 1024 / 1024:.2f}"
-    upload_size = 'MB' if int(float(upload)) < 1024 else 'GB'
-    if upload_size == "GB":
-        upload = f"{int(float(upload) / 1024):.2f}"
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+    stats = await traffic_monitor.get_inbound_stats()
 
-    download = f"{stats.get('download', 0) / 1024 / 1024:.2f}"
-    download_size = 'MB' if int(float(download)) < 1024 else 'GB'
-    if download_size == "GB":
-        download = f"{int(float(download) / 1024):.2f}"
-    
     await callback.answer()
     text = (
         "📊 **Статистика использования сети:**\n\n"
-        f"🔼 Upload: `{upload} {upload_size}` | 🔽 Download: `{download} {download_size}`"
+        f"🔼 Upload: `{format_traffic(stats.get('upload', 0))}` | "
+        f"🔽 Download: `{format_traffic(stats.get('download', 0))}`\n"
     )
+    if config.TRAFFIC_HISTORY_ENABLED:
+        text += "\n" + format_periods(await traffic_history.get_periods())
+        top = await traffic_history.get_top(config.TRAFFIC_TOP_LIMIT)
+        if top:
+            text += f"**Больше всего трафика {TOP_PERIOD[0]}:**\n"
+            for place, (email, up, down) in enumerate(top, start=1):
+                text += f"{place}. `{email}` - `{format_traffic(up + down)}`\n"
+            text += "\n"
+    text += format_updated_at(stats['updated_at'])
     await callback.message.edit_text(text, parse_mode='Markdown')
 
+def format_analytics(report) -> str:
+    """Отчет аналитики трафика для администратора"""
+    if not report.clients:
+        return "📈 Данных о трафике клиентов пока нет"
+
+    text = (
+        "📈 **Аналитика трафика:**\n\n"
+        f"Клиентов: `{report.clients}` | всего: `{format_traffic(report.total)}`\n"
+        "Трафик на клиента: " + " | ".join(
+            f"p{p} `{format_traffic(value)}`" for p, value in report.percentiles.items()
+        ) + "\n"
+        "Скорость за интервал опроса: " + " | ".join(
+            f"p{p} `{format_traffic(value)}/s`" for p, value in report.rate_percentiles.items()
+        ) + "\n\n"
+        f"**Top {len(report.top)} по трафику:**\n"
+    )
+    for place, (email, total) in enumerate(report.top, start=1):
+        text += f"{place}. `{email}` - `{format_traffic(total)}`\n"
+
+    if report.flagged:
+        text += f"\n⚠️ **Аномальная скорость ({len(report.flagged)}):**\n"
+        for email, rate, peak, score in report.flagged[:config.TRAFFIC_TOP_LIMIT]:
+            if peak:
+                text += f"• `{email}` - `{format_traffic(rate)}/s` (x{rate / peak:.0f} к пику за сутки)\n"
+            else:
+                text += f"• `{email}` - `{format_traffic(rate)}/s` (нет истории, z = {score:.1f})\n"
+        if len(report.flagged) > config.TRAFFIC_TOP_LIMIT:
+            text += f"...и еще {len(report.flagged) - config.TRAFFIC_TOP_LIMIT}\n"
+    else:
+        text += "\n✅ Аномалий скорости не найдено\n"
+
+    text += f"\n{format_updated_at(traffic_monitor.updated_at)}"
+    return text
+
+@router.message(Command("analytics"))
+async def analytics_cmd(message: Message):
+    user = await get_user(message.from_user.id)
+    if not user or not user.is_admin:
+        await message.answer("🛑 Доступ запрещен!")
+        return
+    report = await get_traffic_report(config.TRAFFIC_TOP_LIMIT)
+    await message.answer(format_analytics(report), parse_mode='Markdown')
+
+@router.callback_query(F.data == "admin_analytics")
+async def admin_analytics(callback: CallbackQuery):
+    user = await get_user(callback.from_user.id)
+    if not user or not user.is_admin:
+        await callback.answer("🛑 Доступ запрещен!")
+        return
+    await callback.answer()
+    report = await get_traffic_report(config.TRAFFIC_TOP_LIMIT)
+    await callback.message.edit_text(format_analytics(report), parse_mode='Markdown')
+
 @router.callback_query(F.data == "back_to_menu")
 async def back_to_menu(callback: CallbackQuery, bot: Bot):
     await callback.answer()
     await show_menu(bot, callback.from_user.id, callback.message.message_id)
 
+# Обработчики изменений членства в чате. Dispatcher подписывается на
+# chat_member / my_chat_member автоматически по зарегистрированным хендлерам,
+# но события приходят, только если бот - администратор чата.
+@router.chat_member(F.chat.id == config.CHAT_ID)
+async def on_chat_member_update(event: ChatMemberUpdated, bot: Bot):
+    telegram_id = event.new_chat_member.user.id
+    is_member = event.new_chat_member.status in MEMBER_STATUSES
+    membership_cache.set(telegram_id, is_member)
+    user = await get_user(telegram_id)
+    if not user:
+        return
+
+    await mark_membership_checked([telegram_id])
+    if user.chat_member != is_member:
+        await set_chat_member([telegram_id], is_member)
+        logger.info(f"🔄 Chat membership changed for {telegram_id}: {is_member}")
+
+    # Вышедший из чата пользователь теряет профиль сразу, не дожидаясь ревизии
+    if not is_member and user.vless_profile_data:
+        await revoke_profiles(bot, [user])
+
+@router.my_chat_member(F.chat.id == config.CHAT_ID)
+async def on_bot_chat_member_update(event: ChatMemberUpdated):
+    status = event.new_chat_member.status
+    if status == "administrator":
+        logger.info("✅ Bot is an administrator of the chat, membership updates enabled")
+    else:
+        logger.warning(
+            f"⚠️ Bot status in the chat changed to {status}: chat_member updates "
+            f"will not be delivered, relying on the periodic audit"
+        )
+
 def setup_handlers(dp: Dispatcher):
     dp.include_router(router)
     logger.info("✅ Handlers setup completed")
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config import config
+from database import (
+    add_traffic_samples, get_traffic_counters, save_traffic_counters, get_traffic_totals, get_top_traffic,
+    get_peak_traffic, compact_traffic_history,
+)
+from storage import locks, LeaseLostError
+from traffic import TrafficMonitor, traffic_monitor
+
+logger = logging.getLogger(__name__)
+
+MINUTE, HOUR, DAY = 60, 3600, 86400
+RESOLUTIONS = (MINUTE, HOUR, DAY)
+
+# Периоды экранов статистики: подпись, длина агрегата и число агрегатов.
+# Последний агрегат - текущий, еще не закончившийся интервал
+PERIODS = (
+    ("За час", MINUTE, 60),
+    ("За сутки", HOUR, 24),
+    ("За 7 дней", DAY, 7),
+    ("За 30 дней", DAY, 30),
+)
+TOP_PERIOD = ("за 7 дней", DAY, 7)
+# Полные часы, по которым считается обычная пиковая скорость клиента
+PEAK_RATE_HOURS = 24
+
+COMPACT_INTERVAL = 3600
+HISTORY_LEASE_TTL = 300
+
+def period_start(resolution: int, buckets: int, now: Optional[float] = None) -> int:
+    """Начало первого из последних `buckets` интервалов длины resolution"""
+    now = int(time.time() if now is None else now)
+    return now - now % resolution - (buckets - 1) * resolution
+
+class TrafficHistory:
+    """
+    Per-client traffic history built from TrafficMonitor snapshots.
+
+    Each new snapshot is compared with the previous one and the non-zero
+    per-client deltas are appended to `traffic_samples` and added to the
+    minute, hour and day rollups in `traffic_rollups`. Stats screens read
+    the rollups only. Samples and rollups older than their retention are
+    deleted hourly.
+
+    The panel counters the deltas were computed from are saved in
+    `traffic_counters` together with the samples, so after a restart or a
+    lease handoff the traffic in between is attributed to the first new
+    snapshot. A client without a saved counter is new and all of its
+    traffic counts. Only when `traffic_counters` is empty (the first start
+    with history enabled) does the first snapshot just set the baseline.
+    With several bot processes only the holder of the history lease
+    records.
+    """
+
+    def __init__(self, monitor: TrafficMonitor):
+        self.monitor = monitor
+        self._totals: Dict[str, Tuple[int, int]] = {}
+        self._loaded = False
+        self._compacted_at = 0.0
+        self._peak_rates: Optional[Tuple[int, Dict[str, float]]] = None
+
+    def _deltas(self, clients: Dict[str, dict]) -> Dict[str, Tuple[int, int]]:
+        deltas = {}
+        for email, stats in clients.items():
+            up, down = stats.get("upload", 0), stats.get("download", 0)
+            # Нового клиента считаем с нуля, как после сброса счетчиков
+            previous_up, previous_down = self._totals.get(email, (0, 0))
+            # Сброс счетчиков в панели: весь текущий счетчик - новый трафик
+            delta_up = up - previous_up if up >= previous_up else up
+            delta_down = down - previous_down if down >= previous_down else down
+            if delta_up or delta_down:
+                deltas[email] = (delta_up, delta_down)
+                self._totals[email] = (up, down)
+        return deltas
+
+    async def record(self, now: Optional[float] = None) -> int:
+        """Запись приростов с прошлого снимка. Возвращает число клиентов с трафиком"""
+        if not self._loaded:
+            self._totals = await get_traffic_counters()
+            self._loaded = True
+            if not self._totals:
+                # Счетчики еще не сохранялись: текущий снимок - только база
+                self._deltas(self.monitor.clients)
+                await save_traffic_counters(self._totals)
+                return 0
+        deltas = self._deltas(self.monitor.clients)
+        try:
+            await add_traffic_samples(
+                int(time.time() if now is None else now), deltas, RESOLUTIONS,
+                {email: self._totals[email] for email in deltas},
+            )
+        except Exception:
+            # Приросты не записаны: в следующий раз считаем от сохраненных счетчиков
+            self._loaded = False
+            raise
+        return len(deltas)
+
+    async def compact(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        removed = await compact_traffic_history(
+            int(now - config.TRAFFIC_SAMPLE_RETENTION * DAY),
+            {
+                MINUTE: int(now - config.TRAFFIC_MINUTE_RETENTION * DAY),
+                HOUR: int(now - config.TRAFFIC_HOUR_RETENTION * DAY),
+                DAY: int(now - config.TRAFFIC_DAY_RETENTION * DAY),
+            },
+        )
+        if removed:
+            logger.info(f"✅ Traffic history compacted: {removed} rows removed")
+        return removed
+
+    async def get_periods(self, email: Optional[str] = None) -> List[Tuple[str, int, int]]:
+        """Трафик клиента (или всей сети без email) по периодам: (подпись, up, down)"""
+        totals = await get_traffic_totals(
+            [(resolution, period_start(resolution, buckets)) for _, resolution, buckets in PERIODS], email,
+        )
+        return [(label, up, down) for (label, _, _), (up, down) in zip(PERIODS, totals)]
+
+    async def get_top(self, limit: int) -> list:
+        _, resolution, buckets = TOP_PERIOD
+        return await get_top_traffic(resolution, period_start(resolution, buckets), limit)
+
+    async def get_peak_rates(self) -> Dict[str, float]:
+        """
+        Наибольшая часовая скорость каждого клиента за PEAK_RATE_HOURS
+        последних полных часов, байт/с. Текущий час не входит, поэтому
+        результат меняется раз в час и до тех пор запоминается.
+        """
+        current = period_start(HOUR, 1)
+        if self._peak_rates is None or self._peak_rates[0] != current:
+            peaks = await get_peak_traffic(HOUR, current - PEAK_RATE_HOURS * HOUR, current)
+            self._peak_rates = (current, {email: total / HOUR for email, total in peaks.items()})
+        return self._peak_rates[1]
+
+    async def _sample(self):
+        while True:
+            await self.monitor.snapshot_updated.wait()
+            self.monitor.snapshot_updated.clear()
+            try:
+                await self.record()
+                if time.monotonic() - self._compacted_at >= COMPACT_INTERVAL:
+                    await self.compact()
+                    self._compacted_at = time.monotonic()
+            except Exception as e:
+                logger.warning(f"⚠️ Traffic history error: {e}")
+
+    async def run(self):
+        """Фоновая запись истории трафика"""
+        while True:
+            try:
+                async with locks.lease("traffic_history", HISTORY_LEASE_TTL) as acquired:
+                    if acquired:
+                        await self._sample()
+            except LeaseLostError as e:
+                logger.warning(f"⚠️ Traffic history stopped: {e}")
+            except Exception as e:
+                logger.warning(f"⚠️ Traffic history lease error: {e}")
+            # История пишется в другом процессе: сменим его, если он остановится,
+            # и продолжим от сохраненных им счетчиков
+            self._loaded = False
+            await asyncio.sleep(HISTORY_LEASE_TTL)
+
+traffic_history = TrafficHistory(traffic_monitor)
@@ -0,0 +1,173 @@
+import asyncio
+import logging
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from config import config
+from database import get_users_page, set_chat_member, mark_membership_checked, get_user_stats
+from functions import check_if_user_chat_member
+from ratelimit import TokenBucket
+from storage import locks
+
+logger = logging.getLogger(__name__)
+
+# Участники читаются по курсору порциями, результаты записываются каждые
+# FLUSH_SIZE проверок
+CHUNK_SIZE = 500
+FLUSH_SIZE = 50
+PROGRESS_INTERVAL = 5
+# Та же аренда, что у периодической ревизии: обе проверяют членство
+# через getChatMember и не должны делить лимит Telegram
+SYNC_LEASE_NAME = "audit"
+SYNC_LEASE_TTL = 300
+
+_task: Optional[asyncio.Task] = None
+
+class MembershipSyncJob:
+    """
+    Background re-verification of everyone marked as a chat member.
+
+    Members are read by telegram_id cursor and checked by AUDIT_CONCURRENCY
+    workers sharing an AUDIT_RATE limiter. Confirmed checks update
+    `membership_checked_at`, confirmed leavers lose the chat_member flag.
+    Progress is reported by editing the admin's status message, which also
+    carries the cancel button.
+    """
+
+    def __init__(self, bot: Bot, admin_chat_id: int, status_message_id: int):
+        self.bot = bot
+        self.admin_chat_id = admin_chat_id
+        self.status_message_id = status_message_id
+        self.limiter = TokenBucket(config.AUDIT_RATE)
+        self.total = 0
+        self.checked = 0
+        self.left = 0
+        self.failed = 0
+        self._confirmed = []
+        self._left = []
+
+    async def run(self):
+        _, self.total, _ = await get_user_stats()
+        progress_task = asyncio.create_task(self._report_progress())
+        status = "cancelled"
+        try:
+            after_id = 0
+            while True:
+                rows, has_more = await get_users_page(True, after_id, limit=CHUNK_SIZE)
+                if rows:
+                    after_id = rows[-1].telegram_id
+                    await self._check_chunk(rows)
+                if not has_more:
+                    break
+            status = "done"
+        finally:
+            progress_task.cancel()
+            # Сохраняем уже проверенное и при отмене
+            await asyncio.shield(self._flush())
+            await asyncio.shield(self._edit_status(status))
+
+    async def _check_chunk(self, rows):
+        pending = iter(rows)
+
+        async def worker():
+            for row in pending:
+                is_member = await check_if_user_chat_member(row.telegram_id, self.bot, self.limiter)
+                if is_member is None:
+                    self.failed += 1
+                    continue
+                self.checked += 1
+                self._confirmed.append(row.telegram_id)
+                if not is_member:
+                    self.left += 1
+                    self._left.append(row.telegram_id)
+                if len(self._confirmed) >= FLUSH_SIZE:
+                    # Отмена не должна терять уже забранную из буфера порцию
+                    await asyncio.shield(self._flush())
+
+        await asyncio.gather(*(worker() for _ in range(max(1, config.AUDIT_CONCURRENCY))))
+
+    async def _flush(self):
+        confirmed, self._confirmed = self._confirmed, []
+        left, self._left = self._left, []
+        if confirmed:
+            await mark_membership_checked(confirmed)
+        await set_chat_member(left, False)
+
+    async def _report_progress(self):
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            await self._edit_status()
+
+    async def _edit_status(self, status: str = "running"):
+        title = {
+            "running": "⏳ Идет проверка членства...",
+            "done": "✅ Проверка членства завершена",
+            "cancelled": "⏹ Проверка членства остановлена",
+        }[status]
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.admin_chat_id,
+                message_id=self.status_message_id,
+                text=(
+                    f"{title}\n\n"
+                    f"• Проверено: {self.checked + self.failed} из {self.total}\n"
+                    f"• Вышли из чата: {self.left}\n"
+                    f"• Не удалось проверить: {self.failed}"
+                ),
+                reply_markup=cancel_keyboard() if status == "running" else None,
+            )
+        except TelegramBadRequest as e:
+            # "message is not modified" - прогресс не изменился с прошлого раза
+            logger.debug(f"⚙️ Membership sync status not edited: {e}")
+        except Exception as e:
+            logger.warning(f"⚠️ Membership sync status update error: {e}")
+
+def cancel_keyboard() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⏹ Остановить", callback_data="membership_sync_cancel")
+    return builder.as_markup()
+
+def is_running() -> bool:
+    return _task is not None and not _task.done()
+
+async def _run_job(bot: Bot, admin_chat_id: int):
+    try:
+        status_message = await bot.send_message(
+            admin_chat_id, "⏳ Проверка членства запущена...", reply_markup=cancel_keyboard(),
+        )
+        job = MembershipSyncJob(bot, admin_chat_id, status_message.message_id)
+        async with locks.lease(SYNC_LEASE_NAME, SYNC_LEASE_TTL) as acquired:
+            if not acquired:
+                await bot.edit_message_text(
+                    chat_id=admin_chat_id,
+                    message_id=status_message.message_id,
+                    text="ℹ️ Сейчас идет ревизия пользователей, попробуйте позже",
+                )
+                return
+            await job.run()
+        logger.info(
+            f"✅ Membership sync finished: {job.checked} checked, "
+            f"{job.left} left, {job.failed} failed"
+        )
+    except asyncio.CancelledError:
+        logger.info("ℹ️  Membership sync cancelled")
+    except Exception as e:
+        logger.error(f"🛑 Membership sync error: {e}")
+
+def start_membership_sync(bot: Bot, admin_chat_id: int) -> bool:
+    """Запуск проверки членства в фоне; False, если она уже идет"""
+    global _task
+    if is_running():
+        return False
+    _task = asyncio.create_task(_run_job(bot, admin_chat_id))
+    return True
+
+def cancel_membership_sync() -> bool:
+    if not is_running():
+        return False
+    _task.cancel()
+    return True
@@ -0,0 +1,103 @@
+import asyncio
+import functools
+import logging
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Dispatcher
+from aiogram.types import TelegramObject
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+from tracing import trace
+
+logger = logging.getLogger(__name__)
+
+XUI_CALL_SECONDS = Histogram(
+    "xui_api_call_seconds", "Duration of XUIAPI method calls", ["server", "method"],
+)
+XUI_LOGINS = Counter(
+    "xui_login_attempts_total", "Logins to the 3x-ui panel", ["server", "result"],
+)
+MEMBERSHIP_FLOOD_RETRIES = Counter(
+    "membership_check_flood_retries_total", "getChatMember calls hit by flood control",
+)
+BROADCAST_MESSAGES = Counter(
+    "broadcast_messages_total", "Broadcast send attempts", ["result"],  # sent | failed | flood_retry
+)
+SUBSCRIPTION_REQUESTS = Counter(
+    "subscription_requests_total", "Subscription endpoint requests", ["result"],  # ok | not_modified | not_found
+)
+HANDLER_SECONDS = Histogram(
+    "bot_handler_seconds", "Duration of update handlers", ["handler"],
+)
+HANDLER_UPDATES = Counter(
+    "bot_handler_updates_total", "Updates processed by handlers", ["handler", "result"],
+)
+AUDIT_DURATION = Gauge(
+    "audit_duration_seconds", "Duration of the last membership audit pass",
+)
+AUDIT_LAST_FINISHED = Gauge(
+    "audit_last_finished_timestamp_seconds", "Unix time the last membership audit finished",
+)
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds", "How late the event loop wakes up a sleeping task",
+)
+
+def observe_xui(method: Callable[..., Awaitable[Any]]):
+    """Гистограмма длительности и участок трассировки для метода XUIAPI"""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            with trace(f"xui.{method.__name__}"):
+                return await method(self, *args, **kwargs)
+        finally:
+            XUI_CALL_SECONDS.labels(self.server.name, method.__name__).observe(time.perf_counter() - started)
+    return wrapper
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Длительность и число апдейтов по обработчикам"""
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        result = "error"
+        try:
+            response = await handler(event, data)
+            result = "ok"
+            return response
+        finally:
+            HANDLER_SECONDS.labels(name).observe(time.perf_counter() - started)
+            HANDLER_UPDATES.labels(name, result).inc()
+
+def setup_metrics(dp: Dispatcher):
+    """
+    Подключение метрик обработчиков.
+
+    Внутренние middleware родительского роутера применяются и ко вложенным,
+    поэтому достаточно зарегистрировать их на диспетчере.
+    """
+    middleware = HandlerMetricsMiddleware()
+    for observer in dp.observers.values():
+        if observer.event_name not in ("update", "error"):
+            observer.middleware(middleware)
+
+async def monitor_event_loop_lag(interval: float = 1.0):
+    """Фоновое измерение задержки event loop"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        EVENT_LOOP_LAG.set(max(time.perf_counter() - started - interval, 0.0))
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    response = web.Response(body=generate_latest())
+    response.content_type = CONTENT_TYPE_LATEST.split(";")[0]
+    response.charset = "utf-8"
+    return response
@@ -0,0 +1,79 @@
+import logging
+from typing import Optional
+
+from config import config
+from functions import get_api, delete_client_by_email
+from traffic import Placement, traffic_monitor
+
+logger = logging.getLogger(__name__)
+
+def choose_placement() -> Placement:
+    """
+    Least-loaded inbound of the pool for a new client.
+
+    The load is a weighted sum of the inbound's client count and its recent
+    traffic rate, each normalized by the pool maximum. Inbounds missing from
+    the traffic snapshot (their panel did not answer) are skipped; ties go
+    to the inbound listed first in XUI_SERVERS.
+    """
+    loads = {
+        placement: traffic_monitor.inbounds[placement]
+        for placement in traffic_monitor.placements
+        if placement in traffic_monitor.inbounds
+    }
+    if not loads:
+        return traffic_monitor.placements[0]
+
+    max_clients = max(load["clients"] for load in loads.values()) or 1
+    max_rate = max(load["rate"] for load in loads.values()) or 1
+    weight = min(max(config.PLACEMENT_TRAFFIC_WEIGHT, 0.0), 1.0)
+
+    def score(placement: Placement) -> float:
+        load = loads[placement]
+        return (1 - weight) * load["clients"] / max_clients + weight * load["rate"] / max_rate
+
+    return min(loads, key=score)
+
+async def _create_client(create, label: str):
+    await traffic_monitor.ensure_snapshot()
+    placement = choose_placement()
+    traffic_monitor.reserve(placement)
+    server_name, inbound_id = placement
+    logger.info(f"ℹ️  Placing {label} on inbound {inbound_id} of {server_name}")
+    profile_data = None
+    try:
+        profile_data = await create(get_api(server_name), inbound_id)
+    finally:
+        if profile_data:
+            traffic_monitor.record_client(placement, profile_data["email"])
+        else:
+            traffic_monitor.reserve(placement, -1)
+    return profile_data
+
+async def create_vless_profile(telegram_id: int):
+    """Создание клиента пользователя на наименее загруженном инбаунде пула"""
+    return await _create_client(
+        lambda api, inbound_id: api.create_vless_profile(telegram_id, inbound_id),
+        f"client of {telegram_id}",
+    )
+
+async def create_static_client(profile_name: str):
+    """Создание статического клиента на наименее загруженном инбаунде пула"""
+    return await _create_client(
+        lambda api, inbound_id: api.create_static_client(profile_name, inbound_id),
+        f"static client {profile_name}",
+    )
+
+async def delete_static_client(profile_name: str) -> bool:
+    """
+    Удаление статического клиента.
+
+    В БД статический профиль хранится только как ссылка, поэтому инбаунд
+    клиента определяется по снимку трафика.
+    """
+    await traffic_monitor.ensure_snapshot()
+    placement: Optional[Placement] = traffic_monitor.locate(profile_name)
+    if placement is None:
+        return await delete_client_by_email(profile_name)
+    server_name, inbound_id = placement
+    return await delete_client_by_email(profile_name, server=server_name, inbound_id=inbound_id)
@@ -0,0 +1,102 @@
+import asyncio
+import logging
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+from config import config
+from functions import get_chat_name
+
+logger = logging.getLogger(__name__)
+
+def _build_menu_keyboard(is_admin: bool) -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="✅ Подключить", callback_data="connect")
+    builder.button(text="📊 Статистика", callback_data="stats")
+    builder.button(text="ℹ️ Помощь", callback_data="help")
+
+    if is_admin:
+        builder.button(text="⚠️ Админ. меню", callback_data="admin_menu")
+
+    builder.adjust(2, 2, 1)
+    return builder.as_markup()
+
+def _build_back_keyboard() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
+    return builder.as_markup()
+
+def _build_admin_menu_keyboard() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text="📋 Список пользователей", callback_data="admin_user_list")
+    builder.button(text="📊 Статистика исп. сети", callback_data="admin_network_stats")
+    builder.button(text="📢 Рассылка", callback_data="admin_send_message")
+    builder.button(text="📈 Аналитика трафика", callback_data="admin_analytics")
+    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
+    builder.adjust(2, 1, 1, 1, 1)
+    return builder.as_markup()
+
+def _build_client_apps_keyboard() -> InlineKeyboardMarkup:
+    builder = InlineKeyboardBuilder()
+    builder.button(text='️Windows [Hiddify]', url='https://github.com/hiddify/hiddify-app/releases/download/v4.1.1/Hiddify-Windows-Setup-x64.exe')
+    builder.button(text='Linux [Hiddify]', url='https://github.com/hiddify/hiddify-app/releases')
+    builder.button(text='iOS/macOS [Happ]', url='https://apps.apple.com/ru/app/happ-proxy-utility-plus/id6746188973')
+    builder.button(text='Android [Hiddify]', url='https://play.google.com/store/apps/details?id=app.hiddify.com')
+    builder.button(text="⬅️ Назад", callback_data="back_to_menu")
+    builder.adjust(2, 2, 1)
+    return builder.as_markup()
+
+# Клавиатуры не зависят от пользователя и собираются один раз
+USER_MENU_KEYBOARD = _build_menu_keyboard(is_admin=False)
+ADMIN_MENU_KEYBOARD = _build_menu_keyboard(is_admin=True)
+BACK_TO_MENU_KEYBOARD = _build_back_keyboard()
+ADMIN_PANEL_KEYBOARD = _build_admin_menu_keyboard()
+CLIENT_APPS_KEYBOARD = _build_client_apps_keyboard()
+
+def menu_keyboard(is_admin: bool) -> InlineKeyboardMarkup:
+    return ADMIN_MENU_KEYBOARD if is_admin else USER_MENU_KEYBOARD
+
+class PresentationCache:
+    """
+    Bot identity and chat title shared by the handlers.
+
+    Both are fetched at startup and refreshed every
+    PRESENTATION_REFRESH_INTERVAL seconds, so greetings and the help screen
+    need no Bot API calls. Until the first successful fetch they are
+    requested on demand.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.bot_name: Optional[str] = None
+        self.chat_name: Optional[str] = None
+
+    async def refresh(self, bot: Bot) -> bool:
+        try:
+            me = await bot.get_me()
+            chat_name = await get_chat_name(bot, config.CHAT_ID)
+        except Exception as e:
+            logger.warning(f"⚠️ Bot identity refresh error: {e}")
+            return False
+        self.bot_name, self.chat_name = me.full_name, chat_name
+        return True
+
+    async def get_bot_name(self, bot: Bot) -> str:
+        if self.bot_name is None:
+            self.bot_name = (await bot.get_me()).full_name
+        return self.bot_name
+
+    async def get_chat_name(self, bot: Bot) -> str:
+        if self.chat_name is None:
+            self.chat_name = await get_chat_name(bot, config.CHAT_ID)
+        return self.chat_name
+
+    async def run(self, bot: Bot):
+        """Фоновое обновление имени бота и названия чата"""
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.refresh(bot)
+
+presentation = PresentationCache(config.PRESENTATION_REFRESH_INTERVAL)
@@ -0,0 +1,43 @@
+import asyncio
+import time
+from typing import Optional
+
+class TokenBucket:
+    """
+    Asyncio token bucket.
+
+    Allows `rate` operations per second with bursts of up to `capacity`.
+    `pause()` blocks every waiter for a while, e.g. after Telegram answers
+    with flood control (retry_after).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, tokens: float = 1):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self._tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        # Пополнение начинается после паузы, а не копится за ее время
+        self._tokens = 0
+        self._updated = self._paused_until
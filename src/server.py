@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import hashlib
+import signal
+from typing import Any, Awaitable, Callable, Dict
+
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.types import TelegramObject
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+from config import config
+from metrics import metrics_handler
+from subscription import subscription_handler
+
+logger = logging.getLogger(__name__)
+
+# Сколько ждать обработки уже принятых апдейтов при остановке
+SHUTDOWN_TIMEOUT = 30
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Ограничение числа одновременно обрабатываемых апдейтов"""
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+        self._active = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        self._active += 1
+        self._idle.clear()
+        try:
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._active -= 1
+            if not self._active:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float) -> bool:
+        """Дождаться завершения всех обрабатываемых апдейтов"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+def create_web_app() -> web.Application:
+    """Встроенный HTTP сервер бота"""
+    app = web.Application()
+    if config.METRICS_ENABLED:
+        app.router.add_get(config.METRICS_PATH, metrics_handler)
+    if config.SUBSCRIPTION_BASE_URL:
+        app.router.add_get(f"{config.SUBSCRIPTION_PATH}/{{sub_id}}", subscription_handler)
+    return app
+
+async def start_web_app(app: web.Application) -> web.AppRunner:
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, config.WEB_SERVER_HOST, config.WEB_SERVER_PORT)
+    await site.start()
+    logger.info(f"✅ Web server listening on {config.WEB_SERVER_HOST}:{config.WEB_SERVER_PORT}")
+    return runner
+
+async def wait_for_shutdown():
+    """Ожидание SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    await stop.wait()
+    logger.info("👋 Stopping bot...")
+
+def webhook_secret() -> str:
+    """
+    Секрет вебхука: WEBHOOK_SECRET или, если он не задан, производный от
+    BOT_TOKEN. Секрет должен совпадать во всех процессах бота: каждый из
+    них заново регистрирует вебхук, а Telegram присылает только последний.
+    """
+    if config.WEBHOOK_SECRET:
+        return config.WEBHOOK_SECRET
+    return hashlib.sha256(f"webhook:{config.BOT_TOKEN}".encode()).hexdigest()
+
+async def run_webhook(dp: Dispatcher, bot: Bot, app: web.Application):
+    """
+    Прием апдейтов через вебхук вместо long polling.
+
+    Запросы Telegram проверяются по заголовку X-Telegram-Bot-Api-Secret-Token,
+    обработка идет в фоне с ограничением UPDATE_CONCURRENCY. При остановке
+    сервер дожидается обработки уже принятых апдейтов.
+    """
+    secret_token = webhook_secret()
+    limiter = ConcurrencyLimitMiddleware(config.UPDATE_CONCURRENCY)
+    dp.update.outer_middleware(limiter)
+
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=secret_token,
+        handle_in_background=True,
+    ).register(app, path=config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = await start_web_app(app)
+    try:
+        webhook_url = f"{config.WEBHOOK_URL.rstrip('/')}{config.WEBHOOK_PATH}"
+        await bot.set_webhook(
+            webhook_url,
+            secret_token=secret_token,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+        )
+        logger.info(f"✅ Webhook set to {webhook_url}")
+        await wait_for_shutdown()
+    finally:
+        # Вебхук не удаляем: Telegram придержит апдейты до перезапуска
+        if not await limiter.wait_idle(SHUTDOWN_TIMEOUT):
+            logger.warning("⚠️ Some updates were still being processed at shutdown")
+        await runner.cleanup()
@@ -0,0 +1,163 @@
+import asyncio
+import json
+import logging
+import os
+import socket
+import uuid
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import config
+from database import get_fsm_record, save_fsm_record, acquire_lease, release_lease
+
+logger = logging.getLogger(__name__)
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM storage in the bot database.
+
+    Lets several bot processes on one host share FSM state, so an admin's
+    dialog keeps working whichever worker receives the next update.
+    """
+
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        value = state.state if isinstance(state, State) else state
+        await save_fsm_record(self.key_builder.build(key), state=value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = await get_fsm_record(self.key_builder.build(key))
+        return record.state if record else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await save_fsm_record(self.key_builder.build(key), data=json.dumps(dict(data)))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = await get_fsm_record(self.key_builder.build(key))
+        return json.loads(record.data) if record and record.data else {}
+
+    async def close(self) -> None:
+        pass
+
+def create_fsm_storage() -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE: memory | sqlite | redis"""
+    if config.FSM_STORAGE == "sqlite":
+        return SQLiteStorage()
+    if config.FSM_STORAGE == "redis":
+        # redis - необязательная зависимость, нужна только для этого режима
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(config.REDIS_URL)
+    return MemoryStorage()
+
+class LocalLocks:
+    """Блокировки в пределах одного процесса"""
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    async def acquire(self, name: str, ttl: float, wait: float = 0) -> bool:
+        lock = self._locks.setdefault(name, asyncio.Lock())
+        if lock.locked() and not wait:
+            return False
+        try:
+            await asyncio.wait_for(lock.acquire(), wait or None)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def renew(self, name: str, ttl: float) -> bool:
+        return True
+
+    async def release(self, name: str):
+        lock = self._locks.get(name)
+        if lock and lock.locked():
+            lock.release()
+
+class SQLiteLocks:
+    """
+    Блокировки-аренды в общей базе SQLite.
+
+    Срок аренды продлевается, пока владелец работает; если процесс упал,
+    блокировка освобождается сама через ttl секунд.
+    """
+
+    def __init__(self):
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    async def acquire(self, name: str, ttl: float, wait: float = 0) -> bool:
+        deadline = asyncio.get_running_loop().time() + wait
+        while True:
+            if await acquire_lease(name, self.owner, ttl):
+                return True
+            if asyncio.get_running_loop().time() >= deadline:
+                return False
+            await asyncio.sleep(config.LOCK_POLL_INTERVAL)
+
+    async def renew(self, name: str, ttl: float) -> bool:
+        return await acquire_lease(name, self.owner, ttl)
+
+    async def release(self, name: str):
+        await release_lease(name, self.owner)
+
+class LeaseLostError(Exception):
+    """Аренда потеряна, пока работал защищенный ею блок"""
+
+class LockManager:
+    def __init__(self, backend):
+        self.backend = backend
+
+    @asynccontextmanager
+    async def lease(self, name: str, ttl: float, wait: float = 0):
+        """
+        Захват блокировки на время блока `async with`.
+
+        Аренда продлевается в фоне. Если ее перехватил другой процесс или
+        продлить ее не удается до истечения срока, задача, выполняющая
+        блок, отменяется, а из `async with` выходит LeaseLostError.
+
+        Yields:
+            bool: удалось ли захватить блокировку за `wait` секунд.
+        """
+        if not await self.backend.acquire(name, ttl, wait):
+            yield False
+            return
+        holder = asyncio.current_task()
+        renew_task = asyncio.create_task(self._keep_alive(name, ttl, holder))
+        try:
+            yield True
+        except asyncio.CancelledError:
+            # Отмену от _keep_alive превращаем в LeaseLostError, чужую пропускаем
+            lost = renew_task.done() and not renew_task.cancelled() and renew_task.result()
+            if lost and holder.uncancel() == 0:
+                raise LeaseLostError(f"Lease {name} was lost") from None
+            raise
+        finally:
+            renew_task.cancel()
+            await self.backend.release(name)
+
+    async def _keep_alive(self, name: str, ttl: float, holder: asyncio.Task) -> bool:
+        """Продление аренды; True, если она потеряна и holder отменен"""
+        loop = asyncio.get_running_loop()
+        renewed_at = loop.time()
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if await self.backend.renew(name, ttl):
+                    renewed_at = loop.time()
+                    continue
+                logger.warning(f"⚠️ Lease {name} was lost")
+            except Exception as e:
+                logger.warning(f"⚠️ Lease {name} renew error: {e}")
+                # Повторяем, пока аренда точно не истечет до следующей попытки
+                if loop.time() + ttl / 3 < renewed_at + ttl:
+                    continue
+            holder.cancel()
+            return True
+
+locks = LockManager(SQLiteLocks() if config.LOCK_BACKEND == "sqlite" else LocalLocks())
@@ -0,0 +1,89 @@
+import base64
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from typing import Dict, Optional
+
+from aiohttp import web
+
+from config import config
+from database import get_all_users, get_user_by_sub_id
+from functions import generate_vless_url
+from metrics import SUBSCRIPTION_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class SubscriptionEntry:
+    profile_data: str  # vless_profile_data, из которого собрано тело
+    body: bytes
+    etag: str
+
+def subscription_url(sub_id: str) -> str:
+    return f"{config.SUBSCRIPTION_BASE_URL.rstrip('/')}{config.SUBSCRIPTION_PATH}/{sub_id}"
+
+def build_entry(profile_data: str) -> SubscriptionEntry:
+    """Тело подписки в формате v2ray: ссылки по одной на строку в base64"""
+    body = base64.b64encode((generate_vless_url(json.loads(profile_data)) + "\n").encode())
+    return SubscriptionEntry(profile_data, body, f'"{hashlib.sha256(body).hexdigest()[:32]}"')
+
+class SubscriptionCache:
+    """
+    Precomputed subscription bodies keyed by sub_id.
+
+    Client apps poll `/sub/{sub_id}` periodically, so bodies are built once
+    and served with an ETag; a poll with a matching If-None-Match costs a
+    dictionary lookup and a 304. An entry is rebuilt when the user's
+    vless_profile_data no longer matches the one it was built from, so
+    profile changes need no explicit invalidation.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, SubscriptionEntry] = {}
+
+    async def warm(self):
+        """Сборка тел подписок всех пользователей с профилем"""
+        for user in await get_all_users():
+            if user.sub_id and user.vless_profile_data:
+                self._build(user.sub_id, user.vless_profile_data)
+        logger.info(f"✅ Subscriptions prepared: {len(self._entries)}")
+
+    async def get(self, sub_id: str) -> Optional[SubscriptionEntry]:
+        user = await get_user_by_sub_id(sub_id)
+        if not user or not user.chat_member or not user.vless_profile_data:
+            self._entries.pop(sub_id, None)
+            return None
+        entry = self._entries.get(sub_id)
+        if entry is None or entry.profile_data != user.vless_profile_data:
+            entry = self._build(sub_id, user.vless_profile_data)
+        return entry
+
+    def _build(self, sub_id: str, profile_data: str) -> Optional[SubscriptionEntry]:
+        try:
+            entry = build_entry(profile_data)
+        except Exception as e:
+            logger.warning(f"⚠️ Broken profile data for subscription {sub_id}: {e}")
+            return None
+        self._entries[sub_id] = entry
+        return entry
+
+subscriptions = SubscriptionCache()
+
+async def subscription_handler(request: web.Request) -> web.Response:
+    entry = await subscriptions.get(request.match_info["sub_id"])
+    if entry is None:
+        SUBSCRIPTION_REQUESTS.labels("not_found").inc()
+        raise web.HTTPNotFound()
+
+    headers = {
+        "ETag": entry.etag,
+        "Cache-Control": "no-cache",
+        # Интервал автообновления подписки в клиентах (Hiddify, Happ и др.), часы
+        "Profile-Update-Interval": str(config.SUBSCRIPTION_UPDATE_INTERVAL),
+    }
+    if entry.etag in request.headers.get("If-None-Match", ""):
+        SUBSCRIPTION_REQUESTS.labels("not_modified").inc()
+        return web.Response(status=304, headers=headers)
+    SUBSCRIPTION_REQUESTS.labels("ok").inc()
+    return web.Response(body=entry.body, content_type="text/plain", headers=headers)
@@ -0,0 +1,177 @@
+import cProfile
+import logging
+import random
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+from aiogram.types import TelegramObject, Update
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+class Span:
+    """Участок обработки апдейта: имя, длительность и вложенные участки"""
+    __slots__ = ("name", "started", "duration", "children")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.perf_counter()
+        self.duration: Optional[float] = None
+        self.children: List["Span"] = []
+
+    def finish(self):
+        self.duration = time.perf_counter() - self.started
+
+    def format(self, depth: int = 0) -> List[str]:
+        duration = f"{self.duration * 1000:.1f} ms" if self.duration is not None else "unfinished"
+        lines = [f"{'  ' * depth}{self.name}: {duration}"]
+        for child in sorted(self.children, key=lambda span: span.started):
+            lines.extend(child.format(depth + 1))
+        return lines
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+def start_span(name: str) -> Optional[Span]:
+    """Дочерний участок текущего апдейта; вне трассируемого апдейта - None"""
+    parent = _current_span.get()
+    # Фоновые задачи, запущенные из обработчика (рассылка), наследуют
+    # контекст апдейта, но после его завершения в дерево не пишут
+    if parent is None or parent.duration is not None:
+        return None
+    span = Span(name)
+    parent.children.append(span)
+    return span
+
+class trace:
+    """
+    Участок трассировки для блока кода (with и async with).
+
+    Вложенные вызовы (в том числе в задачах, созданных внутри блока)
+    попадают в дерево как дочерние участки.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.span: Optional[Span] = None
+        self._token = None
+
+    def __enter__(self) -> Optional[Span]:
+        self.span = start_span(self.name)
+        if self.span is not None:
+            self._token = _current_span.set(self.span)
+        return self.span
+
+    def __exit__(self, *exc_info):
+        if self.span is not None:
+            self.span.finish()
+            _current_span.reset(self._token)
+
+    async def __aenter__(self) -> Optional[Span]:
+        return self.__enter__()
+
+    async def __aexit__(self, *exc_info):
+        self.__exit__(*exc_info)
+
+def trace_engine(engine: AsyncEngine):
+    """Участки для каждого SQL запроса движка"""
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        span = start_span(f"db {statement.split(None, 1)[0].upper()}")
+        conn.info.setdefault("trace_spans", []).append(span)
+
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        spans = conn.info.get("trace_spans")
+        span = spans.pop() if spans else None
+        if span:
+            span.finish()
+
+    event.listen(engine.sync_engine, "before_cursor_execute", before_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", after_execute)
+
+class BotAPITracingMiddleware(BaseRequestMiddleware):
+    """Участки для запросов к Bot API"""
+
+    async def __call__(
+        self,
+        make_request: NextRequestMiddlewareType[TelegramType],
+        bot: Bot,
+        method: TelegramMethod[TelegramType],
+    ) -> Response[TelegramType]:
+        with trace(f"bot {method.__api_method__}"):
+            return await make_request(bot, method)
+
+class UpdateTracingMiddleware(BaseMiddleware):
+    """
+    Per-update span tree with slow update dumps and sampled profiling.
+
+    Updates that take longer than TRACE_SLOW_THRESHOLD seconds are logged
+    with the time spent in DB queries, panel requests and Bot API calls.
+    PROFILE_SAMPLE_RATE of updates run under cProfile and the stats go to
+    PROFILE_DIR, keeping the newest PROFILE_KEEP files. cProfile sees all
+    code the event loop runs meanwhile, so a profile may include other
+    updates' work; only one update is profiled at a time.
+    """
+
+    def __init__(self):
+        self._profiling = False
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        root = Span(f"update {event.update_id} ({_describe(event)})")
+        token = _current_span.set(root)
+        profiler = self._start_profiler()
+        try:
+            return await handler(event, data)
+        finally:
+            root.finish()
+            _current_span.reset(token)
+            if profiler:
+                self._save_profile(profiler, event)
+            if config.TRACE_SLOW_THRESHOLD and root.duration >= config.TRACE_SLOW_THRESHOLD:
+                logger.warning("🐢 Slow update:\n" + "\n".join(root.format()))
+
+    def _start_profiler(self) -> Optional[cProfile.Profile]:
+        if self._profiling or random.random() >= config.PROFILE_SAMPLE_RATE:
+            return None
+        self._profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _save_profile(self, profiler: cProfile.Profile, event: Update):
+        profiler.disable()
+        self._profiling = False
+        try:
+            directory = Path(config.PROFILE_DIR)
+            directory.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(directory / f"{time.strftime('%Y%m%d-%H%M%S')}-{event.update_id}.prof")
+            # Ротация: оставляем только последние PROFILE_KEEP профилей
+            profiles = sorted(directory.glob("*.prof"), key=lambda path: path.stat().st_mtime)
+            for path in profiles[:max(len(profiles) - config.PROFILE_KEEP, 0)]:
+                path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"⚠️ Profile not saved: {e}")
+
+def _describe(event: Update) -> str:
+    if event.message:
+        return f"message {(event.message.text or '')[:32]!r}"
+    if event.callback_query:
+        return f"callback {event.callback_query.data!r}"
+    return event.event_type
+
+def setup_tracing(dp: Dispatcher, bot: Bot, engine: AsyncEngine):
+    dp.update.outer_middleware(UpdateTracingMiddleware())
+    bot.session.middleware(BotAPITracingMiddleware())
+    trace_engine(engine)
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from config import config
+from functions import get_api
+
+logger = logging.getLogger(__name__)
+
+# Размещение клиента: (имя сервера, id инбаунда)
+Placement = Tuple[str, int]
+
+class TrafficMonitor:
+    """
+    In-memory snapshot of per-client traffic for every inbound of the pool.
+
+    A background task pulls `clientStats` of each inbound in a single
+    request every TRAFFIC_POLL_INTERVAL seconds, so stats screens are served
+    from memory and cost no panel requests. The same snapshot gives the
+    client count and recent traffic rate of each inbound for placement.
+    """
+
+    def __init__(self, placements: List[Placement], interval: float):
+        self.placements = placements
+        self.interval = interval
+        self.clients: Dict[str, dict] = {}
+        self.inbounds: Dict[Placement, dict] = {}
+        self.updated_at: Optional[datetime] = None
+        # Выставляется после каждого обновленного снимка (для истории трафика)
+        self.snapshot_updated = asyncio.Event()
+        self._inbound_clients: Dict[Placement, Dict[str, dict]] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def _poll_inbound(self, placement: Placement) -> bool:
+        server_name, inbound_id = placement
+        inbound = await get_api(server_name).get_inbound(inbound_id)
+        if not inbound:
+            logger.warning(f"⚠️ Traffic poll failed for inbound {inbound_id} on {server_name}")
+            return False
+
+        clients = {
+            stat["email"]: {"upload": stat.get("up", 0), "download": stat.get("down", 0), "rate": 0.0}
+            for stat in inbound.get("clientStats") or []
+            if stat.get("email")
+        }
+        upload, download = inbound.get("up", 0), inbound.get("down", 0)
+        now = time.monotonic()
+        previous = self.inbounds.get(placement)
+        rate = 0.0
+        if previous and now > previous["polled_at"]:
+            elapsed = now - previous["polled_at"]
+            # Счетчики панели могут сбрасываться - отрицательную разницу не учитываем
+            delta = upload + download - previous["upload"] - previous["download"]
+            rate = max(delta, 0) / elapsed
+            # Скорость каждого клиента за интервал опроса (для аналитики)
+            previous_clients = self._inbound_clients.get(placement, {})
+            for email, stats in clients.items():
+                before = previous_clients.get(email)
+                if before:
+                    delta = stats["upload"] + stats["download"] - before["upload"] - before["download"]
+                    stats["rate"] = max(delta, 0) / elapsed
+        self._inbound_clients[placement] = clients
+        self.inbounds[placement] = {
+            "upload": upload,
+            "download": download,
+            "clients": len(clients),
+            "rate": rate,
+            "polled_at": now,
+        }
+        return True
+
+    async def poll(self) -> bool:
+        """Загрузка трафика всех клиентов пула, по одному запросу на инбаунд"""
+        results = await asyncio.gather(
+            *(self._poll_inbound(placement) for placement in self.placements),
+            return_exceptions=True,
+        )
+        if not any(result is True for result in results):
+            return False
+
+        # Инбаунды, которые не ответили, остаются в снимке с прошлыми данными
+        clients = {}
+        for placement_clients in self._inbound_clients.values():
+            clients.update(placement_clients)
+        self.clients = clients
+        self.updated_at = datetime.now()
+        self.snapshot_updated.set()
+        logger.debug(f"⚙️ Traffic snapshot updated: {len(self.clients)} clients in {len(self.inbounds)} inbounds")
+        return True
+
+    async def ensure_snapshot(self):
+        """Дождаться первого снимка (параллельные вызовы делят один запрос)"""
+        if self.updated_at is not None:
+            return
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.poll())
+        await asyncio.shield(self._refresh_task)
+
+    async def get_client_stats(self, email: str) -> dict:
+        await self.ensure_snapshot()
+        stats = self.clients.get(email, {"upload": 0, "download": 0})
+        return {**stats, "updated_at": self.updated_at}
+
+    async def get_inbound_stats(self) -> dict:
+        """Суммарный трафик всех инбаундов пула"""
+        await self.ensure_snapshot()
+        return {
+            "upload": sum(inbound["upload"] for inbound in self.inbounds.values()),
+            "download": sum(inbound["download"] for inbound in self.inbounds.values()),
+            "updated_at": self.updated_at,
+        }
+
+    def locate(self, email: str) -> Optional[Placement]:
+        """Инбаунд, в котором находится клиент по последнему снимку"""
+        for placement, clients in self._inbound_clients.items():
+            if email in clients:
+                return placement
+        return None
+
+    def reserve(self, placement: Placement, count: int = 1):
+        """
+        Учесть создаваемых клиентов до следующего опроса, чтобы серия
+        одновременных созданий не легла в один инбаунд. Отрицательное
+        значение снимает резерв после неудачи.
+        """
+        if placement in self.inbounds:
+            self.inbounds[placement]["clients"] += count
+
+    def record_client(self, placement: Placement, email: str):
+        """Запомнить размещение нового клиента до следующего опроса"""
+        self._inbound_clients.setdefault(placement, {}).setdefault(email, {"upload": 0, "download": 0, "rate": 0.0})
+
+    async def run(self):
+        """Фоновый опрос трафика"""
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.warning(f"⚠️ Traffic poll error: {e}")
+            await asyncio.sleep(self.interval)
+
+traffic_monitor = TrafficMonitor(
+    [(server.name, inbound_id) for server in config.XUI_SERVERS for inbound_id in server.inbounds],
+    config.TRAFFIC_POLL_INTERVAL,
+)